@@ -0,0 +1,330 @@
+"""
+End-to-end load benchmark: N simulated users go through the whole /image -> prompt -> count ->
+size -> style -> price flow of BotHandler at the same time, against local stand-ins for the
+Stability API (fake_stability.py) and the Telegram Bot API (fake_telegram.py). Everything else
+is the real bot: scheduler, cache, decode/watermark/encode, delivery, database, persistence.
+The fakes run in their own process, so their work doesn't show up as the bot's loop blocking.
+
+Reports throughput, end-to-end latency percentiles, event loop blocking and peak memory.
+With --draft, users ask for drafts and refine the first one instead of answering the price question.
+Results can be saved and compared with an earlier run to catch regressions:
+
+    python benchmarks/bench_e2e.py --users 50 --save benchmarks/results/baseline.json
+    python benchmarks/bench_e2e.py --users 50 --compare benchmarks/results/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import resource
+import platform
+import subprocess
+import multiprocessing
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.abspath(os.path.join(BENCH_DIR, "..", "bot"))
+STABILITY_PORT = 8787
+TELEGRAM_PORT = 8788
+
+# Lower is better for every metric except these
+HIGHER_IS_BETTER = {"images_per_second", "flows_per_second", "completed"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="simulated users, all starting at once")
+    parser.add_argument("--count", type=int, default=2, help="images each user asks for (1-4)")
+    parser.add_argument("--size", default="square", help="size each user picks")
+    parser.add_argument("--stability-latency", type=float, default=0.5, help="seconds per fake render")
+    parser.add_argument("--stability-error-rate", type=float, default=0.0, help="share of renders answered with 503")
+    parser.add_argument("--image-size", type=int, default=1024, help="side in pixels of the fake renders (payload size)")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="seconds per fake Bot API call")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="share of send calls that fail")
+    parser.add_argument("--telegram-bandwidth", type=float, default=None, help="simulated upload link to Telegram in Mbit/s")
+    parser.add_argument("--one-shot", action="store_true", help="send /image <prompt> --n --size --style instead of answering each step")
+    parser.add_argument("--draft", action="store_true", help="render drafts, then refine the first one of each user")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a user takes to answer each bot message")
+    parser.add_argument("--preview-format", default="jpeg", choices=["jpeg", "webp", "none"], help="PREVIEW_FORMAT of the bot")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    return parser.parse_args()
+
+
+def configure(args, workdir):
+    """
+    Points the bot at the fakes and a scratch directory. Must run before the bot modules are imported,
+    they read their settings at import time.
+    """
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{TELEGRAM_PORT}/bot",
+        "STABILITY_API_URL": f"http://127.0.0.1:{STABILITY_PORT}/v1/generation/fake/text-to-image",
+        "STABILITY_API_KEY": "bench",
+        "USER_ID": "*",
+        "ADMIN_ID": "",
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "RATE_LIMIT_PER_MINUTE": "0",
+        "DAILY_IMAGE_QUOTA": "0",
+        "GENERATION_MAX_QUEUE": str(max(args.users * args.count, 50)),
+        "GENERATION_PER_USER_LIMIT": "4",
+        "PREVIEW_FORMAT": args.preview_format,
+    })
+    # The bot saves images to ./image and reads ./logo.png, keep both inside the scratch directory
+    shutil.copy(os.path.join(BOT_DIR, "logo.png"), workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+    sys.path.insert(0, BENCH_DIR)
+
+
+def run_fakes(args):
+    """
+    Child process: serves the fake Stability and Telegram APIs until terminated.
+    """
+    sys.path.insert(0, BOT_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from webhook import serve_http
+    from fake_stability import FakeStability
+    from fake_telegram import FakeTelegram
+
+    async def serve():
+        stability = FakeStability(latency=args.stability_latency, fail_rate=args.stability_error_rate, image_size=args.image_size, seed=1)
+        telegram = FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_error_rate, seed=1,
+                                bandwidth_mbps=args.telegram_bandwidth)
+        await serve_http(stability.handle, "127.0.0.1", STABILITY_PORT)
+        await serve_http(telegram.handle, "127.0.0.1", TELEGRAM_PORT, max_body=64 * 1024 * 1024)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def fake_stats(client, port):
+    return (await client.get(f"http://127.0.0.1:{port}/stats")).json()
+
+
+async def wait_for_fakes(timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        for port in (STABILITY_PORT, TELEGRAM_PORT):
+            while True:
+                try:
+                    await fake_stats(client, port)
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("The fake APIs did not start")
+                    await asyncio.sleep(0.1)
+
+
+def message_update(update_id, user_id, text):
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def button_update(update_id, user_id, data):
+    sender = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": ""}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": sender, "chat_instance": str(user_id),
+                                                       "message": message, "data": data}}
+
+
+async def run(args):
+    from telegram import Update
+    from main import BotHandler
+    from database import database
+    from common import measure_loop_lag, percentile
+
+    await wait_for_fakes()
+    database.open()
+    bot_handler = BotHandler(use_updater=False)
+    application = bot_handler.application
+    await application.initialize()
+    await bot_handler.post_init(application)
+    await application.start()
+
+    update_ids = iter(range(1, 10 ** 9))
+    flow_latencies = []
+    style_latencies = []
+    refine_latencies = []
+    completed = 0
+
+    async def first_draft(user_id):
+        # The image id the first Refine button carries
+        return await database.run(lambda conn: conn.execute(
+            "SELECT image_id FROM drafts WHERE telegram_id = ? ORDER BY created_at LIMIT 1", (user_id,),
+        ).fetchone())
+
+    async def user(user_id):
+        nonlocal completed
+        prompt = f"a benchmark prompt from user {user_id}"
+        if args.one_shot:
+            steps = ["/start", f"/image {prompt} --n {args.count} --size {args.size} --style anime", "no"]
+        else:
+            steps = ["/start", "/image", prompt, str(args.count), args.size, "anime", "no"]
+        if args.draft:
+            # Drafts end the conversation with the Refine buttons, there is no price question
+            steps = steps[:-1]
+            if args.one_shot:
+                steps[-1] += " --draft"
+            else:
+                steps.insert(1, "/draft")
+        # The step that starts the renders, timed until the images are sent
+        generating = steps[-1] if args.draft else steps[-2]
+        begin = time.perf_counter()
+        try:
+            for text in steps:
+                if text != "/start":
+                    await asyncio.sleep(args.think_time)
+                step_begin = time.perf_counter()
+                update = Update.de_json(message_update(next(update_ids), user_id, text), application.bot)
+                await application.process_update(update)
+                if text == generating:
+                    style_latencies.append(time.perf_counter() - step_begin)
+            if args.draft:
+                row = await first_draft(user_id)
+                if row is None:
+                    raise RuntimeError("no draft to refine")
+                await asyncio.sleep(args.think_time)
+                step_begin = time.perf_counter()
+                update = Update.de_json(button_update(next(update_ids), user_id, f"refine:{row[0]}"), application.bot)
+                await application.process_update(update)
+                refine_latencies.append(time.perf_counter() - step_begin)
+        except Exception as e:
+            print(f"user {user_id} failed: {e}")
+            return
+        flow_latencies.append(time.perf_counter() - begin)
+        completed += 1
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    begin = time.perf_counter()
+    await asyncio.gather(*(user(1000 + n) for n in range(args.users)))
+    elapsed = time.perf_counter() - begin
+    stop.set()
+    worst_lag, total_lag = await lag_task
+
+    images = bot_handler.metrics.images
+    send = bot_handler.metrics.summary().get("send", (float("nan"),) * 3)
+    delivered = images["rendered"] + images["cached"]
+    drafts = images["draft"]
+    await application.stop()
+    await application.shutdown()
+    await bot_handler.shutdown(application)
+    async with httpx.AsyncClient() as client:
+        stability = await fake_stats(client, STABILITY_PORT)
+        telegram = await fake_stats(client, TELEGRAM_PORT)
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kilobytes on Linux
+    return {
+        "completed": completed,
+        "images_delivered": delivered,
+        "images_failed": images["failed"],
+        "drafts_delivered": drafts,
+        "elapsed_s": elapsed,
+        "flows_per_second": completed / elapsed,
+        "images_per_second": delivered / elapsed,
+        "flow_p50_s": percentile(flow_latencies, 0.5),
+        "flow_p95_s": percentile(flow_latencies, 0.95),
+        "flow_p99_s": percentile(flow_latencies, 0.99),
+        "style_p50_s": percentile(style_latencies, 0.5),
+        "style_p95_s": percentile(style_latencies, 0.95),
+        "style_p99_s": percentile(style_latencies, 0.99),
+        "refine_p50_s": percentile(refine_latencies, 0.5),
+        "refine_p95_s": percentile(refine_latencies, 0.95),
+        "send_p50_s": send[0],
+        "send_p95_s": send[1],
+        "loop_blocked_worst_ms": worst_lag * 1000,
+        "loop_blocked_total_ms": total_lag * 1000,
+        "peak_rss_mb": peak_kb / 1024,
+        "stability_calls": stability["calls"],
+        "stability_steps": stability["steps"],
+        "telegram_calls": telegram["calls"],
+        "uploaded_mb": telegram["uploaded_bytes"] / 2 ** 20,
+    }
+
+
+def report(results):
+    print(f"users completed: {results['completed']}, images delivered: {results['images_delivered']}, failed: {results['images_failed']}")
+    print(f"throughput: {results['images_per_second']:.2f} images/s, {results['flows_per_second']:.2f} flows/s ({results['elapsed_s']:.1f}s total)")
+    print(f"whole flow   p50 {results['flow_p50_s']:.2f}s  p95 {results['flow_p95_s']:.2f}s  p99 {results['flow_p99_s']:.2f}s")
+    print(f"render step  p50 {results['style_p50_s']:.2f}s  p95 {results['style_p95_s']:.2f}s  p99 {results['style_p99_s']:.2f}s")
+    if results.get("drafts_delivered"):
+        print(f"refine step  p50 {results['refine_p50_s']:.2f}s  p95 {results['refine_p95_s']:.2f}s ({results['drafts_delivered']} drafts)")
+    print(f"Telegram send p50 {results['send_p50_s']:.2f}s  p95 {results['send_p95_s']:.2f}s")
+    print(f"event loop blocked: worst {results['loop_blocked_worst_ms']:.1f} ms, total {results['loop_blocked_total_ms']:.0f} ms")
+    print(f"peak memory: {results['peak_rss_mb']:.0f} MB, uploaded {results['uploaded_mb']:.1f} MB, "
+          f"{results['stability_calls']} Stability calls ({results['stability_steps']} steps), {sum(results['telegram_calls'].values())} Telegram calls")
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints every numeric metric next to the baseline. Returns True when any got worse by more than `threshold`.
+    """
+    regressed = False
+    print(f"\n{'metric':<24} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, value in results.items():
+        old = baseline.get(name)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+            continue
+        change = (value - old) / old
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = ""
+        # Tiny absolute numbers (a few ms of loop lag) swing a lot between runs, don't call those regressions
+        if worse > threshold and not (name.endswith("_ms") and abs(value - old) < 5):
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{name:<24} {old:>10.3f} {value:>10.3f} {change:>+8.1%}{flag}")
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    args = parse_args()
+    config = {key: value for key, value in vars(args).items() if key not in ("save", "compare", "threshold")}
+    save = os.path.abspath(args.save) if args.save else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    fakes = multiprocessing.get_context("spawn").Process(target=run_fakes, args=(args,), daemon=True)
+    fakes.start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configure(args, workdir)
+            results = asyncio.run(run(args))
+            os.chdir(BENCH_DIR)
+    finally:
+        fakes.terminate()
+    report(results)
+
+    if save:
+        os.makedirs(os.path.dirname(save), exist_ok=True)
+        with open(save, "w", encoding="utf-8") as f:
+            json.dump({"commit": git_commit(), "python": platform.python_version(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "config": config, "results": results}, f, indent=2)
+        print(f"\nSaved to {save}")
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("\nNote: the baseline was run with different settings")
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Synthetic-archive benchmark for the streaming gallery build (generate_html.py --stream).
+Creates archives of the given sizes (empty placeholder .png files plus generation records),
+runs the streaming build on each in a fresh process and prints time and peak memory.
+Peak memory should stay flat as the archive grows.
+
+    python benchmarks/bench_gallery_stream.py --sizes 1000 10000 100000
+    python benchmarks/bench_gallery_stream.py --sizes 1000 1000000 --compare
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, PROJECT_DIR)
+
+from bot.database import connect, migrate  # noqa: E402
+
+
+def make_archive(directory, count):
+    """
+    Lays out <directory>/bot/image with `count` placeholder images and a matching database.
+    """
+    image_folder = os.path.join(directory, "bot", "image")
+    os.makedirs(image_folder)
+    conn = connect(os.path.join(directory, "bot", "bot_users.db"))
+    migrate(conn)
+    conn.execute("BEGIN")
+    styles = ["anime", "photographic", "pixel-art", "cinematic"]
+    for n in range(count):
+        image_id = f"txt2img_{n}"
+        open(os.path.join(image_folder, image_id + ".png"), "wb").close()
+        conn.execute(
+            "INSERT INTO generations (image_id, path, prompt, style, size, username, telegram_id, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (image_id, f"image/{image_id}.png", f"a synthetic prompt number {n} with a few words", styles[n % 4],
+             "square", f"user{n % 500}", n % 500, (n % 9) * 2.5 or None),
+        )
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def run_build(directory, stream):
+    """
+    Runs generate_html.py in `directory` and returns (seconds, peak memory MB).
+    """
+    command = [sys.executable, os.path.join(PROJECT_DIR, "generate_html.py")]
+    if stream:
+        command.append("--stream")
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    started = time.perf_counter()
+    output = subprocess.run(command, cwd=directory, env=env, check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - started
+    match = re.search(r"peak memory ([\d.]+) MB", output)
+    return elapsed, float(match.group(1)) if match else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="archive sizes to test")
+    parser.add_argument("--compare", action="store_true", help="also run the in-memory (indexed) build")
+    args = parser.parse_args()
+
+    print(f"{'images':>10} {'mode':>8} {'seconds':>9} {'peak MB':>9}")
+    for count in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            make_archive(directory, count)
+            modes = [("stream", True)] + ([("indexed", False)] if args.compare else [])
+            for name, stream in modes:
+                elapsed, peak = run_build(directory, stream)
+                print(f"{count:>10} {name:>8} {elapsed:>9.2f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Post-processing throughput: API response -> decoded, watermarked, PNG + preview encoded image.
+Compares the thread path (asyncio.to_thread, what the bot does with POSTPROCESS_WORKERS=0) with
+the process pool (postprocess.py), feeding both the same responses `--concurrency` at a time.
+Reports images/second and how long the event loop was blocked meanwhile.
+
+    python benchmarks/bench_postprocess.py
+    python benchmarks/bench_postprocess.py --images 64 --workers 4 --size 1024
+"""
+import io
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+os.environ.setdefault("USER_ID", "*")
+os.environ.setdefault("ADMIN_ID", "*")
+os.chdir(BOT_DIR)  # logo.png is resolved relative to the bot folder
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+from postprocess import Watermark, PostProcessPool, process_response, default_workers  # noqa: E402
+from common import measure_loop_lag  # noqa: E402
+
+
+def sample_response(size, seed):
+    """
+    A text-to-image response with a `size` x `size` PNG: smooth gradients plus some grain, which
+    compresses about like a real render (pure noise would make PNG encoding look cheaper than it is).
+    """
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    pixels = np.stack([np.add.outer(ramp, ramp) / 2, np.add.outer(ramp[::-1], ramp) / 2, np.tile(ramp, (size, 1))], axis=-1)
+    pixels += rng.normal(0, 6, pixels.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB").save(buffer, format="PNG")
+    artifact = {"base64": base64.b64encode(buffer.getvalue()).decode("ascii"), "seed": seed, "finishReason": "SUCCESS"}
+    return json.dumps({"artifacts": [artifact]}).encode("ascii")
+
+
+async def run(process, bodies, concurrency):
+    """
+    Processes every body with `process`, `concurrency` at a time. Returns (seconds, worst loop lag, total loop lag).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+
+    async def one(body):
+        async with semaphore:
+            await process(body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(body) for body in bodies))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    worst, total = await lag_task
+    return elapsed, worst, total
+
+
+async def main(args):
+    bodies = [sample_response(args.size, seed) for seed in range(args.images)]
+    print(f"{args.images} responses of {sum(map(len, bodies)) / len(bodies) / 1024 / 1024:.1f} MB, "
+          f"{args.size}x{args.size}, {args.concurrency} at a time, preview {args.preview_format}")
+    sizes = [(args.size, args.size)]
+
+    watermark = Watermark("logo.png")
+    watermark.prewarm(sizes)
+    elapsed, worst, total = await run(
+        lambda body: asyncio.to_thread(process_response, body, watermark, args.preview_format, 85), bodies, args.concurrency,
+    )
+    print(f"  thread:            {args.images / elapsed:6.2f} images/s, loop blocked worst {worst * 1000:5.0f} ms, total {total * 1000:6.0f} ms")
+
+    pool = PostProcessPool(args.workers, "logo.png", sizes, args.preview_format, 85)
+    started = time.perf_counter()
+    await pool.start()
+    warmup = time.perf_counter() - started
+    elapsed, worst, total = await run(pool.process, bodies, args.concurrency)
+    await pool.close()
+    print(f"  pool ({args.workers} workers): {args.images / elapsed:6.2f} images/s, loop blocked worst {worst * 1000:5.0f} ms, "
+          f"total {total * 1000:6.0f} ms (start-up {warmup:.1f}s, not counted)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--size", type=int, default=1024, help="side of the rendered images in pixels")
+    parser.add_argument("--concurrency", type=int, default=4, help="responses in flight (STABILITY_MAX_CONCURRENCY)")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="pool processes, defaults to the cores available")
+    parser.add_argument("--preview-format", default="jpeg", choices=["jpeg", "webp", "none"])
+    asyncio.run(main(parser.parse_args()))
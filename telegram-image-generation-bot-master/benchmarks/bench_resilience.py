@@ -0,0 +1,124 @@
+"""
+Runs ImageGen.generate_image against the fake Stability server (fake_stability.py) in three
+scenarios and compares the resilience settings:
+
+    flaky   30% 503s and 10% 429s: success rate without and with retries
+    outage  every call fails: time per call before and after the circuit breaker opens
+    tail    5% of renders are slow: latency percentiles without and with hedging
+
+    python benchmarks/bench_resilience.py
+    python benchmarks/bench_resilience.py --calls 400 --scenario tail
+"""
+import io
+import os
+import sys
+import time
+import contextlib
+import asyncio
+import argparse
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+os.environ.setdefault("USER_ID", "*")
+os.environ.setdefault("ADMIN_ID", "*")
+os.chdir(BOT_DIR)
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from webhook import serve_http  # noqa: E402
+from helper import ImageGen  # noqa: E402
+from resilience import ResilientCaller, RetryPolicy, CircuitBreaker  # noqa: E402
+from fake_stability import FakeStability  # noqa: E402
+from common import percentile  # noqa: E402
+
+PORT = 8778
+
+
+def make_image_gen(retries=0, threshold=1000, reset=30.0, hedge=0):
+    image_gen = ImageGen()
+    image_gen.api_url = f"http://127.0.0.1:{PORT}/v1/generation/fake/text-to-image"
+    image_gen.resilience = ResilientCaller(
+        retry=RetryPolicy(attempts=retries, base_delay=0.02, max_delay=2),
+        breaker=CircuitBreaker(failure_threshold=threshold, reset_timeout=reset),
+        hedge_percentile=hedge,
+        semaphore=image_gen._semaphore,
+    )
+    return image_gen
+
+
+async def run_calls(image_gen, calls, concurrency=4):
+    """
+    Makes `calls` renders, `concurrency` at a time. Returns (successes, per-call latencies).
+    """
+    latencies = []
+    successes = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(n):
+        nonlocal successes
+        async with semaphore:
+            started = time.perf_counter()
+            result = await image_gen.generate_image(f"benchmark prompt {n}")
+            latencies.append(time.perf_counter() - started)
+            successes += result is not None
+
+    # generate_image prints every failure, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(one(n) for n in range(calls)))
+    await image_gen.close()
+    return successes, latencies
+
+
+async def flaky(fake, calls):
+    fake.fail_rate, fake.rate_limit_rate, fake.retry_after = 0.3, 0.1, 0
+    print("flaky: 30% 503, 10% 429")
+    for retries in (0, 3):
+        fake.calls = 0
+        successes, latencies = await run_calls(make_image_gen(retries=retries), calls)
+        print(f"  retries={retries}: {successes}/{calls} succeeded, {fake.calls} API calls, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms")
+    fake.fail_rate = fake.rate_limit_rate = 0.0
+
+
+async def outage(fake, calls):
+    fake.down = True
+    fake.latency = 0.2
+    print("outage: every call fails after 200 ms")
+    for threshold in (1000, 5):
+        fake.calls = 0
+        image_gen = make_image_gen(retries=2, threshold=threshold)
+        successes, latencies = await run_calls(image_gen, calls)
+        label = "no breaker" if threshold == 1000 else f"breaker after {threshold} failures"
+        print(f"  {label}: {fake.calls} API calls for {calls} renders, "
+              f"mean {sum(latencies) / len(latencies) * 1000:.0f} ms per render, opened {image_gen.resilience.breaker.opens}x")
+    fake.down = False
+    fake.latency = 0.05
+
+
+async def tail(fake, calls):
+    fake.slow_rate, fake.slow_seconds = 0.05, 1.0
+    print("tail: 5% of renders take 1 s instead of 50 ms")
+    for hedge in (0, 90):
+        fake.calls = 0
+        image_gen = make_image_gen(hedge=hedge)
+        successes, latencies = await run_calls(image_gen, calls, concurrency=2)
+        label = "no hedging" if not hedge else f"hedge at p{hedge}"
+        print(f"  {label}: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p95 {percentile(latencies, 0.95) * 1000:.0f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, {fake.calls} API calls, "
+              f"{image_gen.resilience.hedges} hedges ({image_gen.resilience.hedge_wins} won)")
+    fake.slow_rate = 0.0
+
+
+async def main(args):
+    fake = FakeStability(seed=1)
+    server = await serve_http(fake.handle, "127.0.0.1", PORT)
+    scenarios = {"flaky": flaky, "outage": outage, "tail": tail}
+    for name in ([args.scenario] if args.scenario else scenarios):
+        await scenarios[name](fake, args.calls)
+    server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="renders per run")
+    parser.add_argument("--scenario", choices=["flaky", "outage", "tail"], help="run only one scenario")
+    asyncio.run(main(parser.parse_args()))
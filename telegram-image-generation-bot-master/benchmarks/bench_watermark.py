@@ -0,0 +1,67 @@
+"""
+Microbenchmark for watermarking: the old per-image path (open logo.png, resize, convert, paste)
+against the cached Watermark engine in bot/postprocess.py.
+
+Run from anywhere:
+    python benchmarks/bench_watermark.py --runs 20
+"""
+import os
+import sys
+import time
+import argparse
+from PIL import Image, ImageEnhance
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+os.environ.setdefault("USER_ID", "*")
+os.environ.setdefault("ADMIN_ID", "*")
+os.chdir(BOT_DIR)  # helper.py resolves logo.png relative to the bot folder
+sys.path.insert(0, BOT_DIR)
+
+from helper import ImageGen, Watermark  # noqa: E402
+
+
+def legacy_watermark(original_image, watermark_image_path, transparency=25):
+    """
+    The watermark code as it was before the cache: logo reopened and resized for every image.
+    """
+    watermark = Image.open(watermark_image_path)
+    min_dimension = min(original_image.width, original_image.height)
+    watermark_size = (int(min_dimension * 0.14), int(min_dimension * 0.14))
+    watermark = watermark.resize(watermark_size)
+    if watermark.mode != 'RGBA':
+        watermark = watermark.convert('RGBA')
+    image_with_watermark = original_image.copy()
+    position = (0, original_image.size[1] - watermark.size[1])
+    image_with_watermark.paste(watermark, position, watermark)
+    alpha = watermark.split()[3]
+    alpha = ImageEnhance.Brightness(alpha).enhance(transparency / 100.0)
+    watermark.putalpha(alpha)
+    return image_with_watermark
+
+
+def time_per_image(func, images, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        for image in images:
+            func(image)
+    return (time.perf_counter() - start) / (runs * len(images))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="passes over all nine output sizes")
+    args = parser.parse_args()
+
+    images = [Image.new("RGB", (width, height), (120, 80, 200)) for height, width in ImageGen.SIZE_MAPPING.values()]
+    engine = Watermark("logo.png")
+    engine.prewarm([image.size for image in images], transparency=25)
+
+    before = time_per_image(lambda image: legacy_watermark(image, "logo.png", 25), images, args.runs)
+    after = time_per_image(lambda image: engine.apply(image, 25), images, args.runs)
+    print(f"legacy (reopen + resize per image): {before * 1000:8.3f} ms/image")
+    print(f"cached engine (vectorized blend):   {after * 1000:8.3f} ms/image")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import asyncio
+
+
+async def measure_loop_lag(stop, interval=0.005):
+    """
+    Wakes up every `interval` seconds and records how late it was; lateness is time the loop was blocked.
+    Returns (worst lag, total lag) in seconds once `stop` is set.
+    """
+    worst = 0.0
+    total = 0.0
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        before = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - before - interval
+        worst = max(worst, lag)
+        total += max(lag, 0.0)
+    return worst, total
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else float("nan")
@@ -0,0 +1,112 @@
+"""
+A stand-in for the Stability text-to-image endpoint that injects failures and slow responses.
+Run it and point the bot at it to see retries, the circuit breaker and hedging at work:
+
+    python benchmarks/fake_stability.py --port 8777 --fail-rate 0.3 --rate-limit-rate 0.1 --slow-rate 0.05
+    STABILITY_API_URL=http://127.0.0.1:8777/v1/generation/fake/text-to-image python main.py
+
+Every render returns a small PNG, so the bot's decode/watermark/upload path runs as usual.
+"""
+import io
+import os
+import sys
+import json
+import random
+import base64
+import asyncio
+import argparse
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+
+from PIL import Image  # noqa: E402
+from webhook import serve_http  # noqa: E402
+
+
+def sample_png(size=64):
+    """
+    Returns a base64 PNG of `size` x `size` noise. Noise barely compresses, so the payload is about as big as a real render's.
+    """
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class FakeStability:
+    """
+    Answers text-to-image calls after `latency` seconds. A `fail_rate` share of calls get
+    `fail_status`, a `rate_limit_rate` share get 429 with Retry-After, and a `slow_rate` share take
+    `slow_seconds` instead. With `down` set every call fails. Renders are `image_size` pixels square.
+    Render time scales with the requested steps (`latency` is for 50) and each step count gets its own image.
+    GET /stats returns the call counters and the steps rendered.
+    """
+    def __init__(self, latency=0.05, fail_rate=0.0, fail_status=503, rate_limit_rate=0.0, retry_after=1,
+                 slow_rate=0.0, slow_seconds=5.0, down=False, seed=None, image_size=64):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.down = down
+        self.random = random.Random(seed)
+        self.image_size = image_size
+        self._pngs = {}  # steps -> PNG
+        self.calls = 0
+        self.steps = 0
+        self.failures = 0
+
+    async def handle(self, method, path, headers, body):
+        if method == "GET" and path == "/stats":
+            return 200, json.dumps({"calls": self.calls, "failures": self.failures, "steps": self.steps}), "application/json"
+        self.calls += 1
+        if method != "POST":
+            return 405, "POST only", "text/plain"
+        roll = self.random.random()
+        if self.down or roll < self.fail_rate:
+            self.failures += 1
+            await asyncio.sleep(self.latency)
+            return self.fail_status, json.dumps({"message": "injected failure"}), "application/json"
+        if roll < self.fail_rate + self.rate_limit_rate:
+            self.failures += 1
+            return 429, json.dumps({"message": "rate limited"}), "application/json", {"Retry-After": str(self.retry_after)}
+        slow = self.random.random() < self.slow_rate
+        request = json.loads(body or b"{}")
+        steps = request.get("steps", 50)
+        await asyncio.sleep(self.slow_seconds if slow else self.latency * steps / 50)
+        self.steps += steps
+        if steps not in self._pngs:
+            self._pngs[steps] = sample_png(self.image_size)
+        artifact = {"base64": self._pngs[steps], "seed": request.get("seed", self.random.randrange(2 ** 32)), "finishReason": "SUCCESS"}
+        return 200, json.dumps({"artifacts": [artifact]}), "application/json"
+
+
+async def serve(fake, host, port):
+    server = await serve_http(fake.handle, host, port)
+    print(f"Fake Stability API on http://{host}:{port}/v1/generation/fake/text-to-image")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8777)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per normal render")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of calls answered with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of calls that take --slow-seconds")
+    parser.add_argument("--slow-seconds", type=float, default=5.0)
+    parser.add_argument("--down", action="store_true", help="fail every call")
+    parser.add_argument("--image-size", type=int, default=64, help="side of the returned image in pixels")
+    args = parser.parse_args()
+    fake = FakeStability(args.latency, args.fail_rate, args.fail_status, args.rate_limit_rate, args.retry_after,
+                         args.slow_rate, args.slow_seconds, args.down, image_size=args.image_size)
+    asyncio.run(serve(fake, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+A stand-in for the Telegram Bot API, enough for the bot's own calls: getMe, sendMessage, answerCallbackQuery,
+sendChatAction, sendPhoto, sendMediaGroup and setWebhook. Every call takes `latency` seconds and
+an `error_rate` share of calls fail, `--bandwidth` makes uploads as slow as a link of that many Mbit/s. Point the bot at it with TELEGRAM_BASE_URL:
+
+    python benchmarks/fake_telegram.py --port 8999 --latency 0.05
+    TELEGRAM_BASE_URL=http://127.0.0.1:8999/bot python main.py --mode webhook
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from urllib.parse import parse_qs
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+
+from webhook import serve_http  # noqa: E402
+
+
+def form_fields(headers, body):
+    """
+    Returns the request's form fields as {name: str}. The bot sends url-encoded forms, or
+    multipart forms when it uploads files (file parts are skipped).
+    """
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        fields = {}
+        for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+            fields[name.decode()] = value.decode("utf-8", "replace")
+        return fields
+    return {name: values[0] for name, values in parse_qs(body.decode("utf-8", "replace")).items()}
+
+
+class FakeTelegram:
+    """
+    Answers Bot API calls after `latency` seconds, failing an `error_rate` share of the send calls.
+    With `bandwidth_mbps` set, uploads also take as long as they would on a link of that speed.
+    Counts calls per method and uploaded bytes, GET /stats returns the counters.
+    """
+    def __init__(self, latency=0.02, error_rate=0.0, seed=None, bandwidth_mbps=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth_mbps = bandwidth_mbps
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = 0
+        self.uploaded_bytes = 0
+        self._ids = itertools.count(1)
+
+    def _message(self, chat_id, **extra):
+        return {"message_id": next(self._ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def _photo(self):
+        n = next(self._ids)
+        return [{"file_id": f"fake-file-{n}", "file_unique_id": f"fake-unique-{n}", "width": 1024, "height": 1024}]
+
+    async def handle(self, method, path, headers, body):
+        if method == "GET" and path == "/stats":
+            stats = {"calls": dict(self.calls), "errors": self.errors, "uploaded_bytes": self.uploaded_bytes}
+            return 200, json.dumps(stats), "application/json"
+        name = path.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        transfer = len(body) * 8 / (self.bandwidth_mbps * 1e6) if self.bandwidth_mbps else 0.0
+        await asyncio.sleep(self.latency + transfer)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+            return 200, json.dumps({"ok": True, "result": result}), "application/json"
+        if name.startswith("send") and self.random.random() < self.error_rate:
+            self.errors += 1
+            return 500, json.dumps({"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}), "application/json"
+
+        fields = form_fields(headers, body)
+        chat_id = int(fields.get("chat_id", 1))
+        if name in ("sendChatAction", "setWebhook", "deleteWebhook", "answerCallbackQuery"):
+            result = True
+        elif name == "sendPhoto":
+            self.uploaded_bytes += len(body)
+            result = self._message(chat_id, photo=self._photo())
+        elif name == "sendMediaGroup":
+            self.uploaded_bytes += len(body)
+            # One message per media item; the media list is JSON inside a form field
+            count = len(json.loads(fields.get("media", "[{}]")))
+            result = [self._message(chat_id, photo=self._photo()) for _ in range(count)]
+        else:
+            result = self._message(chat_id, text="")
+        return 200, json.dumps({"ok": True, "result": result}), "application/json"
+
+
+async def serve(fake, host, port):
+    server = await serve_http(fake.handle, host, port, max_body=64 * 1024 * 1024)  # photo uploads
+    print(f"Fake Telegram Bot API on http://{host}:{port}/bot")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of send calls that fail")
+    parser.add_argument("--bandwidth", type=float, default=None, help="simulated upload link in Mbit/s")
+    args = parser.parse_args()
+    asyncio.run(serve(FakeTelegram(args.latency, args.error_rate, bandwidth_mbps=args.bandwidth), args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
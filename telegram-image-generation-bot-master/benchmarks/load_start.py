@@ -0,0 +1,121 @@
+"""
+Load test for /start: fires N concurrent /start updates at BotHandler.start and reports throughput,
+latency percentiles and how long the event loop was blocked. With --legacy the old path
+(a new sqlite3 connection per call, on the event loop) is measured for comparison.
+
+    python benchmarks/load_start.py --users 2000
+    python benchmarks/load_start.py --users 2000 --legacy
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+os.environ.setdefault("USER_ID", "*")
+os.environ.setdefault("ADMIN_ID", "*")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:load-test")
+os.chdir(BOT_DIR)
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import BotHandler  # noqa: E402
+from database import Database  # noqa: E402
+from common import measure_loop_lag, percentile  # noqa: E402
+
+
+class _User:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Load"
+
+
+class _Message:
+    def __init__(self, user_id):
+        self.from_user = _User(user_id)
+
+    async def reply_text(self, text, **kwargs):
+        pass
+
+
+class _Update:
+    def __init__(self, user_id):
+        self.message = _Message(user_id)
+
+
+class _Context:
+    def __init__(self):
+        self.user_data = {}
+
+
+def legacy_save_user(path, telegram_id, username):
+    """
+    The old save_user_to_db: a fresh connection and commit per call, run on the event loop.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)", (telegram_id, username))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def run(args, db_path):
+    bot_handler = BotHandler()
+    database = Database(db_path)
+    database.open()
+    bot_handler.database = database
+
+    if args.legacy:
+        async def start(update, context):
+            user = update.message.from_user
+            legacy_save_user(db_path, user.id, user.username)
+            await update.message.reply_text("hi")
+    else:
+        start = bot_handler.start
+
+    latencies = []
+
+    async def one(user_id):
+        begin = time.perf_counter()
+        await start(_Update(user_id), _Context())
+        latencies.append(time.perf_counter() - begin)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    begin = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in range(args.users)))
+    elapsed = time.perf_counter() - begin
+    stop.set()
+    worst_lag, total_lag = await lag_task
+
+    stored = await database.count_users()
+    commits = database.commits
+    await database.aclose()
+
+    mode = "legacy (connection per call)" if args.legacy else "Database (WAL, batched commits)"
+    print(f"mode: {mode}")
+    print(f"/start calls: {args.users}, users stored: {stored}")
+    print(f"throughput: {args.users / elapsed:,.0f} /start per second ({elapsed:.2f}s total)")
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"event loop blocked: worst {worst_lag * 1000:.1f} ms, total {total_lag * 1000:.0f} ms")
+    if not args.legacy:
+        print(f"commits: {commits} for {args.users} writes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="number of concurrent /start updates")
+    parser.add_argument("--legacy", action="store_true", help="measure the old per-call connection path")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(args, os.path.join(directory, "load_test.db")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    In-memory LRU of finished images keyed by the generation parameters that produced them.
+    Bounded both by total image bytes and by number of entries, least recently used entries go first.
+    """
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '500'))
+        self._entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(params, variant=0, owner=None):
+        """
+        Returns the cache key for a request body built by ImageGen.build_params, for the user `owner`.
+        Keys are per user: an image is recorded (and priced) as its owner's, so it is only served to them again.
+        The prompt is normalized (case and whitespace; the SDXL tokenizer ignores both) so trivial
+        resubmissions match. Without a pinned seed every render is random, so `variant` tells the
+        images of one multi-image request apart: resubmitting a 3-image request reuses all three.
+        """
+        normalized = {
+            "prompts": [
+                [" ".join(text_prompt["text"].split()).casefold(), text_prompt["weight"]]
+                for text_prompt in params["text_prompts"]
+            ],
+            "style": params.get("style_preset"),
+            "height": params.get("height"),
+            "width": params.get("width"),
+            "steps": params["steps"],
+            "cfg_scale": params["cfg_scale"],
+            "owner": owner,
+        }
+        if params.get("seed") is not None:
+            normalized["seed"] = params["seed"]
+        else:
+            normalized["variant"] = variant
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns a copy of the cached GeneratedImage marked as `from_cache`, or None.
+        """
+        image = self._entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return type(image)(image.seed, image.data, from_cache=True, preview=image.preview, preview_format=image.preview_format,
+                           image_id=image.image_id, steps=image.steps)
+
+    def put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size_bytes -= old.nbytes
+        self._entries[key] = image
+        self.size_bytes += image.nbytes
+        # Evict least recently used entries until both budgets are met
+        while self._entries and (self.size_bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+
+    def __len__(self):
+        return len(self._entries)
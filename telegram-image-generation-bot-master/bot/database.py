@@ -0,0 +1,772 @@
+import os
+import csv
+import sys
+import json
+import queue
+import asyncio
+import time
+import logging
+import sqlite3
+import argparse
+import threading
+
+# Database file path
+DB_FILE = os.getenv('DB_FILE', "bot_users.db")
+
+# Lower bounds (in dollars) of the price distribution's buckets, a price counts in the highest bound it reaches
+PRICE_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def _price_bucket(price):
+    return "CASE " + " ".join(f"WHEN {price} >= {bound} THEN {bound}" for bound in reversed(PRICE_BUCKETS)) + " ELSE 0 END"
+
+
+def _rollup_add(row):
+    """
+    Trigger statements that count generation `row` (NEW or OLD) into the rollup tables.
+    Rows without a prompt are file ids whose metadata hasn't arrived yet, they aren't counted until it has.
+    """
+    return f"""
+        INSERT INTO generation_rollup (day, telegram_id, style, size, images, steps, priced)
+        SELECT date({row}.created_at), COALESCE({row}.telegram_id, 0), COALESCE({row}.style, 'None'), COALESCE({row}.size, ''),
+               1, COALESCE({row}.steps, 0), {row}.price IS NOT NULL
+        WHERE {row}.prompt IS NOT NULL
+        ON CONFLICT (day, telegram_id, style, size) DO UPDATE SET
+            images = images + 1, steps = steps + excluded.steps, priced = priced + excluded.priced;
+        INSERT INTO price_rollup (bucket, images, total)
+        SELECT {_price_bucket(f"{row}.price")}, 1, {row}.price
+        WHERE {row}.prompt IS NOT NULL AND {row}.price IS NOT NULL
+        ON CONFLICT (bucket) DO UPDATE SET images = images + 1, total = total + excluded.total;
+    """
+
+
+def _rollup_subtract(row):
+    """
+    Trigger statements that take generation `row` back out of the rollup tables.
+    """
+    return f"""
+        UPDATE generation_rollup SET
+            images = images - 1, steps = steps - COALESCE({row}.steps, 0), priced = priced - ({row}.price IS NOT NULL)
+        WHERE {row}.prompt IS NOT NULL AND day = date({row}.created_at) AND telegram_id = COALESCE({row}.telegram_id, 0)
+            AND style = COALESCE({row}.style, 'None') AND size = COALESCE({row}.size, '');
+        UPDATE price_rollup SET images = images - 1, total = total - {row}.price
+        WHERE {row}.prompt IS NOT NULL AND {row}.price IS NOT NULL AND bucket = {_price_bucket(f"{row}.price")};
+    """
+
+
+# Schema migrations, applied in order. PRAGMA user_version records the last one applied.
+MIGRATIONS = [
+    # 1: the original users table
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT
+        )
+        """,
+    ],
+    # 2: generation metadata, replaces the per-image .txt files
+    [
+        """
+        CREATE TABLE IF NOT EXISTS generations (
+            image_id TEXT PRIMARY KEY,
+            path TEXT,
+            prompt TEXT,
+            style TEXT,
+            size TEXT,
+            username TEXT,
+            telegram_id INTEGER,
+            full_user TEXT,
+            price REAL,
+            file_id TEXT,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_generations_telegram_id ON generations (telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_username ON generations (username)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_style ON generations (style)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_price ON generations (price)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations (created_at)",
+    ],
+    # 3: conversation states and user/chat/bot data (persistence.py), shared by every replica
+    [
+        """
+        CREATE TABLE IF NOT EXISTS persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            replica TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 4: images generated per user and day, for the daily quota
+    [
+        """
+        CREATE TABLE IF NOT EXISTS usage (
+            telegram_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            images INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (telegram_id, day)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_usage_day ON usage (day)",
+    ],
+    # 5: file_id of the lossless original once it has been sent as a document
+    [
+        "ALTER TABLE generations ADD COLUMN original_file_id TEXT",
+    ],
+    # 6: image size and last delivery, for the storage retention policy (storage.py)
+    [
+        "ALTER TABLE generations ADD COLUMN bytes INTEGER",
+        "ALTER TABLE generations ADD COLUMN last_served_at TEXT",
+        # Eviction walks stored images by last use, the same expression as in SERVED_GENERATIONS
+        """
+        CREATE INDEX IF NOT EXISTS idx_generations_served
+        ON generations (COALESCE(last_served_at, created_at)) WHERE path IS NOT NULL
+        """,
+    ],
+    # 7: seed and diffusion steps, so a draft can be rendered again at full quality. Drafts get a table
+    # of their own, they aren't generated images as far as the gallery, exports and rollups go
+    [
+        "ALTER TABLE generations ADD COLUMN seed INTEGER",
+        "ALTER TABLE generations ADD COLUMN steps INTEGER",
+        """
+        CREATE TABLE IF NOT EXISTS drafts (
+            image_id TEXT PRIMARY KEY,
+            prompt TEXT,
+            style TEXT,
+            size TEXT,
+            telegram_id INTEGER,
+            seed INTEGER NOT NULL,
+            steps INTEGER,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )
+        """,
+    ],
+    # 8: rollups for /analytics, kept up to date by triggers so reading them never scans the history
+    [
+        """
+        CREATE TABLE IF NOT EXISTS generation_rollup (
+            day TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            style TEXT NOT NULL,
+            size TEXT NOT NULL,
+            images INTEGER NOT NULL DEFAULT 0,
+            steps INTEGER NOT NULL DEFAULT 0,
+            priced INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, telegram_id, style, size)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS price_rollup (
+            bucket REAL PRIMARY KEY,
+            images INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        # The history so far, counted once (replacing what a half-applied run of this step left)
+        """
+        INSERT OR REPLACE INTO generation_rollup (day, telegram_id, style, size, images, steps, priced)
+        SELECT date(created_at), COALESCE(telegram_id, 0), COALESCE(style, 'None'), COALESCE(size, ''),
+               COUNT(*), COALESCE(SUM(steps), 0), COUNT(price)
+        FROM generations WHERE prompt IS NOT NULL GROUP BY 1, 2, 3, 4
+        """,
+        f"""
+        INSERT OR REPLACE INTO price_rollup (bucket, images, total)
+        SELECT {_price_bucket("price")}, COUNT(*), SUM(price)
+        FROM generations WHERE prompt IS NOT NULL AND price IS NOT NULL GROUP BY 1
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS generations_rollup_insert AFTER INSERT ON generations
+        BEGIN {_rollup_add("NEW")} END
+        """,
+        # Only the columns the rollups group or sum by, so file ids and served times don't fire it
+        f"""
+        CREATE TRIGGER IF NOT EXISTS generations_rollup_update
+        AFTER UPDATE OF prompt, style, size, telegram_id, price, steps, created_at ON generations
+        BEGIN {_rollup_subtract("OLD")} {_rollup_add("NEW")} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS generations_rollup_delete AFTER DELETE ON generations
+        BEGIN {_rollup_subtract("OLD")} END
+        """,
+    ],
+]
+
+# Queries are kept as constants: sqlite3 caches the compiled statement per SQL string,
+# so every call after the first reuses the prepared statement.
+SAVE_USER = "INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)"
+GET_USER = "SELECT telegram_id, username FROM users WHERE telegram_id = ?"
+COUNT_USERS = "SELECT COUNT(*) FROM users"
+# Generation writes are upserts: the file_id can arrive before or after the metadata row
+ADD_GENERATION = """
+    INSERT INTO generations (image_id, path, prompt, style, size, username, telegram_id, bytes, seed, steps)
+    VALUES (:image_id, :path, :prompt, :style, :size, :username, :telegram_id, :bytes, :seed, :steps)
+    ON CONFLICT (image_id) DO UPDATE SET
+        path = excluded.path, prompt = excluded.prompt, style = excluded.style, size = excluded.size,
+        username = excluded.username, telegram_id = excluded.telegram_id, bytes = excluded.bytes,
+        seed = excluded.seed, steps = excluded.steps
+"""
+SET_FILE_ID = """
+    INSERT INTO generations (image_id, file_id) VALUES (?, ?)
+    ON CONFLICT (image_id) DO UPDATE SET file_id = excluded.file_id
+"""
+SET_ORIGINAL_FILE_ID = "UPDATE generations SET original_file_id = ? WHERE image_id = ?"
+SET_SERVED = "UPDATE generations SET last_served_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE image_id = ?"
+SET_PRICE = "UPDATE generations SET price = ? WHERE image_id = ? AND telegram_id = ?"
+GET_GENERATION = "SELECT * FROM generations WHERE image_id = ?"
+ADD_DRAFT = """
+    INSERT OR REPLACE INTO drafts (image_id, prompt, style, size, telegram_id, seed, steps)
+    VALUES (:image_id, :prompt, :style, :size, :telegram_id, :seed, :steps)
+"""
+GET_DRAFT = "SELECT * FROM drafts WHERE image_id = ?"
+RECENT_FILE_IDS = "SELECT image_id, file_id FROM generations WHERE file_id IS NOT NULL ORDER BY created_at DESC LIMIT ?"
+LOAD_STATE = "SELECT key, data, replica, updated_at FROM persistence WHERE kind = ?"
+GET_STATE = "SELECT data, replica, updated_at FROM persistence WHERE kind = ? AND key = ?"
+SAVE_STATE = """
+    INSERT INTO persistence (kind, key, data, replica, updated_at) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (kind, key) DO UPDATE SET
+        data = excluded.data, replica = excluded.replica, updated_at = excluded.updated_at
+"""
+DELETE_STATE = "DELETE FROM persistence WHERE kind = ? AND key = ?"
+STORED_BYTES = "SELECT COALESCE(SUM(bytes), 0) FROM generations WHERE path IS NOT NULL"
+SERVED_GENERATIONS = """
+    SELECT image_id, path, bytes, COALESCE(last_served_at, created_at) FROM generations
+    WHERE path IS NOT NULL ORDER BY COALESCE(last_served_at, created_at)
+"""
+MISSING_BYTES = "SELECT image_id, path FROM generations WHERE path IS NOT NULL AND bytes IS NULL LIMIT ?"
+SET_BYTES = "UPDATE generations SET bytes = ? WHERE image_id = ?"
+# Only clears the path it was asked to, so an image saved again meanwhile keeps its file
+EVICT_GENERATION = "UPDATE generations SET path = NULL WHERE image_id = ? AND path = ?"
+# /analytics reads only the rollups, the day leads their primary key
+ROLLUP_DAYS = "SELECT day, SUM(images), SUM(priced), SUM(steps) FROM generation_rollup WHERE day >= ? GROUP BY day ORDER BY day"
+ROLLUP_USERS = """
+    SELECT r.telegram_id, u.username, SUM(r.images) FROM generation_rollup r LEFT JOIN users u ON u.telegram_id = r.telegram_id
+    WHERE r.day >= ? GROUP BY r.telegram_id HAVING SUM(r.images) > 0 ORDER BY 3 DESC LIMIT ?
+"""
+ROLLUP_STYLES = "SELECT style, SUM(images) FROM generation_rollup WHERE day >= ? GROUP BY style HAVING SUM(images) > 0 ORDER BY 2 DESC LIMIT ?"
+ROLLUP_SIZES = "SELECT size, SUM(images) FROM generation_rollup WHERE day >= ? GROUP BY size HAVING SUM(images) > 0 ORDER BY 2 DESC LIMIT ?"
+PRICE_DISTRIBUTION = "SELECT bucket, images, total FROM price_rollup WHERE images > 0 ORDER BY bucket"
+# Exports, oldest first; the generations one walks the created_at index instead of sorting
+EXPORTS = {
+    "users": "SELECT telegram_id, username FROM users ORDER BY id",
+    "generations": """
+        SELECT image_id, path, prompt, style, size, username, telegram_id, price, seed, steps, bytes, created_at, last_served_at
+        FROM generations WHERE prompt IS NOT NULL ORDER BY created_at
+    """,
+}
+GET_USAGE = "SELECT telegram_id, images FROM usage WHERE day = ?"
+GET_USER_USAGE = "SELECT images FROM usage WHERE telegram_id = ? AND day = ?"
+# Counts are added, not set, so replicas sharing the database don't overwrite each other's counts
+ADD_USAGE = """
+    INSERT INTO usage (telegram_id, day, images) VALUES (:telegram_id, :day, MAX(:images, 0))
+    ON CONFLICT (telegram_id, day) DO UPDATE SET images = MAX(images + :images, 0)
+"""
+
+
+def connect(path=DB_FILE):
+    """
+    Opens a connection configured the way the bot uses SQLite: WAL journaling, so readers
+    (e.g. the gallery builder) never block the writer, and manual transaction control.
+    """
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA busy_timeout=5000")  # first, switching to WAL waits for other processes too
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, one fsync per checkpoint instead of per commit
+    return conn
+
+
+def _apply(conn, statement):
+    try:
+        conn.execute(statement)
+    except sqlite3.OperationalError as e:
+        # Left by a migration that ran twice before migrate() took the write lock, the column is there already
+        if "duplicate column name" not in str(e):
+            raise
+
+
+def migrate(conn):
+    """
+    Applies every migration newer than the database's user_version, each in its own transaction.
+    Safe when several processes start at once: each step takes the write lock first (BEGIN IMMEDIATE)
+    and re-reads user_version inside it, so a step another process applied meanwhile is skipped.
+    """
+    while conn.execute("PRAGMA user_version").fetchone()[0] < len(MIGRATIONS):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(MIGRATIONS):
+                for statement in MIGRATIONS[version]:
+                    _apply(conn, statement)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if version < len(MIGRATIONS):
+            logging.info(f"Database migrated to version {version + 1}")
+
+
+def query_generations(conn, telegram_id=None, username=None, style=None, min_price=None, for_sale=None, limit=None, offset=0, newest_first=True):
+    """
+    Returns generation rows (sqlite3.Row) matching the filters. Every filter is backed by an index.
+    Shared by the bot and generate_html.py.
+    """
+    clauses = []
+    params = []
+    if telegram_id is not None:
+        clauses.append("telegram_id = ?")
+        params.append(telegram_id)
+    if username is not None:
+        clauses.append("username = ?")
+        params.append(username)
+    if style is not None:
+        clauses.append("style = ?")
+        params.append(style)
+    if min_price is not None:
+        clauses.append("price >= ?")
+        params.append(min_price)
+    if for_sale is not None:
+        clauses.append("price IS NOT NULL" if for_sale else "price IS NULL")
+    sql = "SELECT * FROM generations WHERE path IS NOT NULL"
+    if clauses:
+        sql += " AND " + " AND ".join(clauses)
+    sql += " ORDER BY created_at DESC" if newest_first else " ORDER BY created_at"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+    cursor = conn.execute(sql, params)
+    cursor.row_factory = sqlite3.Row
+    return cursor.fetchall()
+
+
+def get_generation(conn, image_id):
+    cursor = conn.execute(GET_GENERATION, (image_id,))
+    cursor.row_factory = sqlite3.Row
+    return cursor.fetchone()
+
+
+def export_rows(conn, table, fmt, out, chunk_size=1000):
+    """
+    Writes every row of `table` ("users" or "generations") to the text stream `out` as CSV with a header
+    line, or as JSON lines. Rows are fetched `chunk_size` at a time, so memory use doesn't grow with the table.
+    Returns the number of rows written.
+    """
+    cursor = conn.execute(EXPORTS[table])
+    columns = [column[0] for column in cursor.description]
+    writer = csv.writer(out) if fmt == "csv" else None
+    if writer is not None:
+        writer.writerow(columns)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if writer is not None:
+            writer.writerows(rows)
+        else:
+            out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+        count += len(rows)
+    return count
+
+
+def analytics(conn, since, top=5):
+    """
+    Reads the rollups: images, priced images and steps per day from `since` (YYYY-MM-DD), the `top` users,
+    styles and sizes over the same days, and the price distribution over all time.
+    """
+    return {
+        "days": conn.execute(ROLLUP_DAYS, (since,)).fetchall(),
+        "users": conn.execute(ROLLUP_USERS, (since, top)).fetchall(),
+        "styles": conn.execute(ROLLUP_STYLES, (since, top)).fetchall(),
+        "sizes": conn.execute(ROLLUP_SIZES, (since, top)).fetchall(),
+        "prices": conn.execute(PRICE_DISTRIBUTION).fetchall(),
+    }
+
+
+def get_draft(conn, image_id):
+    cursor = conn.execute(GET_DRAFT, (image_id,))
+    cursor.row_factory = sqlite3.Row
+    return cursor.fetchone()
+
+
+def parse_sidecar(metadata_file):
+    """
+    Reads an old `Prompt:/Style:/Size:/User:/Price:` text file into a dict of generation columns.
+    When a file has several Price lines the last one wins (handle_price used to append them).
+    """
+    record = {}
+    with open(metadata_file, "r", encoding="utf-8") as f:
+        for line in f:
+            key, separator, value = line.partition(":")
+            if not separator:
+                continue
+            value = value.strip()
+            if key == "Prompt":
+                record["prompt"] = value
+            elif key == "Style":
+                record["style"] = value
+            elif key == "Size":
+                record["size"] = value
+            elif key == "User":
+                record["username"] = value
+            elif key == "Telegram ID":
+                record["telegram_id"] = int(value) if value.lstrip("-").isdigit() else None
+            elif key == "Full User":
+                record["full_user"] = value
+            elif key == "Price":
+                try:
+                    record["price"] = None if value.lower() == "no" else float(value.replace("$", ""))
+                except ValueError:
+                    record["price"] = None
+    return record
+
+
+def import_sidecars(conn, image_folder):
+    """
+    One-shot importer: loads every image's .txt metadata file (and file_ids.json, if present) into
+    the generations table. Images already in the table are left alone, so running it twice is safe.
+    Returns the number of rows imported.
+    """
+    file_ids = {}
+    file_ids_path = os.path.join(image_folder, "file_ids.json")
+    if os.path.exists(file_ids_path):
+        with open(file_ids_path, "r", encoding="utf-8") as f:
+            file_ids = {name.rsplit(".", 1)[0]: file_id for name, file_id in json.load(f).items()}
+
+    imported = 0
+    conn.execute("BEGIN")
+    try:
+        for entry in os.scandir(image_folder):
+            if not entry.name.endswith(".png"):
+                continue
+            image_id = entry.name[:-len(".png")]
+            metadata_file = os.path.join(image_folder, image_id + ".txt")
+            record = parse_sidecar(metadata_file) if os.path.exists(metadata_file) else {}
+            created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(entry.stat().st_mtime))
+            cursor = conn.execute(
+                """
+                INSERT OR IGNORE INTO generations
+                    (image_id, path, prompt, style, size, username, telegram_id, full_user, price, file_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    image_id, f"image/{entry.name}", record.get("prompt"), record.get("style"), record.get("size"),
+                    record.get("username"), record.get("telegram_id"), record.get("full_user"), record.get("price"),
+                    file_ids.get(image_id), created_at,
+                ),
+            )
+            imported += cursor.rowcount
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return imported
+
+
+class Database:
+    """
+    The bot's data-access layer. One long-lived connection is owned by a dedicated thread, so no
+    SQLite call ever runs on the event loop. Writes that arrive together are committed in one
+    transaction (one commit for a whole burst of /start calls), each isolated in a savepoint so a
+    failing write doesn't take the rest of the batch with it.
+    """
+    def __init__(self, path=DB_FILE, batch_size=200):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+        self._migrate = True
+        self._background = set()
+        self.commits = 0
+        self.writes = 0
+        # Called on the database thread as on_batch(seconds, ok) after every write transaction, used for metrics
+        self.on_batch = None
+
+    def open(self, migrate=True):
+        """
+        Starts the database thread, which connects and runs migrations (unless `migrate` is False,
+        for processes whose parent already ran them). Blocks until it is ready.
+        """
+        if self._thread is not None:
+            return
+        self._migrate = migrate
+        self._thread = threading.Thread(target=self._run, name="database", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._thread = None
+            raise self._error
+
+    def _run(self):
+        try:
+            conn = connect(self.path)
+            if self._migrate:
+                migrate(conn)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                # Take whatever else is already waiting, without delaying the first item
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._queue.put(None)  # finish this batch, then stop
+                        break
+                    batch.append(item)
+                self._execute_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _execute_batch(self, conn, batch):
+        results = []
+        writes = [entry for entry in batch if entry[1]]
+        started = time.perf_counter()
+        if writes:
+            conn.execute("BEGIN")
+        for fn, write, future, loop in batch:
+            try:
+                if write:
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        result = fn(conn)
+                        conn.execute("RELEASE op")
+                    except Exception:
+                        conn.execute("ROLLBACK TO op")
+                        conn.execute("RELEASE op")
+                        raise
+                else:
+                    result = fn(conn)
+                results.append((future, loop, result, None))
+            except Exception as e:
+                results.append((future, loop, None, e))
+        if writes:
+            try:
+                conn.execute("COMMIT")
+                self.commits += 1
+                self.writes += len(writes)
+                ok = True
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK")
+                results = [(future, loop, None, e) for future, loop, _, _ in results]
+                ok = False
+            if self.on_batch is not None:
+                self.on_batch(time.perf_counter() - started, ok)
+        # Hand results back to the event loop only after the commit, so awaiting a write means it is durable
+        for future, loop, result, error in results:
+            loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def run(self, fn, write=False):
+        """
+        Runs `fn(conn)` on the database thread and returns its result.
+        """
+        if self._thread is None:
+            raise RuntimeError("Database is not open")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, write, future, loop))
+        return await future
+
+    async def execute(self, sql, params=()):
+        """
+        Runs one write statement. Returns the number of changed rows.
+        """
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount, write=True)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def save_user(self, telegram_id, username):
+        """
+        Saves a user's Telegram ID and username to the database.
+        If the user already exists, it ignores the duplicate entry.
+        """
+        return await self.execute(SAVE_USER, (telegram_id, username))
+
+    async def get_user(self, telegram_id):
+        return await self.fetchone(GET_USER, (telegram_id,))
+
+    async def count_users(self):
+        return (await self.fetchone(COUNT_USERS))[0]
+
+    async def add_generation(self, image_id, path, prompt, style, size, username, telegram_id, nbytes=None, seed=None, steps=None):
+        """
+        Records the metadata of a newly generated image (not for sale until a price is set).
+        `nbytes` is the size of the stored file, counted against the storage budget.
+        """
+        return await self.execute(ADD_GENERATION, {
+            "image_id": image_id, "path": path, "prompt": prompt, "style": style, "size": size,
+            "username": username, "telegram_id": telegram_id, "bytes": nbytes, "seed": seed, "steps": steps,
+        })
+
+    async def add_draft(self, image_id, prompt, style, size, telegram_id, seed, steps):
+        """
+        Records a draft's settings and seed, what its Refine button renders again at full quality.
+        """
+        return await self.execute(ADD_DRAFT, {
+            "image_id": image_id, "prompt": prompt, "style": style, "size": size,
+            "telegram_id": telegram_id, "seed": seed, "steps": steps,
+        })
+
+    async def get_draft(self, image_id):
+        return await self.run(lambda conn: get_draft(conn, image_id))
+
+    async def set_file_id(self, image_id, file_id):
+        return await self.execute(SET_FILE_ID, (image_id, file_id))
+
+    async def set_original_file_id(self, image_id, file_id):
+        return await self.execute(SET_ORIGINAL_FILE_ID, (image_id, file_id))
+
+    async def set_served(self, image_ids):
+        """
+        Marks the images as sent to a user just now.
+        """
+        return await self.run(lambda conn: conn.executemany(SET_SERVED, [(image_id,) for image_id in image_ids]).rowcount, write=True)
+
+    async def set_price(self, image_ids, telegram_id, price):
+        """
+        Sets the price of the given images, only where they belong to `telegram_id`. Returns how many were updated.
+        """
+        def update(conn):
+            return sum(conn.execute(SET_PRICE, (price, image_id, telegram_id)).rowcount for image_id in image_ids)
+        return await self.run(update, write=True)
+
+    async def get_generation(self, image_id):
+        return await self.run(lambda conn: get_generation(conn, image_id))
+
+    async def find_generations(self, **filters):
+        """
+        Async version of query_generations, see there for the filters.
+        """
+        return await self.run(lambda conn: query_generations(conn, **filters))
+
+    async def analytics(self, since, top=5):
+        """
+        Async version of analytics, see there.
+        """
+        return await self.run(lambda conn: analytics(conn, since, top))
+
+    async def export(self, table, fmt, out):
+        """
+        Streams `table` into the text stream `out`, see export_rows. Runs on a connection of its own in a worker thread:
+        a long export reads a WAL snapshot there instead of holding up the writes queued for the database thread.
+        """
+        def dump():
+            conn = connect(self.path)
+            try:
+                return export_rows(conn, table, fmt, out)
+            finally:
+                conn.close()
+        return await asyncio.to_thread(dump)
+
+    async def file_ids(self, limit):
+        """
+        Returns (image_id, file_id) pairs for the `limit` most recent uploaded images, newest first.
+        """
+        return await self.fetchall(RECENT_FILE_IDS, (limit,))
+
+    async def usage(self, day):
+        """
+        Returns (telegram_id, images) pairs for everyone who generated images on `day` (YYYY-MM-DD).
+        """
+        return await self.fetchall(GET_USAGE, (day,))
+
+    async def add_usage(self, day, counts):
+        """
+        Adds `counts` ({telegram_id: images}) to the day's usage in one transaction and returns the new totals.
+        """
+        def add(conn):
+            totals = {}
+            for telegram_id, images in counts.items():
+                conn.execute(ADD_USAGE, {"telegram_id": telegram_id, "day": day, "images": images})
+                totals[telegram_id] = conn.execute(GET_USER_USAGE, (telegram_id, day)).fetchone()[0]
+            return totals
+        return await self.run(add, write=True)
+
+    def close(self):
+        """
+        Lets the database thread finish queued work, then closes the connection.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def write_behind(self, write, what):
+        """
+        Runs the coroutine `write` (one of the writes above) in the background, for callers that shouldn't wait for it.
+        It still goes through the batched writer; a failure is logged as "Could not {what}".
+        """
+        task = asyncio.create_task(write)
+        self._background.add(task)
+        task.add_done_callback(lambda task: self._written(task, what))
+
+    def _written(self, task, what):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Could not {what}: {task.exception()}")
+
+    async def flush(self):
+        """
+        Waits for the background writes started so far.
+        """
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    async def aclose(self):
+        await self.flush()
+        await asyncio.to_thread(self.close)
+
+
+database = Database()
+
+
+# One-shot import of the old .txt metadata files:  python database.py import image
+# Export a table:  python database.py export generations --format jsonl > generations.jsonl
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bot database maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    import_parser = subcommands.add_parser("import", help="import .txt metadata files into the generations table")
+    import_parser.add_argument("folder", nargs="?", default="image")
+    export_parser = subcommands.add_parser("export", help="write a table to stdout as CSV or JSON lines")
+    export_parser.add_argument("table", choices=sorted(EXPORTS))
+    export_parser.add_argument("--format", default="csv", choices=["csv", "jsonl"])
+    args = parser.parse_args()
+
+    conn = connect(DB_FILE)
+    migrate(conn)
+    if args.command == "import":
+        count = import_sidecars(conn, args.folder)
+        print(f"Imported {count} generations from {args.folder} into {DB_FILE}")
+    else:
+        count = export_rows(conn, args.table, args.format, sys.stdout)
+        print(f"Exported {count} {args.table}", file=sys.stderr)
+    conn.close()
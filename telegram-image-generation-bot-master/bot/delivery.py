@@ -0,0 +1,238 @@
+import os
+import asyncio
+import logging
+import httpx
+from collections import OrderedDict
+from telegram import InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from database import database
+from metrics import metrics
+from helper import image_gen
+
+_DONE = object()
+
+
+class FileIdStore:
+    """
+    Remembers the Telegram `file_id` of images already uploaded, keyed by image id.
+    Ids are persisted in the generations table next to the image's metadata, lookups are served
+    from an in-memory LRU of the `max_entries` most recently used. An image that fell out of it is uploaded again.
+    """
+    def __init__(self, database, max_entries=None):
+        self.database = database
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('FILE_ID_CACHE_SIZE', '10000'))
+        self._file_ids = OrderedDict()
+
+    async def load(self):
+        """
+        Loads the file ids of the most recent images from the database. Called once when the bot starts.
+        """
+        self._file_ids = OrderedDict(reversed(await self.database.file_ids(self.max_entries)))
+
+    def get(self, image_id):
+        file_id = self._file_ids.get(image_id)
+        if file_id is not None:
+            self._file_ids.move_to_end(image_id)
+        return file_id
+
+    def set(self, image_id, file_id):
+        self._file_ids[image_id] = file_id
+        self._file_ids.move_to_end(image_id)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+        self.database.write_behind(self.database.set_file_id(image_id, file_id), "save file id")
+
+    async def recent(self, limit):
+        """
+        Returns up to `limit` (image_id, file_id) pairs of the newest images, newest first.
+        """
+        return await self.database.file_ids(limit)
+
+
+class Delivery:
+    """
+    Sends generated images to a chat. Images Telegram has seen before go out by `file_id`,
+    new ones are uploaded and their `file_id` is recorded. Several images are sent as one media group.
+    Images with a preview are sent as the small lossy preview, with a button that sends the PNG as a document.
+    Drafts get a button that renders them again at full quality instead.
+    """
+    MAX_GROUP = 10  # Telegram's media group limit
+    ORIGINAL = "original:"  # callback data prefix of the "Download original" buttons
+    REFINE = "refine:"  # callback data prefix of the "Refine" buttons under drafts
+
+    def __init__(self, file_ids=None, group_window=None, storage=None):
+        self.file_ids = file_ids or FileIdStore(database)
+        self.storage = storage or image_gen.storage  # where the originals are read from
+        # How long to wait for the rest of a batch after its first image is ready
+        self.group_window = group_window if group_window is not None else float(os.getenv('DELIVERY_GROUP_WINDOW', '0.5'))
+
+    def _media(self, image):
+        """
+        Returns what to send as the photo: the known file_id, else the preview, else the PNG. And its filename.
+        """
+        file_id = self.file_ids.get(image.image_id)
+        if file_id is not None:
+            return file_id, None
+        if image.preview is not None:
+            return image.preview, image.preview_filename
+        return image.data, image.filename
+
+    def original_button(self, image, label="Download original"):
+        return InlineKeyboardButton(label, callback_data=f"{self.ORIGINAL}{image.image_id}")
+
+    def refine_button(self, image, label="Refine"):
+        return InlineKeyboardButton(label, callback_data=f"{self.REFINE}{image.image_id}")
+
+    async def send_images(self, bot, chat_id, images, draft=False):
+        """
+        Sends `images` (GeneratedImage objects) as one photo or one media group and records new file ids.
+        With `draft`, the buttons under the images refine them rather than download originals (drafts aren't stored).
+        """
+        if draft:
+            with_buttons = images
+            button, label, text = self.refine_button, "Refine {}", "Pick one to render at full quality:"
+        else:
+            with_buttons = [image for image in images if image.preview is not None]
+            button, label, text = self.original_button, "Original {}", "Download the lossless originals:"
+        if len(images) == 1:
+            image = images[0]
+            photo, filename = self._media(image)
+            # A single photo can carry the button itself
+            reply_markup = InlineKeyboardMarkup([[button(image)]]) if with_buttons else None
+            with metrics.timer("send"):
+                message = await bot.send_photo(chat_id, photo=photo, filename=filename, reply_markup=reply_markup)
+            if not draft:
+                self._record([image], [message])
+                self.storage.served([image.image_id])
+            return
+        for start in range(0, len(images), self.MAX_GROUP):
+            chunk = images[start:start + self.MAX_GROUP]
+            media = []
+            for image in chunk:
+                photo, filename = self._media(image)
+                media.append(InputMediaPhoto(photo, filename=filename))
+            with metrics.timer("send"):
+                messages = await bot.send_media_group(chat_id, media=media)
+            if not draft:  # drafts are never sent again, /gallery shouldn't show them either
+                self._record(chunk, messages)
+        if not draft:
+            self.storage.served([image.image_id for image in images])
+        if with_buttons:
+            # Media groups can't have buttons, so they follow in one message, numbered like the photos
+            buttons = [button(image, label.format(number)) for number, image in enumerate(images, start=1) if image in with_buttons]
+            try:
+                await bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup([buttons[row:row + 5] for row in range(0, len(buttons), 5)]))
+            except Exception as e:
+                # The photos are out, losing their buttons doesn't make them unsent
+                logging.error(f"Could not send the buttons: {e}")
+
+    async def send_original(self, bot, chat_id, image_id):
+        """
+        Sends the lossless PNG of `image_id` as a document, by file_id when it was sent before.
+        Returns False when the image is unknown or was evicted from storage.
+        """
+        generation = await self.file_ids.database.get_generation(image_id)
+        if generation is None:
+            return False
+        if generation["original_file_id"]:
+            await bot.send_document(chat_id, document=generation["original_file_id"])
+            self.storage.served([image_id])
+            return True
+        path = generation["path"]
+        data = await self.storage.read(path) if path else None
+        if data is None:
+            return False
+        with metrics.timer("send"):
+            message = await bot.send_document(chat_id, document=data, filename=path.rsplit("/", 1)[-1])
+        self.storage.served([image_id])
+        if message.document:
+            try:
+                await self.file_ids.database.set_original_file_id(image_id, message.document.file_id)
+            except Exception as e:
+                logging.error(f"Could not save file id: {e}")
+        return True
+
+    async def upload_document(self, bot, chat_id, file, filename, mime_type, caption=None):
+        """
+        Uploads the open binary `file` as a document, read from disk in chunks while it is sent:
+        python-telegram-bot would read the whole file into memory first.
+        """
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60)) as client:
+            response = await client.post(
+                f"{bot.base_url}/sendDocument",
+                data={"chat_id": str(chat_id), **({"caption": caption} if caption else {})},
+                files={"document": (filename, file, mime_type)},
+            )
+        try:
+            answer = response.json()
+        except ValueError:
+            answer = {}
+        if not answer.get("ok"):
+            raise TelegramError(answer.get("description") or f"sendDocument failed with HTTP {response.status_code}")
+
+    async def send_file_ids(self, bot, chat_id, file_ids):
+        """
+        Re-sends already uploaded images by `file_id` only, nothing is uploaded.
+        """
+        if len(file_ids) == 1:
+            await bot.send_photo(chat_id, photo=file_ids[0])
+            return
+        for start in range(0, len(file_ids), self.MAX_GROUP):
+            await bot.send_media_group(chat_id, media=[InputMediaPhoto(file_id) for file_id in file_ids[start:start + self.MAX_GROUP]])
+
+    def _record(self, images, messages):
+        for image, message in zip(images, messages):
+            if message.photo and self.file_ids.get(image.image_id) is None:
+                self.file_ids.set(image.image_id, message.photo[-1].file_id)
+
+    async def send_as_ready(self, bot, chat_id, images, draft=False):
+        """
+        Sends images from the async iterable `images` as they finish. Images that finish within
+        `group_window` of each other go out together as one media group. `draft` is passed on to send_images.
+        A batch Telegram refuses doesn't stop the rest. Returns (images sent, images that could not be sent).
+        """
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for image in images:
+                    await queue.put(image)
+            finally:
+                await queue.put(_DONE)
+
+        pump_task = asyncio.create_task(pump())
+        sent = []
+        unsent = []
+        done = False
+        try:
+            while not done:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                batch = [item]
+                deadline = asyncio.get_running_loop().time() + self.group_window
+                while len(batch) < self.MAX_GROUP:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    batch.append(item)
+                try:
+                    await self.send_images(bot, chat_id, batch, draft=draft)
+                except Exception as e:  # counted as a send error by the timer in send_images
+                    logging.error(f"Could not send {len(batch)} image(s): {e}")
+                    unsent.extend(batch)
+                    continue
+                sent.extend(batch)
+        finally:
+            pump_task.cancel()
+        return sent, unsent
+
+
+delivery = Delivery()
@@ -1,22 +1,222 @@
 import os
-import base64
-import requests
-from PIL import Image, ImageEnhance
-from dotenv import load_dotenv
+import time
+import random
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import httpx
+from dotenv import load_dotenv, dotenv_values
+from cache import ResultCache
+from resilience import ResilientCaller
+from metrics import metrics
+from database import database
+from storage import ImageStore
+from postprocess import Watermark, PostProcessPool, process_response, content_digest, default_workers
 
 # Load environment variables from .env file
 load_dotenv('.env')
 
+class RateLimiter:
+    """
+    Per-user token buckets: each user gets `burst` requests, refilled at `per_minute` requests per minute.
+    Buckets live in memory only, a restart simply gives everyone a full bucket.
+    """
+    def __init__(self, per_minute=None, burst=None):
+        self.per_minute = per_minute if per_minute is not None else float(os.getenv('RATE_LIMIT_PER_MINUTE', '6'))
+        self.burst = burst if burst is not None else float(os.getenv('RATE_LIMIT_BURST', str(self.per_minute)))
+        self._buckets = {}  # user_id -> [tokens, last refill time]
+
+    def allow(self, user_id, cost=1):
+        """
+        Takes `cost` tokens from the user's bucket. Returns 0 when allowed, otherwise the seconds until it would be.
+        """
+        if self.per_minute <= 0:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_minute / 60.0)
+        bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0
+        return (cost - bucket[0]) * 60.0 / self.per_minute
+
+    def prune(self):
+        """
+        Drops buckets that have refilled completely, they are the same as no bucket at all.
+        """
+        now = time.monotonic()
+        full_after = self.burst * 60.0 / self.per_minute if self.per_minute > 0 else 0
+        for user_id in [user_id for user_id, (_, last) in self._buckets.items() if now - last >= full_after]:
+            del self._buckets[user_id]
+
+
+class DailyQuota:
+    """
+    Counts the images each user generated today (UTC) against a daily limit.
+    Counts are kept in memory and flushed to the `usage` table every `flush_interval` seconds
+    as increments, so replicas sharing the database add up their counts instead of overwriting them.
+    """
+    def __init__(self, database, limit=None, flush_interval=None):
+        self.database = database
+        self.limit = limit if limit is not None else int(os.getenv('DAILY_IMAGE_QUOTA', '20'))
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv('QUOTA_FLUSH_INTERVAL', '30'))
+        self.day = self._today()
+        self._used = {}  # user_id -> images used today, as last known
+        self._pending = {}  # user_id -> images not flushed yet
+        self._stale = None  # (day, pending) left over when the day rolled over before a flush
+        self._task = None
+
+    @staticmethod
+    def _today():
+        return time.strftime('%Y-%m-%d', time.gmtime())
+
+    def _roll_over(self):
+        today = self._today()
+        if today != self.day:
+            # Yesterday's pending counts still belong to yesterday
+            self._stale = (self.day, self._pending)
+            self.day = today
+            self._used = {}
+            self._pending = {}
+
+    def remaining(self, user_id):
+        if self.limit <= 0:
+            return None
+        self._roll_over()
+        return max(self.limit - self._used.get(user_id, 0), 0)
+
+    def reserve(self, user_id, count):
+        """
+        Counts `count` images against the user's quota. Returns False (and counts nothing) when it would exceed it.
+        """
+        remaining = self.remaining(user_id)
+        if remaining is not None and count > remaining:
+            return False
+        self._used[user_id] = self._used.get(user_id, 0) + count
+        self._pending[user_id] = self._pending.get(user_id, 0) + count
+        return True
+
+    def refund(self, user_id, count):
+        """
+        Gives back images that were reserved but not delivered.
+        """
+        if count <= 0:
+            return
+        self._used[user_id] = max(self._used.get(user_id, 0) - count, 0)
+        self._pending[user_id] = self._pending.get(user_id, 0) - count
+
+    async def load(self):
+        """
+        Loads today's counts from the database. Called once when the bot starts.
+        """
+        self._used = dict(await self.database.usage(self.day))
+
+    async def flush(self):
+        """
+        Adds the pending counts to the database and picks up the totals other replicas added meanwhile.
+        """
+        self._roll_over()
+        batches = []
+        if self._stale is not None:
+            batches.append(self._stale)
+            self._stale = None
+        pending, self._pending = {user_id: count for user_id, count in self._pending.items() if count}, {}
+        batches.append((self.day, pending))
+        for day, counts in batches:
+            if not counts:
+                continue
+            try:
+                totals = await self.database.add_usage(day, counts)
+            except Exception:
+                # Keep the counts for the next flush
+                for user_id, count in counts.items():
+                    if day == self.day:
+                        self._pending[user_id] = self._pending.get(user_id, 0) + count
+                raise
+            if day == self.day:
+                for user_id, total in totals.items():
+                    self._used[user_id] = total + self._pending.get(user_id, 0)
+
+    def start(self, on_tick=None):
+        """
+        Starts flushing in the background. `on_tick` is called after every flush (used to prune rate limiter buckets).
+        """
+        async def flush_forever():
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Could not flush usage counts: {e}")
+                if on_tick is not None:
+                    on_tick()
+        if self._task is None:
+            self._task = asyncio.create_task(flush_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
 class Helper:
-    def __init__(self):
-        self.allowed_users = os.getenv('USER_ID').split(',')
-        self.allowed_admins = os.getenv('ADMIN_ID').split(',')
+    """
+    Access control: who may use the bot (USER_ID / ADMIN_ID, re-read from .env when it changes),
+    how fast they may send requests and how many images they may generate per day. Admins are exempt from the limits.
+    """
+    RELOAD_CHECK_INTERVAL = 5  # seconds between checks of the .env file's mtime
+
+    def __init__(self, env_file='.env'):
+        self.env_file = env_file
+        self.allowed_users = set()
+        self.allowed_admins = set()
+        self._env_mtime = None
+        self._next_check = 0
+        # Without a .env file the ids come from the environment (docker, systemd...), which can't change while we run
+        self._from_environment = not os.path.exists(env_file)
+        self.reload()
+        self.rate_limiter = RateLimiter()
+        self.quota = DailyQuota(database)
+
+    def reload(self):
+        """
+        Re-reads USER_ID and ADMIN_ID. The .env file is authoritative: a key that is missing or empty there
+        leaves nobody allowed. The environment is only read when the bot was started without a .env file,
+        otherwise it still holds what load_dotenv copied from the file at startup and access could never be revoked.
+        """
+        if os.path.exists(self.env_file):
+            self._env_mtime = os.path.getmtime(self.env_file)
+            values = dotenv_values(self.env_file)
+        else:
+            self._env_mtime = None
+            values = os.environ if self._from_environment else {}
+        users = values.get('USER_ID') or ''
+        admins = values.get('ADMIN_ID') or ''
+        # Sets, so a lookup costs the same with 10 or 10,000 allowed ids
+        self.allowed_users = {user.strip() for user in users.split(',') if user.strip()}
+        self.allowed_admins = {admin.strip() for admin in admins.split(',') if admin.strip()}
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.RELOAD_CHECK_INTERVAL
+        try:
+            mtime = os.path.getmtime(self.env_file)
+        except OSError:
+            mtime = None
+        if mtime != self._env_mtime:
+            self.reload()
 
     def is_user(self, user_id):
         """
         Check if a user is authorized (based on user ID).
         Returns True if the user ID is in the allowed list or if '*' is present (wildcard for all users >:)).
         """
+        self._maybe_reload()
         return '*' in self.allowed_users or str(user_id) in self.allowed_users
 
     def is_admin(self, user_id):
@@ -24,51 +224,165 @@ class Helper:
        Check if a user has admin privileges (based on user ID).
        Returns True if the user ID is in the admin list or if '*' is present (wildcard for all admins  MUAHAHAHA).
        """
+        self._maybe_reload()
         return '*' in self.allowed_admins or str(user_id) in self.allowed_admins
 
+    def check_limits(self, user_id, count):
+        """
+        Checks a request for `count` images against the rate limit and the daily quota, and counts it when allowed.
+        Returns None when allowed, otherwise a message explaining why not.
+        """
+        if self.is_admin(user_id):
+            return None
+        remaining = self.quota.remaining(user_id)
+        if remaining is not None and count > remaining:
+            if remaining == 0:
+                return f"You have reached your daily limit of {self.quota.limit} images. It resets at midnight UTC."
+            return f"You have {remaining} image(s) left today, please ask for fewer."
+        wait = self.rate_limiter.allow(user_id)
+        if wait:
+            return f"You are sending requests too quickly, please try again in {int(wait) + 1} seconds."
+        self.quota.reserve(user_id, count)
+        return None
+
+    def refund(self, user_id, count):
+        """
+        Gives back quota for images that could not be generated.
+        """
+        if not self.is_admin(user_id):
+            self.quota.refund(user_id, count)
+
+    def start(self):
+        self.quota.start(on_tick=self.rate_limiter.prune)
+
+    async def close(self):
+        await self.quota.close()
+
+class GeneratedImage:
+    """
+    A finished (watermarked) image kept in memory as encoded PNG bytes, plus an optional
+    lossy `preview` (JPEG or WebP) that is what gets sent as the chat photo.
+    The id ends in a hash of the PNG, so two renders that happen to share a seed never share an id (or a file).
+    `steps` is the number of diffusion steps it was rendered with, fewer than usual for a draft.
+    """
+    def __init__(self, seed, data, from_cache=False, preview=None, preview_format=None, image_id=None, steps=None):
+        self.seed = seed
+        self.steps = steps
+        self.data = data
+        self.image_id = image_id or f"txt2img_{seed}_{content_digest(data)}"
+        self.filename = f"{self.image_id}.png"
+        self.from_cache = from_cache  # True when served from the ResultCache instead of a new render
+        self.preview = preview
+        self.preview_format = preview_format
+
+    @property
+    def preview_filename(self):
+        return f"{self.image_id}.{'jpg' if self.preview_format == 'jpeg' else self.preview_format}"
+
+    @property
+    def nbytes(self):
+        return len(self.data) + len(self.preview or b"")
+
+
 class ImageGen: # You  are still reading all comments?
     """
     A class for handling image generation and processing, including watermarking and API interaction.
     """
-    def add_watermark(self, input_image_path, output_image_path, watermark_image_path, transparency=25):
-        if watermark_image_path is None or not os.path.exists(watermark_image_path): #adds watermark for image
-            original_image = Image.open(input_image_path)
-            original_image.save(output_image_path)
-            return # Save the original image without changes if no watermark is provided
+    # Map size keywords to specific dimensions (height, width)
+    SIZE_MAPPING = {
+        "square-p": (1152, 896),
+        "portrait": (1216, 832),
+        "highscreen": (1344, 768),
+        "panorama-p": (1536, 640),
+        "square": (1024, 1024),
+        "panorama": (640, 1536),
+        "square-l": (896, 1152),
+        "landscape": (832, 1216),
+        "widescreen": (768, 1344),
+    }
+
+    def __init__(self):
+        """
+        Reads the Stability client settings from the environment.
+        The HTTP client itself is created lazily on the first request so it binds to the running event loop.
+        """
+        self.api_url = os.getenv(
+            'STABILITY_API_URL',
+            "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image",
+        )
+        self.connect_timeout = float(os.getenv('STABILITY_CONNECT_TIMEOUT', '10'))
+        self.read_timeout = float(os.getenv('STABILITY_READ_TIMEOUT', '120'))
+        self.max_concurrency = int(os.getenv('STABILITY_MAX_CONCURRENCY', '4'))
+        # Diffusion steps per tier: full quality, and the quick drafts of draft mode (the API accepts 10-50)
+        self.full_steps = int(os.getenv('STABILITY_STEPS', '50'))
+        self.draft_steps = int(os.getenv('DRAFT_STEPS', '15'))
+        self._client = None
+        self._pending_writes = set()
+        self.cache = ResultCache()
+        self.storage = ImageStore()  # Where finished PNGs are kept, and for how long
+        # Lossy preview sent as the chat photo, the PNG stays available as a document. "none" sends the PNG itself.
+        self.preview_format = os.getenv('PREVIEW_FORMAT', 'jpeg').lower()
+        self.preview_quality = int(os.getenv('PREVIEW_QUALITY', '85'))
+        self.watermark = Watermark('logo.png')
+        # Every output size is known up front, so prepare their logos once instead of per image
+        sizes = [(width, height) for height, width in self.SIZE_MAPPING.values()]
+        self.watermark.prewarm(sizes, transparency=25)
+        # Decode/watermark/encode in worker processes (started by start_postprocess), 0 keeps them in a thread
+        workers = default_workers()
+        self.postprocess = PostProcessPool(workers, 'logo.png', sizes, self.preview_format, self.preview_quality) if workers > 0 else None
+        # Caps how many renders are in flight at once, extra callers wait their turn
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Retries, circuit breaker and hedging around the API call
+        self.resilience = ResilientCaller(semaphore=self._semaphore)
+
+    def _get_client(self):
+        """
+        Returns the shared AsyncClient, creating it on first use.
+        Connections are kept alive between calls so each render skips the TCP/TLS handshake.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self._client
 
+    async def close(self):
+        """
+        Waits for background image saves, then closes the pooled HTTP client. Called once when the bot shuts down.
+        """
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+        await self.storage.close()
+        if self.postprocess is not None:
+            await self.postprocess.close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def add_watermark(self, original_image, transparency=25):
+        """
+        Blends the logo into the bottom left corner of `original_image` (a PIL image) and returns it.
+        Everything happens in memory, the prepared logo comes from the Watermark cache.
+        """
         try:
-            original_image = Image.open(input_image_path)
-            watermark = Image.open(watermark_image_path)
-
-            # Resize the watermark to fit the original image (14% of the smallest dimension)
-            min_dimension = min(original_image.width, original_image.height)
-            watermark_size = (int(min_dimension * 0.14), int(min_dimension * 0.14))
-            watermark = watermark.resize(watermark_size)
-
-            # Ensure the watermark image has an RGBA mode (for transparency)
-            if watermark.mode != 'RGBA':
-                watermark = watermark.convert('RGBA')
-
-            # Copy the original image to add the watermark
-            image_with_watermark = original_image.copy()
-            position = (0, original_image.size[1] - watermark.size[1]) #goes to bottom left
-            image_with_watermark.paste(watermark, position, watermark)
-            #Adjust transparency
-            alpha = watermark.split()[3] # Get the alpha channel (transparency)
-            alpha = ImageEnhance.Brightness(alpha).enhance(transparency / 100.0)
-            watermark.putalpha(alpha)
-            image_with_watermark.save(output_image_path)
+            return self.watermark.apply(original_image, transparency)
         except Exception as e:
-            # Log any errors and save the original image without changes
+            # Log any errors and keep the original image without changes
             print(f"Error adding watermark: {e}")
-            original_image.save(output_image_path)
+            return original_image
 
-    def generate_image(self, prompt, style="None", size="square"):
-        api_key = os.getenv('STABILITY_API_KEY')
+    def build_params(self, prompt, style="None", size="square", seed=None, steps=None):
+        """
+        Builds the request body for the text-to-image endpoint. `steps` defaults to the full quality tier.
+        """
         # Define the common parameters for the API request
         common_params = {
             "samples": 1,
-            "steps": 50,
+            "steps": steps or self.full_steps,
             "cfg_scale": 5.5,
             "text_prompts": [
                 {
@@ -99,59 +413,151 @@ class ImageGen: # You  are still reading all comments?
                 },
             ],
         }
-        # Map size keywords to specific dimensions
-        size_mapping = {
-            "square-p": (1152, 896),
-            "portrait": (1216, 832),
-            "highscreen": (1344, 768),
-            "panorama-p": (1536, 640),
-            "square": (1024, 1024),
-            "panorama": (640, 1536),
-            "square-l": (896, 1152),
-            "landscape": (832, 1216),
-            "widescreen": (768, 1344),
-        }
         # Assign dimensions based on the provided size
-        if size in size_mapping:
-            common_params["height"], common_params["width"] = size_mapping[size]
+        if size in self.SIZE_MAPPING:
+            common_params["height"], common_params["width"] = self.SIZE_MAPPING[size]
             # Add style preset if a style is specified
         if style != "None":
             common_params["style_preset"] = style
-        body = common_params.copy()
+        # Pin the seed when one is given, otherwise the API picks a random one
+        if seed is not None:
+            common_params["seed"] = seed
+        return common_params
 
+    async def start_postprocess(self):
+        """
+        Starts the post-processing worker processes. Until then (or if they can't start) images are processed in a thread.
+        """
+        if self.postprocess is None:
+            return
         try:
-            # Send a POST request to the Stability AI API
-            response = requests.post(
-                "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image",
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {api_key}",
-                },
-                json=body,
-            )
-            # Check for non-200 responses
-            if response.status_code != 200:
-                raise Exception("Non-200 response: " + str(response.text))
-            # Parse the response and save the generated image
-            data = response.json()
-            output_directory = "./image"
-            if not os.path.exists(output_directory):
-                os.makedirs(output_directory)
-            generated_image_path = f'{output_directory}/txt2img_{data["artifacts"][0]["seed"]}.png'
-            with open(generated_image_path, "wb") as f:
-                f.write(base64.b64decode(data["artifacts"][0]["base64"]))
-
-            # Apply a watermark to the generated image the logo one in update 2.0.1 aka biggest update
-            watermark_image_path = 'logo.png'
-            output_with_watermark_path = generated_image_path
-            self.add_watermark(generated_image_path, output_with_watermark_path, watermark_image_path, transparency=25)
-            # Return the path to the final image
-            return generated_image_path
+            await self.postprocess.start()
+        except Exception as e:
+            print(f"Could not start post-processing workers, processing in a thread instead: {e}")
+            self.postprocess = None
+
+    def available(self):
+        """
+        False while the circuit breaker is open, i.e. the API has been failing and calls are refused.
+        """
+        return not self.resilience.breaker.is_open
+
+    async def generate_image(self, prompt, style="None", size="square", seed=None, steps=None):
+        api_key = os.getenv('STABILITY_API_KEY')
+        body = self.build_params(prompt, style, size, seed, steps)
+
+        async def send():
+            # Send a POST request to the Stability AI API without blocking the event loop
+            started = time.perf_counter()
+            try:
+                response = await self._get_client().post(
+                    self.api_url,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Accept": "application/json",
+                        "Authorization": f"Bearer {api_key}",
+                    },
+                    json=body,
+                )
+            except httpx.TransportError:
+                metrics.error("api")
+                raise
+            if response.status_code == 200:
+                metrics.observe("api", time.perf_counter() - started)
+            else:
+                metrics.error("api")
+            return response
+
+        try:
+            # Retried on 429/5xx and network errors, refused right away while the circuit is open
+            response = await self.resilience.call(send)
+            generated_image = await self.finish(response.content)
+            generated_image.steps = body["steps"]
+            return generated_image
         except Exception as e:
             # Log errors and return None in case of failure
             print(f"Error in generate_image: {e}")
             return None
 
+    async def generate_images(self, prompt, style="None", size="square", count=1, submit=None, use_cache=True, seed=None, draft=False, owner=None):
+        """
+        Generates `count` images concurrently and yields each GeneratedImage as soon as its render finishes.
+        A failed render yields None instead of aborting the others, so the caller can report it per image.
+        `submit`, if given, is awaited with each render's coroutine factory (e.g. to run it through the scheduler).
+        Images `owner` (a telegram id) got before are served from the result cache without calling the API,
+        unless `use_cache` is False.
+        `seed` pins the seed (e.g. to refine a draft). Drafts are rendered with `draft_steps` and seeds chosen
+        here, so any of them can be rendered again at full quality; they are never cached.
+        """
+        steps = self.draft_steps if draft else self.full_steps
+
+        async def render(variant):
+            render_seed = random.randrange(2 ** 32) if draft else seed
+            key = self.cache.key(self.build_params(prompt, style, size, render_seed, steps), variant, owner)
+            if use_cache and not draft:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+            job_factory = lambda: self.generate_image(prompt, style, size, render_seed, steps)
+            try:
+                generated_image = await (submit(job_factory) if submit is not None else job_factory())
+            except Exception as e:
+                print(f"Error in generate_images: {e}")
+                return None
+            if generated_image is not None and not draft:
+                self.cache.put(key, generated_image)
+            return generated_image
+
+        tasks = [asyncio.create_task(render(variant)) for variant in range(count)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            # If the caller stops early (e.g. the chat went away) don't leave renders running
+            for task in tasks:
+                task.cancel()
+
+    async def finish(self, body):
+        """
+        Turns an API response body into a GeneratedImage: parse, decode, watermark, encode the PNG and the preview.
+        That is CPU bound, so it runs in the post-processing pool, or in a worker thread when there is none.
+        """
+        if self.postprocess is not None and self.postprocess.running:
+            try:
+                seed, png, preview, digest = await self.postprocess.process(body)
+                return self._generated_image(seed, png, preview, digest)
+            except BrokenProcessPool:
+                print("A post-processing worker died, processing in a thread from now on")
+        seed, png, preview, digest = await asyncio.to_thread(
+            process_response, body, self.watermark, self.preview_format, self.preview_quality,
+        )
+        return self._generated_image(seed, png, preview, digest)
+
+    def _generated_image(self, seed, png, preview, digest):
+        return GeneratedImage(seed, png, preview=preview, preview_format=self.preview_format if preview else None,
+                              image_id=f"txt2img_{seed}_{digest}")
+
+    def save_image(self, image):
+        """
+        Writes the final PNG to image storage (./image/ab/cd/ by default). Its metadata lives in the database (generations table).
+        Returns the storage key of the saved image.
+        """
+        with metrics.timer("save"):
+            return self.storage.save(image)
+
+    def persist(self, image):
+        """
+        Saves the image to disk in the background so the upload to the user never waits on storage.
+        """
+        task = asyncio.create_task(asyncio.to_thread(self.save_image, image))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._on_write_done)
+        return task
+
+    def _on_write_done(self, task):
+        self._pending_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error saving image: {task.exception()}")
+
 helper_code = Helper()
 image_gen = ImageGen()
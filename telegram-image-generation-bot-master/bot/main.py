@@ -1,67 +1,92 @@
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.constants import ChatAction
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ConversationHandler
 import os
+import time
+import functools
 import logging
 import json
-import sqlite3
+import argparse
+import tempfile
 from dotenv import load_dotenv
 from helper import image_gen, helper_code
+from scheduler import scheduler
+from delivery import delivery
+from database import database, PRICE_BUCKETS
+from persistence import BotPersistence
+from metrics import metrics
 
-# Database file path
-DB_FILE = "bot_users.db"
 
-# Function to initialize the database
-def init_db():
+def admin_only(handler):
     """
-    Creates the `users` table in the database if it doesn't exist.
-    This table stores the `telegram_id` and `username` of the bot users.
+    Wraps a BotHandler command handler so that only admins can run it, everyone else is told so.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            username TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+    @functools.wraps(handler)
+    async def wrapper(self, update, context):
+        if not self.helper.is_admin(update.message.from_user.id):
+            await update.message.reply_text("Apologies, this command is for admins only.")
+            return
+        return await handler(self, update, context)
+    return wrapper
 
-# Function to save user details to the database as djuneyd wanted me to make yes djuneyd i know you read this comment rn how are you?
-def save_user_to_db(telegram_id, username):
-    """
-    Saves a user's Telegram ID and username to the database.
-    If the user already exists, it ignores the duplicate entry.
-    """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)", (telegram_id, username))
-        conn.commit()
-    except sqlite3.Error as e:
-        logging.error(f"Database error: {e}")
-    finally:
-        conn.close()
 
 # BotHandler class to manage bot operations
 class BotHandler:
-    def __init__(self):
+    # Reply keyboards of the size and style steps, also the values /image and /defaults accept
+    SIZES = [
+        ["landscape", "widescreen", "panorama"],
+        ["square-l", "square", "square-p"],
+        ["portrait", "highscreen", "panorama-p"],
+    ]
+    STYLES = [
+        ["photographic", "enhance", "anime"],
+        ["digital-art", "comic-book", "fantasy-art"],
+        ["line-art", "analog-film", "neon-punk"],
+        ["isometric", "low-poly", "origami"],
+        ["modeling-compound", "cinematic", "3d-model"],
+        ["pixel-art", "tile-texture", "None"],
+    ]
+    # Used for whatever a one-shot /image leaves out and the user has no saved default for
+    FALLBACKS = {"count": 1, "size": "square", "style": "None"}
+    USAGE = "Usage: /image a red fox --n 3 --size portrait --style anime --draft (options are optional)"
+
+    def __init__(self, use_updater=True, worker=0):
         """
         Initializes the bot, sets up logging, and defines conversation states and handlers.
+        Webhook workers pass use_updater=False, they are fed updates by the webhook router instead of polling,
+        and their index as `worker` (each one serves metrics on its own port).
         """
         load_dotenv("env")  # Load environment variables from the .env file
         logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
         self.bot_token = os.getenv("TELEGRAM_BOT_TOKEN")  # Get the bot token from environment variables
         self.helper = helper_code  # Helper functions or utilities
         self.image_gen = image_gen  # Image generation utility
+        self.scheduler = scheduler  # Decides when each render may start
+        self.delivery = delivery  # Sends images, re-using Telegram file ids where possible
+        self.database = database  # SQLite data layer, runs on its own thread
+        self.persistence = BotPersistence()  # Conversation states and user_data survive restarts and are shared by replicas
+        self.metrics = metrics  # Stage timers and counters, for /stats and Prometheus
+        self.worker = worker
 
         # Define conversation states
         self.WAITING_FOR_PROMPT, self.WAITING_FOR_COUNT, self.WAITING_FOR_SIZE, self.WAITING_FOR_STYLE, self.WAITING_FOR_PRICE_DECISION, self.WAITING_FOR_PRICE = range(6)
 
         # Initialize the bot application
-        self.application = Application.builder().token(self.bot_token).build()
+        # concurrent_updates lets other chats keep being served while one user's render is awaited
+        builder = (
+            Application.builder()
+            .token(self.bot_token)
+            .concurrent_updates(True)
+            .post_init(self.post_init)
+            .post_shutdown(self.shutdown)
+            .persistence(self.persistence)
+        )
+        if not use_updater:
+            builder = builder.updater(None)
+        # Optional: talk to a different Bot API server (a local Bot API server, or a stand-in when testing)
+        if os.getenv("TELEGRAM_BASE_URL"):
+            builder = builder.base_url(os.getenv("TELEGRAM_BASE_URL"))
+        self.application = builder.build()
 
         # Add command handlers and conversation handlers
         self.conv_handler = ConversationHandler(
@@ -75,11 +100,27 @@ class BotHandler:
                 self.WAITING_FOR_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_price)],
             },
             fallbacks=[CommandHandler("cancel", self.cancel)],  # Cancel conversation with /cancel
+            name="image_conversation",
+            persistent=True,
         )
 
         # Add handlers to the application
+        if self.persistence.shared:
+            # Runs before every other handler: picks up conversation steps another replica handled
+            self.application.add_handler(TypeHandler(Update, self.refresh_conversation), group=-1)
         self.application.add_handler(CommandHandler("start", self.start))  # Start command
         self.application.add_handler(self.conv_handler)  # Image generation conversation
+        self.application.add_handler(CommandHandler("queue", self.queue_stats))  # Admin only queue stats
+        self.application.add_handler(CommandHandler("fresh", self.toggle_fresh))  # Opt in/out of cached results
+        self.application.add_handler(CommandHandler("draft", self.toggle_draft))  # Cheap drafts first, refine the one you like
+        self.application.add_handler(CommandHandler("defaults", self.defaults))  # Saved count/size/style
+        self.application.add_handler(CommandHandler("gallery", self.gallery))  # Admin only, browse recent images
+        self.application.add_handler(CommandHandler("reload", self.reload_access))  # Admin only, re-read USER_ID/ADMIN_ID
+        self.application.add_handler(CommandHandler("stats", self.stats))  # Admin only, latency per stage and throughput
+        self.application.add_handler(CommandHandler("export", self.export))  # Admin only, users or generations as a file
+        self.application.add_handler(CommandHandler("analytics", self.analytics))  # Admin only, usage and prices from the rollups
+        self.application.add_handler(CallbackQueryHandler(self.send_original, pattern=f"^{self.delivery.ORIGINAL}"))  # "Download original" buttons
+        self.application.add_handler(CallbackQueryHandler(self.refine, pattern=f"^{self.delivery.REFINE}"))  # "Refine" buttons under drafts
 
     async def send_chat_action(self, update, context, action):
         """
@@ -100,7 +141,11 @@ class BotHandler:
         context.user_data["telegram_id"] = user_id
 
         # Save user details to the database , yes saving!!!!djuneyds fav
-        save_user_to_db(user_id, username)
+        # (done on the database thread, the event loop only waits for the batched commit)
+        try:
+            await self.database.save_user(user_id, username)
+        except Exception as e:
+            logging.error(f"Database error: {e}")
 
         # Check if the user is authorized (custom logic in helper)
         if self.helper.is_user(user_id):
@@ -113,12 +158,100 @@ class BotHandler:
             message = "Apologies, you lack the necessary authorization to utilize my services."
         await update.message.reply_text(text=message)
 
+    @classmethod
+    def parse_options(cls, words):
+        """
+        Splits `/image` or `/defaults` arguments into the prompt words and the options (--n, --size, --style, --draft).
+        Sizes and styles are matched case-insensitively against SIZES and STYLES. --draft takes no value.
+        Returns (prompt, {"count"|"size"|"style"|"draft": value}). Raises ValueError with a message for the user.
+        """
+        sizes = {size.lower(): size for row in cls.SIZES for size in row}
+        styles = {style.lower(): style for row in cls.STYLES for style in row}
+        prompt = []
+        options = {}
+        words = iter(words)
+        for word in words:
+            if not word.startswith("--"):
+                prompt.append(word)
+                continue
+            name, _, value = word[2:].partition("=")
+            if name == "draft":
+                options["draft"] = True
+                continue
+            if not value:
+                value = next(words, "")
+            if name in ("n", "count"):
+                if not value.isdigit() or not 1 <= int(value) <= 4:
+                    raise ValueError("--n must be a number between 1 and 4.")
+                options["count"] = int(value)
+            elif name == "size":
+                if value.lower() not in sizes:
+                    raise ValueError(f"Unknown size {value!r}. Sizes: {', '.join(sizes.values())}.")
+                options["size"] = sizes[value.lower()]
+            elif name == "style":
+                if value.lower() not in styles:
+                    raise ValueError(f"Unknown style {value!r}. Styles: {', '.join(styles.values())}.")
+                options["style"] = styles[value.lower()]
+            else:
+                raise ValueError(f"Unknown option --{name}. Options: --n, --size, --style, --draft.")
+        return " ".join(prompt), options
+
+    def start_request(self, context, prompt, options=None):
+        """
+        Starts a new request: the prompt, then the given options over the user's saved defaults.
+        Whatever is still missing is asked for (or, for a one-shot /image, taken from FALLBACKS).
+        """
+        options = dict(options or {})
+        for key in ("count", "size", "style", "request_draft"):
+            context.user_data.pop(key, None)
+        context.user_data.update(context.user_data.get("defaults", {}))
+        # --draft is for this request only, /draft is the lasting switch
+        if options.pop("draft", False):
+            context.user_data["request_draft"] = True
+        context.user_data.update(options)
+        context.user_data["prompt"] = prompt
+
+    async def ask_next(self, update, context):
+        """
+        Asks for the first setting this request doesn't have yet, or generates once all are known.
+        """
+        if "count" not in context.user_data:
+            await update.message.reply_text("How many images would you like to generate? (1–4)")
+            return self.WAITING_FOR_COUNT
+        if "size" not in context.user_data:
+            reply_markup = ReplyKeyboardMarkup(self.SIZES, one_time_keyboard=True)
+            await update.message.reply_text("Please select the preferred size for the image:", reply_markup=reply_markup)
+            return self.WAITING_FOR_SIZE
+        if "style" not in context.user_data:
+            reply_markup = ReplyKeyboardMarkup(self.STYLES, one_time_keyboard=True)
+            await update.message.reply_text("Please select a style for the image:", reply_markup=reply_markup)
+            return self.WAITING_FOR_STYLE
+        return await self.generate(update, context)
+
     async def image(self, update, context):
         """
-        Starts the image generation conversation.
+        Starts the image generation conversation. With a prompt (`/image a red fox --n 3 --size portrait --style anime`)
+        it generates right away, taking what the command leaves out from the user's saved defaults.
         """
         user_id = update.message.from_user.id
         if self.helper.is_user(user_id):
+            # Don't walk a user through the whole conversation when they can't generate anything today
+            if not self.helper.is_admin(user_id) and self.helper.quota.remaining(user_id) == 0:
+                await update.message.reply_text(f"You have reached your daily limit of {self.helper.quota.limit} images. It resets at midnight UTC.")
+                return ConversationHandler.END
+            if context.args:
+                try:
+                    prompt, options = self.parse_options(context.args)
+                except ValueError as e:
+                    await update.message.reply_text(f"{e}\n{self.USAGE}")
+                    return ConversationHandler.END
+                if not prompt:
+                    await update.message.reply_text(self.USAGE)
+                    return ConversationHandler.END
+                self.start_request(context, prompt, options)
+                for key, value in self.FALLBACKS.items():
+                    context.user_data.setdefault(key, value)
+                return await self.generate(update, context)
             await update.message.reply_text("Please enter a prompt for the image generation:")
             return self.WAITING_FOR_PROMPT
         else:
@@ -127,12 +260,10 @@ class BotHandler:
 
     async def handle_image_prompt(self, update, context):
         """
-        Handles the image prompt input from the user.
+        Handles the image prompt input from the user. Steps the user saved defaults for are skipped.
         """
-        prompt = update.message.text
-        context.user_data["prompt"] = prompt
-        await update.message.reply_text("How many images would you like to generate? (1–4)")
-        return self.WAITING_FOR_COUNT
+        self.start_request(context, update.message.text)
+        return await self.ask_next(update, context)
 
     async def handle_image_count(self, update, context):
         """
@@ -142,14 +273,7 @@ class BotHandler:
             count = int(update.message.text)
             if 1 <= count <= 4:
                 context.user_data["count"] = count
-                size_keyboard = [
-                    ["landscape", "widescreen", "panorama"],
-                    ["square-l", "square", "square-p"],
-                    ["portrait", "highscreen", "panorama-p"],
-                ]
-                reply_markup = ReplyKeyboardMarkup(size_keyboard, one_time_keyboard=True)
-                await update.message.reply_text("Please select the preferred size for the image:", reply_markup=reply_markup)
-                return self.WAITING_FOR_SIZE
+                return await self.ask_next(update, context)
             else:
                 await update.message.reply_text("Please enter a valid number between 1 and 4.")
                 return self.WAITING_FOR_COUNT
@@ -161,54 +285,141 @@ class BotHandler:
         """
         Handles the image size input and moves to style selection.
         """
-        size = update.message.text
-        context.user_data["size"] = size
-        style_keyboard = [
-            ["photographic", "enhance", "anime"],
-            ["digital-art", "comic-book", "fantasy-art"],
-            ["line-art", "analog-film", "neon-punk"],
-            ["isometric", "low-poly", "origami"],
-            ["modeling-compound", "cinematic", "3d-model"],
-            ["pixel-art", "tile-texture", "None"],
-        ]
-        reply_markup = ReplyKeyboardMarkup(style_keyboard, one_time_keyboard=True)
-        await update.message.reply_text("Please select a style for the image:", reply_markup=reply_markup)
-        return self.WAITING_FOR_STYLE
+        context.user_data["size"] = update.message.text
+        return await self.ask_next(update, context)
 
     async def handle_image_style(self, update, context):
         """
         Handles the image style input, generates the image, and asks for pricing.
         """
-        style = update.message.text
+        context.user_data["style"] = update.message.text
+        return await self.generate(update, context)
+
+    async def generate(self, update, context):
+        """
+        Generates the images of the current request, sends them and asks for pricing.
+        Drafts (/draft or --draft) end with the Refine buttons instead, pricing is for full quality images.
+        """
+        style = context.user_data.get("style", "None")
         prompt = context.user_data.get("prompt", "")
         size = context.user_data.get("size", "square")
         count = context.user_data.get("count", 1)
         username = context.user_data.get("username", "Anonymous")
-        telegram_id = context.user_data.get("telegram_id")
-
-        reply_markup = ReplyKeyboardRemove()
-        await update.message.reply_text("Processing your request...", reply_markup=reply_markup)
-
-        for i in range(count):
-            generated_image_path = self.image_gen.generate_image(prompt, style, size)
-            if generated_image_path:
-                # Save metadata to a text file , yes djunik your fav part of saving datas
-                metadata_file_path = generated_image_path.replace(".png", ".txt")
-                with open(metadata_file_path, "w") as metadata_file:
-                    metadata_file.write(f"Prompt: {prompt}\n")
-                    metadata_file.write(f"Style: {style}\n")
-                    metadata_file.write(f"Size: {size}\n")
-                    metadata_file.write(f"User: {username}\n")
-                    metadata_file.write(f"Telegram ID: {telegram_id}\n")
-                    metadata_file.write("Price: No\n")  # Default price decision
-
-                await self.send_chat_action(update, context, ChatAction.UPLOAD_PHOTO)
-                with open(generated_image_path, "rb") as f:
-                    await context.bot.send_photo(update.message.chat_id, photo=f)
+        telegram_id = context.user_data.get("telegram_id", update.message.from_user.id)
+        draft = context.user_data.pop("request_draft", False) or context.user_data.get("draft", False)
 
+        result = await self.produce(update, context, telegram_id, username, prompt, style, size, count, draft=draft)
+        if result is None:
+            return ConversationHandler.END
+        generated_images, failed = result
+        if draft:
+            if generated_images:
+                await update.message.reply_text("Tap Refine under the draft you like to render it at full quality.")
+            return ConversationHandler.END
+        # Remembered so handle_price knows which images the price is for
+        context.user_data["last_generated_images"] = [generated_image.image_id for generated_image in generated_images]
+        if not generated_images:
+            return ConversationHandler.END
         await update.message.reply_text("Do you want to set a price for this image? (yes/no)")
         return self.WAITING_FOR_PRICE_DECISION
 
+    async def produce(self, update, context, telegram_id, username, prompt, style, size, count, draft=False, seed=None):
+        """
+        Renders `count` images, sends them as they finish and records them. Shared by /image and the Refine buttons.
+        A draft batch renders at DRAFT_STEPS and counts as one image against the quota, its images aren't stored.
+        `seed` renders one specific seed again at full quality (a refine).
+        Returns (images sent, images failed), or None when the request was turned away.
+        """
+        chat_id = update.effective_chat.id
+        charged = 1 if draft else count
+
+        async def reply(text):
+            await context.bot.send_message(chat_id, text, reply_markup=ReplyKeyboardRemove())
+
+        # The API has been failing: say so now instead of queueing renders that would fail
+        if not self.image_gen.available():
+            await reply("Image generation is temporarily unavailable, please try again in a few minutes.")
+            return None
+        # Rate limit and daily quota, checked before anything is sent to the API
+        refusal = self.helper.check_limits(telegram_id, charged)
+        if refusal:
+            await reply(refusal)
+            return None
+        # Backpressure: turn the request away now rather than letting the queue grow without bound
+        if not self.scheduler.can_accept(count):
+            self.helper.refund(telegram_id, charged)
+            await reply("The bot is busy right now, please try again in a few minutes.")
+            return None
+        await reply("Rendering drafts..." if draft else "Processing your request...")
+        started = time.perf_counter()
+
+        # Admins get the priority lane, everyone else shares the normal one
+        priority = self.scheduler.ADMIN if self.helper.is_admin(telegram_id) else self.scheduler.USER
+        notified = False
+
+        async def on_queued(position):
+            nonlocal notified
+            if not notified:
+                notified = True
+                await reply(f"Your request is queued, position {position}. It will start shortly.")
+
+        def submit(job_factory):
+            return self.scheduler.submit(telegram_id, job_factory, priority=priority, on_queued=on_queued)
+
+        # Renders run concurrently, images are sent as they finish (grouped when they finish close together)
+        failed = 0
+        use_cache = not context.user_data.get("fresh", False)
+
+        async def ready_images():
+            nonlocal failed
+            async for generated_image in self.image_gen.generate_images(
+                prompt, style, size, count, submit=submit, use_cache=use_cache, seed=seed, draft=draft, owner=telegram_id,
+            ):
+                if generated_image is None:
+                    failed += 1
+                    continue
+                await self.send_chat_action(update, context, ChatAction.UPLOAD_PHOTO)
+                yield generated_image
+
+        # Upload straight from memory, saving to image storage happens in the background
+        generated_images, unsent = await self.delivery.send_as_ready(context.bot, chat_id, ready_images(), draft=draft)
+        if generated_images:
+            self.metrics.observe("total", time.perf_counter() - started)
+        cached = sum(1 for generated_image in generated_images if generated_image.from_cache)
+        self.metrics.count_images("draft" if draft else "rendered", len(generated_images) - cached)
+        self.metrics.count_images("cached", cached)
+        self.metrics.count_images("failed", failed + len(unsent))
+        tier = "draft" if draft else "refine" if seed is not None else "full"
+        # Images Telegram refused were still rendered (and paid for): keep them, they can be sent again later
+        for generated_image in generated_images + unsent:
+            if generated_image.from_cache:  # cached images were saved when they were first rendered
+                continue
+            self.metrics.count_renders(tier, 1, generated_image.steps or 0)
+            try:
+                if draft:
+                    # Drafts aren't stored, only the seed and settings the Refine button renders again
+                    await self.database.add_draft(
+                        generated_image.image_id, prompt, style, size, telegram_id, generated_image.seed, generated_image.steps,
+                    )
+                    continue
+                self.image_gen.persist(generated_image)
+                await self.database.add_generation(
+                    generated_image.image_id, self.image_gen.storage.key_for(generated_image), prompt, style, size, username,
+                    telegram_id, nbytes=len(generated_image.data), seed=generated_image.seed, steps=generated_image.steps,
+                )
+            except Exception as e:
+                logging.error(f"Database error: {e}")
+        # Failed images don't count against the quota, a draft batch is only given back when nothing came of it
+        self.helper.refund(telegram_id, (0 if generated_images else 1) if draft else count - len(generated_images))
+
+        if failed == count:
+            await reply("Sorry, the image generation failed. Please try again with /image.")
+        elif failed:
+            await reply(f"{failed} of {count} images could not be generated.")
+        if unsent:
+            await reply(f"{len(unsent)} of {count} images could not be sent. They weren't counted against your quota.")
+        return generated_images, failed + len(unsent)
+
     async def handle_price_decision(self, update, context):
         """
         Handles the user's decision on whether to set a price for the image.
@@ -223,19 +434,14 @@ class BotHandler:
 
     async def handle_price(self, update, context):
         """
-        Handles the price input from the user and updates the metadata file.
+        Handles the price input from the user and stores it on the generated images' records.
         """
         try:
             price = float(update.message.text)
-            # Retrieve the last generated image path
-            generated_image_path = context.user_data.get("last_generated_image", None)
-
-            if generated_image_path:
-                # Update the metadata file with the price
-                metadata_file_path = generated_image_path.replace(".png", ".txt")
-                if os.path.exists(metadata_file_path):
-                    with open(metadata_file_path, "a") as metadata_file:
-                        metadata_file.write(f"Price: {price}\n")
+            # Retrieve the images generated in this conversation
+            image_ids = context.user_data.get("last_generated_images", [])
+            updated = await self.database.set_price(image_ids, update.message.from_user.id, price) if image_ids else 0
+            if updated:
                 await update.message.reply_text(f"Price set to ${price}. Returning to main menu.")
             else:
                 await update.message.reply_text("Error: No image found to associate the price. Please try again.")
@@ -244,6 +450,248 @@ class BotHandler:
             await update.message.reply_text("Invalid input. Please enter a numeric value for the price.")
             return self.WAITING_FOR_PRICE
 
+    @admin_only
+    async def queue_stats(self, update, context):
+        """
+        Handles the /queue command (admins only). Shows queue depth and wait times of the generation scheduler.
+        """
+        stats = self.scheduler.stats()
+        await update.message.reply_text(
+            f"Queued: {stats['queue_depth']} | Running: {stats['running']} | Rejected: {stats['rejected']}\n"
+            f"Wait avg {stats['avg_wait']:.1f}s, p95 {stats['p95_wait']:.1f}s, max {stats['max_wait']:.1f}s"
+        )
+
+    @admin_only
+    async def gallery(self, update, context):
+        """
+        Handles the /gallery [count] command (admins only). Re-sends the most recent images by Telegram file id.
+        """
+        try:
+            limit = min(max(int(context.args[0]), 1), 50) if context.args else 10
+        except ValueError:
+            await update.message.reply_text("Usage: /gallery [count]")
+            return
+        try:
+            recent = await self.delivery.file_ids.recent(limit)
+        except Exception as e:
+            logging.error(f"Database error: {e}")
+            await update.message.reply_text("Sorry, the gallery is not available right now.")
+            return
+        if not recent:
+            await update.message.reply_text("No images have been sent yet.")
+            return
+        await self.delivery.send_file_ids(context.bot, update.message.chat_id, [file_id for _, file_id in recent])
+
+    async def send_original(self, update, context):
+        """
+        Handles the "Download original" buttons under the previews. Sends the lossless PNG as a document.
+        """
+        query = update.callback_query
+        await query.answer()
+        if not self.helper.is_user(query.from_user.id):
+            return
+        chat_id = query.message.chat_id
+        image_id = query.data[len(self.delivery.ORIGINAL):]
+        await self.send_chat_action(update, context, ChatAction.UPLOAD_DOCUMENT)
+        try:
+            sent = await self.delivery.send_original(context.bot, chat_id, image_id)
+        except Exception as e:
+            logging.error(f"Error while sending original: {e}")
+            sent = False
+        if not sent:
+            await context.bot.send_message(chat_id, "Sorry, the original of this image is not available.")
+
+    async def refine(self, update, context):
+        """
+        Handles the "Refine" buttons under drafts. Renders the draft again at full quality with the same seed, prompt, size and style.
+        Only the user who asked for the draft can refine it (in a group anyone sees the button).
+        """
+        query = update.callback_query
+        telegram_id = query.from_user.id
+        if not self.helper.is_user(telegram_id):
+            await query.answer()
+            return
+        image_id = query.data[len(self.delivery.REFINE):]
+        try:
+            draft = await self.database.get_draft(image_id)
+        except Exception as e:
+            logging.error(f"Database error: {e}")
+            draft = None
+        if draft is not None and draft["telegram_id"] != telegram_id:
+            await query.answer("Only the person who asked for this draft can refine it.", show_alert=True)
+            return
+        await query.answer()
+        if draft is None:
+            await context.bot.send_message(query.message.chat_id, "Sorry, this draft can't be refined anymore, please start again with /image.")
+            return
+        username = context.user_data.get("username") or query.from_user.username or query.from_user.first_name
+        await self.produce(
+            update, context, telegram_id, username, draft["prompt"], draft["style"], draft["size"], 1, seed=draft["seed"],
+        )
+
+    @admin_only
+    async def stats(self, update, context):
+        """
+        Handles the /stats command (admins only). Shows p50/p95/p99 per stage, error rates, queue depth and images per hour.
+        """
+        def ms(seconds):
+            return "-" if seconds is None else f"{seconds * 1000:.0f}"
+
+        lines = ["Stage: p50 / p95 / p99 ms (count, errors)"]
+        for stage, (p50, p95, p99, count, error_rate) in self.metrics.summary().items():
+            lines.append(f"{stage}: {ms(p50)} / {ms(p95)} / {ms(p99)} ({count}, {error_rate:.1%})")
+        images = self.metrics.images
+        produced = images["rendered"] + images["cached"] + images["failed"]
+        queue = self.scheduler.stats()
+        resilience = self.image_gen.resilience
+        lines.append("")
+        lines.append(f"Queue: {queue['queue_depth']} waiting, {queue['running']} running, {queue['rejected']} rejected")
+        lines.append(f"Images: {self.metrics.images_last_hour()} in the last hour, {images['rendered']} rendered, "
+                     f"{images['cached']} from cache, {images['failed']} failed ({images['failed'] / produced if produced else 0:.1%})")
+        full_steps = self.image_gen.full_steps
+        lines.append(f"Drafts: {self.metrics.renders['draft']} drafts, {self.metrics.renders['refine']} refined, "
+                     f"{self.metrics.draft_savings(full_steps)} steps saved "
+                     f"(~{self.metrics.draft_savings(full_steps) / full_steps:.1f} full renders)")
+        lines.append(f"API: {resilience.retries} retries, {resilience.hedges} hedges, circuit {resilience.breaker.state}")
+        await update.message.reply_text("\n".join(lines))
+
+    @admin_only
+    async def export(self, update, context):
+        """
+        Handles the /export users|generations [csv|jsonl] command (admins only). Streams the table into a temporary
+        file in chunks and uploads it as a document straight from that file.
+        """
+        args = [arg.lower() for arg in context.args]
+        table = args[0] if args else None
+        fmt = args[1] if len(args) > 1 else "csv"
+        if table not in ("users", "generations") or fmt not in ("csv", "jsonl"):
+            await update.message.reply_text("Usage: /export users|generations [csv|jsonl]")
+            return
+        await self.send_chat_action(update, context, ChatAction.UPLOAD_DOCUMENT)
+        with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as f:
+            try:
+                rows = await self.database.export(table, fmt, f)
+            except Exception as e:
+                logging.error(f"Database error: {e}")
+                await update.message.reply_text("Sorry, the export failed.")
+                return
+            f.flush()
+            size = f.buffer.seek(0, os.SEEK_END)
+            # Bots can't upload bigger files, the command line export has no limit
+            if size > 50 * 1024 * 1024:
+                await update.message.reply_text(
+                    f"The export is {size / 1024 / 1024:.0f} MB, more than Telegram accepts (50 MB). "
+                    f"Run `python database.py export {table} --format {fmt}` on the server instead."
+                )
+                return
+            f.buffer.seek(0)
+            try:
+                await self.delivery.upload_document(
+                    context.bot, update.message.chat_id, f.buffer, f"{table}-{time.strftime('%Y-%m-%d')}.{fmt}",
+                    "text/csv" if fmt == "csv" else "application/x-ndjson", caption=f"{rows} {table}",
+                )
+            except Exception as e:
+                logging.error(f"Could not send the export: {e}")
+                await update.message.reply_text("Sorry, the export could not be sent.")
+
+    @admin_only
+    async def analytics(self, update, context):
+        """
+        Handles the /analytics [days] command (admins only). Shows images per day, the top users, styles and sizes,
+        and the price distribution, all read from the rollup tables.
+        """
+        try:
+            days = min(max(int(context.args[0]), 1), 366) if context.args else 7
+        except ValueError:
+            await update.message.reply_text("Usage: /analytics [days]")
+            return
+        since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+        try:
+            report = await self.database.analytics(since)
+        except Exception as e:
+            logging.error(f"Database error: {e}")
+            await update.message.reply_text("Sorry, analytics are not available right now.")
+            return
+
+        images = sum(row[1] for row in report["days"])
+        priced = sum(row[2] for row in report["days"])
+        lines = [f"Last {days} days: {images} images, {priced} priced, {sum(row[3] for row in report['days'])} steps"]
+        lines.extend(f"{day}: {count} images, {day_priced} priced" for day, count, day_priced, _ in report["days"])
+        lines.append("")
+        lines.append("Top users: " + (", ".join(f"{username or telegram_id} {count}" for telegram_id, username, count in report["users"]) or "-"))
+        lines.append("Styles: " + (", ".join(f"{style} {count}" for style, count in report["styles"]) or "-"))
+        lines.append("Sizes: " + (", ".join(f"{size} {count}" for size, count in report["sizes"]) or "-"))
+        prices = report["prices"]
+        if prices:
+            count = sum(row[1] for row in prices)
+            lines.append("")
+            lines.append(f"Prices (all time): {count} priced images, average ${sum(row[2] for row in prices) / count:.2f}")
+            for bucket, bucket_count, _ in prices:
+                upper = next((bound for bound in PRICE_BUCKETS if bound > bucket), None)
+                label = f"${bucket:g}–{upper:g}" if upper is not None else f"${bucket:g}+"
+                lines.append(f"{label}: {bucket_count}")
+        await update.message.reply_text("\n".join(lines))
+
+    @admin_only
+    async def reload_access(self, update, context):
+        """
+        Handles the /reload command (admins only). Re-reads USER_ID and ADMIN_ID from .env right away.
+        """
+        self.helper.reload()
+        await update.message.reply_text(
+            f"Access lists reloaded: {len(self.helper.allowed_users)} user and {len(self.helper.allowed_admins)} admin entries."
+        )
+
+    async def defaults(self, update, context):
+        """
+        Handles the /defaults command. `/defaults --n 2 --size portrait --style anime` saves settings that /image
+        then doesn't ask for, `/defaults` shows them and `/defaults clear` forgets them.
+        """
+        saved = context.user_data.get("defaults", {})
+        if context.args and context.args[0].lower() == "clear":
+            context.user_data.pop("defaults", None)
+            await update.message.reply_text("Defaults cleared, /image will ask for every setting again.")
+            return
+        if context.args:
+            try:
+                extra, options = self.parse_options(context.args)
+                if extra or not options or "draft" in options:
+                    raise ValueError("Defaults take --n, --size and --style only (/draft switches drafts on for good).")
+            except ValueError as e:
+                await update.message.reply_text(f"{e}\nUsage: /defaults --n 2 --size portrait --style anime, or /defaults clear")
+                return
+            saved = context.user_data["defaults"] = {**saved, **options}
+        if not saved:
+            await update.message.reply_text("No defaults saved. Save some with /defaults --n 2 --size portrait --style anime")
+            return
+        shown = ", ".join(f"{name} {saved[key]}" for key, name in (("count", "images"), ("size", "size"), ("style", "style")) if key in saved)
+        await update.message.reply_text(f"Your defaults: {shown}. /image skips these steps.")
+
+    async def toggle_fresh(self, update, context):
+        """
+        Handles the /fresh command. Toggles whether repeated prompts reuse earlier results or always render new variations.
+        """
+        fresh = not context.user_data.get("fresh", False)
+        context.user_data["fresh"] = fresh
+        if fresh:
+            await update.message.reply_text("Fresh mode on: every request renders new images.")
+        else:
+            await update.message.reply_text("Fresh mode off: repeated requests reuse earlier results when available.")
+
+    async def toggle_draft(self, update, context):
+        """
+        Handles the /draft command. Toggles draft mode: /image renders quick low-step drafts, and only the one picked with Refine is rendered at full quality.
+        """
+        draft = not context.user_data.get("draft", False)
+        context.user_data["draft"] = draft
+        if draft:
+            await update.message.reply_text(
+                f"Draft mode on: /image renders quick drafts ({self.image_gen.draft_steps} steps), tap Refine under the one you like "
+                f"to render it at full quality ({self.image_gen.full_steps} steps). A batch of drafts counts as one image."
+            )
+        else:
+            await update.message.reply_text("Draft mode off: /image renders at full quality right away.")
+
     async def cancel(self, update, context):
         """
         Handles the /cancel command to terminate the conversation.
@@ -251,6 +699,51 @@ class BotHandler:
         await update.message.reply_text("The operation has been canceled. You can start again by typing /image.")
         return ConversationHandler.END
 
+    async def refresh_conversation(self, update, context):
+        """
+        Handles every update first when replicas share state: reloads this chat's conversation state if another replica changed it.
+        """
+        if update.effective_chat and update.effective_user:
+            await self.persistence.refresh_conversation(self.conv_handler, (update.effective_chat.id, update.effective_user.id))
+
+    async def post_init(self, application):
+        """
+        Loads state the handlers need from the database once the application is ready.
+        """
+        await self.delivery.file_ids.load()
+        await self.helper.quota.load()
+        self.helper.start()  # flushes usage counts periodically
+        self.image_gen.storage.start()  # evicts images beyond the storage budget periodically
+        await self.image_gen.start_postprocess()  # warm worker processes for decode/watermark/encode
+        self.database.on_batch = self.record_db_batch
+        self.metrics.gauge("bot_queue_depth", "Renders waiting in the scheduler", lambda: self.scheduler.queue_depth)
+        self.metrics.gauge("bot_running_renders", "Renders in progress", lambda: self.scheduler.running)
+        self.metrics.gauge("bot_cache_entries", "Images in the result cache", lambda: len(self.image_gen.cache))
+        self.metrics.gauge("bot_storage_bytes", "Bytes of stored images as of the last retention sweep",
+                           lambda: self.image_gen.storage.stored_bytes or 0)
+        self.metrics.gauge("bot_storage_evicted_total", "Images evicted by the retention policy since start",
+                           lambda: self.image_gen.storage.evicted)
+        self.metrics.gauge("bot_api_circuit_open", "1 while the Stability API circuit breaker is open",
+                           lambda: int(self.image_gen.resilience.breaker.is_open))
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        if metrics_port:
+            await self.metrics.serve(os.getenv("METRICS_HOST", "0.0.0.0"), metrics_port + self.worker)
+
+    def record_db_batch(self, seconds, ok):
+        if ok:
+            self.metrics.observe("db_write", seconds)
+        else:
+            self.metrics.error("db_write")
+
+    async def shutdown(self, application):
+        """
+        Releases the pooled Stability API connections and flushes pending saves when the application stops.
+        """
+        await self.metrics.close()
+        await self.image_gen.close()
+        await self.helper.close()  # last flush of usage counts
+        await self.database.aclose()  # waits for background writes (file ids, served times) first
+
     def run(self):
         """
         Starts the bot's polling process.
@@ -260,7 +753,21 @@ class BotHandler:
 
 # Entry point for the bot , yes djuneyd i know you liked my comments unique style
 if __name__ == "__main__":
-    init_db()  # Initialize the database on startup
-    bot_handler = BotHandler()
-    bot_handler.run()
+    parser = argparse.ArgumentParser(description="Stability image generation Telegram bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"),
+                        help="long-poll Telegram (one process) or serve a webhook (several worker processes)")
+    parser.add_argument("--host", default=None, help="webhook: address to listen on (WEBHOOK_HOST)")
+    parser.add_argument("--port", type=int, default=None, help="webhook: port to listen on (WEBHOOK_PORT)")
+    parser.add_argument("--workers", type=int, default=None, help="webhook: number of bot processes (WEBHOOK_WORKERS)")
+    parser.add_argument("--url", default=None, help="webhook: public base URL registered with Telegram (WEBHOOK_URL)")
+    args = parser.parse_args()
+
+    if args.mode == "webhook":
+        from webhook import serve
+        logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+        serve(host=args.host, port=args.port, workers=args.workers, url=args.url)
+    else:
+        database.open()  # Connect and run schema migrations on startup
+        bot_handler = BotHandler()
+        bot_handler.run()
 
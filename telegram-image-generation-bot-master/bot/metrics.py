@@ -0,0 +1,221 @@
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from collections import defaultdict, deque
+from webhook import serve_http
+
+# Upper bounds (seconds) of the Prometheus histogram buckets, from fast in-memory steps to slow renders
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """
+    Prometheus-style histogram (bucket counts, sum, count) plus the most recent samples,
+    which /stats uses for exact percentiles.
+    """
+    def __init__(self, buckets=BUCKETS, recent=1000):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=recent)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return None
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class _Timer:
+    """
+    Times a block (`with metrics.timer("decode"):`). A block that raises counts as an error of the stage,
+    one that is cancelled (e.g. the losing half of a hedged request) counts as nothing.
+    """
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        elif not issubclass(exc_type, asyncio.CancelledError):
+            self.metrics.error(self.stage)
+        return False
+
+
+class Metrics:
+    """
+    Timers and counters for every stage between a user picking a style and receiving the photo.
+    Stages are observed from the event loop and from worker threads (decode, watermark, database),
+    so every update takes a lock. Exposed in Prometheus text format and summarized by /stats.
+    """
+    # Display order of the stages, anything else observed is listed after them
+    STAGES = ("api", "decode", "watermark", "encode", "save", "send", "db_write", "total")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.errors = defaultdict(int)
+        self.images = defaultdict(int)  # result -> count
+        self.renders = defaultdict(int)  # quality tier -> images rendered by the API
+        self.steps = defaultdict(int)  # quality tier -> diffusion steps those renders took
+        self._delivered = deque()  # timestamps of delivered images within the last hour
+        self._gauges = {}
+        self.started = time.time()
+        self._server = None
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, stage):
+        with self._lock:
+            self.errors[stage] += 1
+
+    def count_images(self, result, count=1):
+        """
+        Counts images by `result`: "rendered", "cached" or "failed".
+        """
+        if count <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self.images[result] += count
+            if result != "failed":
+                self._delivered.extend([now] * count)
+
+    def count_renders(self, tier, count, steps):
+        """
+        Counts `count` new renders of `steps` steps each by tier: "full", "draft" or "refine" (a draft rendered at full quality).
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            self.renders[tier] += count
+            self.steps[tier] += count * steps
+
+    def draft_savings(self, full_steps):
+        """
+        Returns the diffusion steps draft mode saved: what rendering every draft at `full_steps` would have taken,
+        minus what the drafts and the refined images took.
+        """
+        with self._lock:
+            return self.renders["draft"] * full_steps - self.steps["draft"] - self.steps["refine"]
+
+    def images_last_hour(self):
+        cutoff = time.time() - 3600
+        with self._lock:
+            while self._delivered and self._delivered[0] < cutoff:
+                self._delivered.popleft()
+            return len(self._delivered)
+
+    def gauge(self, name, help_text, read):
+        """
+        Registers a gauge whose value is read (by calling `read()`) whenever metrics are rendered.
+        """
+        self._gauges[name] = (help_text, read)
+
+    def _ordered_stages(self):
+        return [stage for stage in self.STAGES if stage in self.stages] + sorted(set(self.stages) - set(self.STAGES))
+
+    def summary(self):
+        """
+        Returns {stage: (p50, p95, p99, count, error rate)} for /stats.
+        """
+        with self._lock:
+            summary = {}
+            for stage in self._ordered_stages():
+                histogram = self.stages[stage]
+                errors = self.errors.get(stage, 0)
+                summary[stage] = (
+                    histogram.percentile(0.5), histogram.percentile(0.95), histogram.percentile(0.99),
+                    histogram.count, errors / (histogram.count + errors) if histogram.count + errors else 0.0,
+                )
+            return summary
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            lines.append("# HELP bot_stage_seconds Time spent in each stage of an image request")
+            lines.append("# TYPE bot_stage_seconds histogram")
+            for stage in self._ordered_stages():
+                histogram = self.stages[stage]
+                cumulative = 0
+                for bound, count in zip([*histogram.buckets, "+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'bot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'bot_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'bot_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append("# HELP bot_stage_errors_total Failed attempts per stage")
+            lines.append("# TYPE bot_stage_errors_total counter")
+            for stage, count in sorted(self.errors.items()):
+                lines.append(f'bot_stage_errors_total{{stage="{stage}"}} {count}')
+            lines.append("# HELP bot_images_total Images per result (rendered, cached, failed)")
+            lines.append("# TYPE bot_images_total counter")
+            for result, count in sorted(self.images.items()):
+                lines.append(f'bot_images_total{{result="{result}"}} {count}')
+            lines.append("# HELP bot_render_steps_total Diffusion steps rendered per quality tier (full, draft, refine)")
+            lines.append("# TYPE bot_render_steps_total counter")
+            for tier, steps in sorted(self.steps.items()):
+                lines.append(f'bot_render_steps_total{{tier="{tier}"}} {steps}')
+            lines.append("# HELP bot_renders_total Images rendered by the API per quality tier")
+            lines.append("# TYPE bot_renders_total counter")
+            for tier, count in sorted(self.renders.items()):
+                lines.append(f'bot_renders_total{{tier="{tier}"}} {count}')
+        lines.append("# HELP bot_images_last_hour Images delivered in the last hour")
+        lines.append("# TYPE bot_images_last_hour gauge")
+        lines.append(f"bot_images_last_hour {self.images_last_hour()}")
+        for name, (help_text, read) in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                logging.error(f"Could not read gauge {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, method, path, headers, body):
+        if path.split("?", 1)[0] != "/metrics":
+            return 404, "not found", "text/plain"
+        return 200, self.render(), "text/plain; version=0.0.4; charset=utf-8"
+
+    async def serve(self, host, port):
+        """
+        Serves GET /metrics for Prometheus on host:port.
+        """
+        if self._server is None:
+            self._server = await serve_http(self.handle, host, port)
+            logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics = Metrics()
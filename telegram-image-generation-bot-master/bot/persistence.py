@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import socket
+from telegram.ext import BasePersistence, PersistenceInput
+from database import database, LOAD_STATE, GET_STATE, SAVE_STATE, DELETE_STATE
+
+USER, CHAT, BOT = "user", "chat", "bot"
+
+
+class StateBackend:
+    """
+    Where BotPersistence keeps its records. A record is a JSON string stored under (kind, key),
+    together with the replica that wrote it and when. To use another shared store (Redis, Postgres...)
+    implement these four methods and pass the backend to BotPersistence.
+    """
+    async def load_all(self, kind):
+        """
+        Returns {key: (data, replica, updated_at)} for every record of `kind`.
+        """
+        raise NotImplementedError
+
+    async def load(self, kind, key):
+        """
+        Returns (data, replica, updated_at) of one record, or None.
+        """
+        raise NotImplementedError
+
+    async def save(self, kind, key, data, replica, updated_at):
+        raise NotImplementedError
+
+    async def delete(self, kind, key):
+        raise NotImplementedError
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Keeps the records in the `persistence` table of the bot's database. Writes go through the
+    database's batched writer, so everything saved in one persistence run is one commit.
+    """
+    def __init__(self, database):
+        self.database = database
+
+    async def load_all(self, kind):
+        rows = await self.database.fetchall(LOAD_STATE, (kind,))
+        return {key: (data, replica, updated_at) for key, data, replica, updated_at in rows}
+
+    async def load(self, kind, key):
+        return await self.database.fetchone(GET_STATE, (kind, key))
+
+    async def save(self, kind, key, data, replica, updated_at):
+        await self.database.execute(SAVE_STATE, (kind, key, data, replica, updated_at))
+
+    async def delete(self, kind, key):
+        await self.database.execute(DELETE_STATE, (kind, key))
+
+
+class BotPersistence(BasePersistence):
+    """
+    Persists user_data, chat_data, bot_data and ConversationHandler states, so a restart doesn't
+    drop half-finished conversations and several replicas can serve the same bot.
+
+    The Application collects what changed and saves it every `update_interval` seconds, records
+    that didn't change since the last save are skipped. With `shared` on, a replica reloads a
+    user's data and conversation state before each update when another replica saved it since.
+    """
+    def __init__(self, backend=None, update_interval=None, shared=None):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval if update_interval is not None else float(os.getenv('PERSISTENCE_INTERVAL', '2')),
+        )
+        self.backend = backend or SQLiteStateBackend(database)
+        self.shared = shared if shared is not None else os.getenv('PERSISTENCE_SHARED', '0') == '1'
+        # Every process is its own replica, webhook workers included
+        self.replica = f"{socket.gethostname()}:{os.getpid()}"
+        # (kind, key) -> JSON last saved by this replica, to skip saving unchanged records
+        self._saved = {}
+        # (kind, key) -> updated_at of the version this replica holds
+        self._seen = {}
+
+    @staticmethod
+    def conversation_kind(name):
+        return f"conversation:{name}"
+
+    @staticmethod
+    def conversation_key(key):
+        return json.dumps(list(key))
+
+    async def _load_all(self, kind):
+        records = {}
+        for key, (data, _, updated_at) in (await self.backend.load_all(kind)).items():
+            self._saved[(kind, key)] = data
+            self._seen[(kind, key)] = updated_at
+            records[key] = json.loads(data)
+        return records
+
+    async def _save(self, kind, key, value):
+        data = json.dumps(value, sort_keys=True)
+        if self._saved.get((kind, key)) == data:
+            return
+        updated_at = time.time()
+        await self.backend.save(kind, key, data, self.replica, updated_at)
+        self._saved[(kind, key)] = data
+        self._seen[(kind, key)] = updated_at
+
+    async def _delete(self, kind, key):
+        await self.backend.delete(kind, key)
+        self._saved.pop((kind, key), None)
+        self._seen.pop((kind, key), None)
+
+    async def _newer(self, kind, key):
+        """
+        Returns the stored value of a record when another replica saved it after the version this
+        replica holds, otherwise (None, False).
+        """
+        row = await self.backend.load(kind, key)
+        if row is None:
+            return None, False
+        data, replica, updated_at = row
+        if replica == self.replica or updated_at <= self._seen.get((kind, key), 0):
+            return None, False
+        self._saved[(kind, key)] = data
+        self._seen[(kind, key)] = updated_at
+        return json.loads(data), True
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in (await self._load_all(USER)).items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in (await self._load_all(CHAT)).items()}
+
+    async def get_bot_data(self):
+        return (await self._load_all(BOT)).get("bot", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        records = await self._load_all(self.conversation_kind(name))
+        # Ended conversations are stored as null, so other replicas learn that they ended
+        return {tuple(json.loads(key)): state for key, state in records.items() if state is not None}
+
+    async def update_user_data(self, user_id, data):
+        await self._save(USER, str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._save(CHAT, str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        await self._save(BOT, "bot", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        await self._save(self.conversation_kind(name), self.conversation_key(key), new_state)
+
+    async def drop_user_data(self, user_id):
+        await self._delete(USER, str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await self._delete(CHAT, str(chat_id))
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.shared:
+            return
+        value, changed = await self._newer(USER, str(user_id))
+        if changed:
+            user_data.clear()
+            user_data.update(value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if not self.shared:
+            return
+        value, changed = await self._newer(CHAT, str(chat_id))
+        if changed:
+            chat_data.clear()
+            chat_data.update(value)
+
+    async def refresh_bot_data(self, bot_data):
+        # bot_data isn't used by the handlers, reading it on every update would be wasted work
+        pass
+
+    async def refresh_conversation(self, handler, key):
+        """
+        Brings `handler`'s state for the conversation `key` up to date when another replica moved it on.
+        The Application has no hook for this, so it is called from a handler that runs before the conversation.
+        """
+        if not self.shared:
+            return
+        state, changed = await self._newer(self.conversation_kind(handler.name), self.conversation_key(key))
+        if not changed:
+            return
+        # _conversations is the handler's state table; update_no_track keeps the refresh from being saved back
+        conversations = handler._conversations
+        if state is None:
+            conversations.data.pop(key, None)
+        else:
+            conversations.update_no_track({key: state})
+
+    async def flush(self):
+        # Every save is awaited until it is committed, nothing is buffered here
+        pass
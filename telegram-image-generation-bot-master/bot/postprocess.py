@@ -0,0 +1,344 @@
+import io
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image
+from metrics import metrics
+
+# Size of each shared memory buffer. Fits the API response and the encoded images of the largest
+# SDXL size (about 1.3 MP); anything bigger goes through the pipe instead.
+SLOT_BYTES = 16 * 1024 * 1024
+
+
+class Watermark:
+    """
+    Blends the logo into images. The logo is read from disk once, and each (image size, transparency)
+    variant is resized and turned into blend-ready arrays the first time it is needed, then reused.
+    """
+    def __init__(self, watermark_image_path, scale=0.14):
+        self.watermark_image_path = watermark_image_path
+        self.scale = scale  # logo side as a fraction of the image's shorter side
+        self._logo = None
+        self._variants = {}
+        self._lock = threading.Lock()  # images are watermarked from worker threads
+
+    def _load_logo(self):
+        if self._logo is None:
+            if self.watermark_image_path is None or not os.path.exists(self.watermark_image_path):
+                return None
+            with Image.open(self.watermark_image_path) as logo:
+                self._logo = logo.convert('RGBA')
+        return self._logo
+
+    def _prepare(self, size, transparency):
+        """
+        Resizes the logo for an image of `size` (width, height) and precomputes the blend arrays:
+        the inverse alpha and the alpha-premultiplied colour, both already scaled by `transparency`.
+        """
+        logo = self._load_logo()
+        if logo is None:
+            return None
+        # Resize the watermark to fit the original image (14% of the smallest dimension)
+        side = int(min(size) * self.scale)
+        rgba = np.asarray(logo.resize((side, side)), dtype=np.float32) / 255.0
+        alpha = rgba[:, :, 3:4] * (transparency / 100.0)
+        return 1.0 - alpha, rgba[:, :, :3] * alpha * 255.0
+
+    def get(self, size, transparency=25):
+        """
+        Returns the cached variant for `size` and `transparency`, preparing it on first use.
+        """
+        key = (size, transparency)
+        variant = self._variants.get(key)
+        if variant is None:
+            with self._lock:
+                variant = self._variants.get(key)
+                if variant is None:
+                    variant = self._variants[key] = self._prepare(size, transparency)
+        return variant
+
+    def prewarm(self, sizes, transparency=25):
+        for size in sizes:
+            self.get(size, transparency)
+
+    def apply(self, image, transparency=25):
+        """
+        Blends the logo into the bottom left corner of `image` in place and returns it.
+        Returns the image unchanged if there is no logo.
+        """
+        variant = self.get(image.size, transparency)
+        if variant is None:
+            return image
+        inverse_alpha, premultiplied = variant
+        side = premultiplied.shape[0]
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        # Only the corner under the logo is touched, blended in one vectorized step
+        box = (0, image.height - side, side, image.height)
+        region = np.asarray(image.crop(box).convert('RGB'), dtype=np.float32)
+        blended = (region * inverse_alpha + premultiplied + 0.5).astype(np.uint8)
+        image.paste(Image.fromarray(blended, 'RGB'), box)
+        return image
+
+
+def content_digest(data):
+    """
+    Short hash of an encoded image, the last part of its image id.
+    """
+    return hashlib.blake2b(data, digest_size=5).hexdigest()
+
+
+def encode_preview(image, preview_format, quality):
+    """
+    Encodes the lossy preview. Telegram recompresses photos anyway, so a tuned JPEG/WebP looks the same
+    in the chat at a fraction of the PNG's upload size.
+    """
+    buffer = io.BytesIO()
+    if preview_format == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def process_response(body, watermark, preview_format=None, preview_quality=85, timer=metrics.timer):
+    """
+    Everything between the API's response and a finished image, all in memory: parse the JSON and
+    base64, watermark, encode the PNG and the preview. `body` is the response body (bytes or a buffer).
+    Returns (seed, png, preview or None, digest of the png). `timer(stage)` times each stage.
+    """
+    with timer("decode"):
+        artifact = json.loads(bytes(body) if isinstance(body, memoryview) else body)["artifacts"][0]
+        original_image = Image.open(io.BytesIO(base64.b64decode(artifact["base64"])))
+        original_image.load()  # PIL decodes lazily, make the decode happen inside the timer
+    # Apply a watermark to the generated image the logo one in update 2.0.1 aka biggest update
+    with timer("watermark"):
+        try:
+            image_with_watermark = watermark.apply(original_image, transparency=25)
+        except Exception as e:
+            # Log any errors and keep the original image without changes
+            print(f"Error adding watermark: {e}")
+            image_with_watermark = original_image
+    buffer = io.BytesIO()
+    with timer("encode"):
+        image_with_watermark.save(buffer, format="PNG")
+    png = buffer.getvalue()
+    preview = None
+    if preview_format in ("jpeg", "webp"):
+        with timer("preview"):
+            preview = encode_preview(image_with_watermark, preview_format, preview_quality)
+    return artifact["seed"], png, preview, content_digest(png)
+
+
+class PostProcessError(Exception):
+    """
+    Raised by a pool worker when post-processing fails, with the stage that failed.
+    """
+    def __init__(self, stage, message):
+        super().__init__(stage, message)
+        self.stage = stage
+        self.message = message
+
+    def __str__(self):
+        return f"{self.stage}: {self.message}"
+
+
+class StageTimes:
+    """
+    Collects stage timings inside a pool worker, where the bot's metrics don't exist. They travel back
+    with the result and are recorded in the bot process.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.failed = None
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.failed = stage
+            raise
+        self.seconds[stage] = time.perf_counter() - started
+
+
+# State of a pool worker process, set up once by _init_worker
+_worker = None
+
+
+def _init_worker(logo_path, sizes, preview_format, preview_quality):
+    """
+    Runs once in every pool process: loads the logo and prepares it for every output size,
+    so the first image a worker handles is as fast as the rest.
+    """
+    global _worker
+    watermark = Watermark(logo_path)
+    watermark.prewarm(sizes, transparency=25)
+    _worker = {"watermark": watermark, "preview_format": preview_format, "preview_quality": preview_quality, "buffers": {}}
+
+
+def _ping():
+    return os.getpid()
+
+
+def _attach(name):
+    # Each worker opens a slot's shared memory once and keeps it, slots are reused for every image
+    buffers = _worker["buffers"]
+    if name not in buffers:
+        buffers[name] = shared_memory.SharedMemory(name=name)
+    return buffers[name]
+
+
+def _run(body, output_name):
+    """
+    Post-processes one response in a pool worker. The response is read from shared memory (or passed
+    as bytes when it didn't fit), the PNG and preview are written into the slot's output buffer.
+    Returns (seed, png length, preview length, digest, stage timings, images that didn't fit or None).
+    """
+    times = StageTimes()
+    try:
+        seed, png, preview, digest = process_response(
+            body, _worker["watermark"], _worker["preview_format"], _worker["preview_quality"], timer=times.timer,
+        )
+    except Exception as e:
+        raise PostProcessError(times.failed or "decode", str(e)) from None
+    preview = preview or b""
+    output = _attach(output_name)
+    if len(png) + len(preview) > output.size:
+        return seed, len(png), len(preview), digest, times.seconds, (png, preview)
+    output.buf[:len(png)] = png
+    output.buf[len(png):len(png) + len(preview)] = preview
+    return seed, len(png), len(preview), digest, times.seconds, None
+
+
+def _run_shared(input_name, size, output_name):
+    return _run(_attach(input_name).buf[:size], output_name)
+
+
+class _Slot:
+    """
+    A pair of shared memory buffers, one for a response on its way to a worker and one for the images coming back.
+    """
+    def __init__(self, size):
+        self.input = shared_memory.SharedMemory(create=True, size=size)
+        self.output = shared_memory.SharedMemory(create=True, size=size)
+
+    def close(self):
+        for buffer in (self.input, self.output):
+            buffer.close()
+            buffer.unlink()
+
+
+def default_workers():
+    """
+    POSTPROCESS_WORKERS, or one worker per core this process may run on.
+    """
+    if os.getenv('POSTPROCESS_WORKERS') is not None:
+        return int(os.getenv('POSTPROCESS_WORKERS'))
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+
+class PostProcessPool:
+    """
+    Post-processes API responses in a pool of warm worker processes, so decoding, watermarking and
+    encoding run on other cores instead of holding the GIL the event loop needs.
+
+    Responses and results move through reusable shared memory slots (two per worker), so an image
+    crosses the process boundary without being pickled; only lengths and timings are. A slot is
+    handed out again only after its worker is done with it, even when the caller gave up waiting.
+    """
+    def __init__(self, workers, logo_path, sizes, preview_format=None, preview_quality=85, slot_bytes=SLOT_BYTES):
+        self.workers = workers
+        self.initargs = (logo_path, list(sizes), preview_format, preview_quality)
+        self.slot_bytes = slot_bytes
+        self._executor = None
+        self._slots = []
+        self._free = None
+        self.broken = False
+
+    @property
+    def running(self):
+        return self._executor is not None and not self.broken
+
+    async def start(self):
+        """
+        Starts every worker process and waits until each has run its initializer.
+        """
+        if self._executor is not None:
+            return
+        # spawn: the bot process has threads (database, asyncio.to_thread), forking it is not safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=self.initargs,
+        )
+        self._free = asyncio.Queue()
+        for _ in range(self.workers * 2):
+            slot = _Slot(self.slot_bytes)
+            self._slots.append(slot)
+            self._free.put_nowait(slot)
+        # Submitted together, each ping starts one more process (an idle worker would take it otherwise)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        pids = await asyncio.gather(*(loop.run_in_executor(self._executor, _ping) for _ in range(self.workers)))
+        logging.info(f"Post-processing pool: {len(set(pids))} processes ready in {time.perf_counter() - started:.1f}s")
+
+    async def process(self, body):
+        """
+        Post-processes a response body (bytes). Returns (seed, png, preview or None, digest).
+        Raises PostProcessError when the image can't be processed and BrokenProcessPool when a worker died.
+        """
+        slot = await self._free.get()
+        loop = asyncio.get_running_loop()
+        try:
+            if len(body) <= self.slot_bytes:
+                slot.input.buf[:len(body)] = body
+                job = self._executor.submit(_run_shared, slot.input.name, len(body), slot.output.name)
+            else:
+                job = self._executor.submit(_run, body, slot.output.name)
+        except BaseException:
+            self._free.put_nowait(slot)
+            raise
+        try:
+            seed, png_size, preview_size, digest, seconds, overflow = await asyncio.wrap_future(job)
+        except asyncio.CancelledError:
+            # The worker may still be writing into the slot, free it once the worker is done
+            job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._free.put_nowait, slot))
+            raise
+        except BaseException as e:
+            self._free.put_nowait(slot)
+            if isinstance(e, PostProcessError):
+                metrics.error(e.stage)
+            elif isinstance(e, BrokenProcessPool):
+                self.broken = True
+            raise
+        try:
+            if overflow is not None:
+                png, preview = overflow
+            else:
+                png = bytes(slot.output.buf[:png_size])
+                preview = bytes(slot.output.buf[png_size:png_size + preview_size])
+        finally:
+            self._free.put_nowait(slot)
+        for stage, duration in seconds.items():
+            metrics.observe(stage, duration)
+        return seed, png, preview or None, digest
+
+    async def close(self):
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown, True, cancel_futures=True)
+            self._executor = None
+        for slot in self._slots:
+            slot.close()
+        self._slots = []
@@ -0,0 +1,252 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import collections
+from email.utils import parsedate_to_datetime
+import httpx
+
+
+class UpstreamError(Exception):
+    """
+    The API answered with an error status. `status` is the HTTP status code.
+    """
+    def __init__(self, status, text=""):
+        super().__init__(f"Non-200 response: {status} {text[:200]}")
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    """
+    The circuit breaker is open: the API failed repeatedly and calls are refused without trying.
+    """
+    def __init__(self, retry_in):
+        super().__init__(f"Circuit open, next attempt in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+def retry_after_seconds(value):
+    """
+    Parses a Retry-After header, either seconds or an HTTP date. Returns None when missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Bounded retries with exponential backoff and full jitter: attempt n waits a random time
+    between 0 and min(max_delay, base_delay * 2**n). A Retry-After from the server is honored
+    as the minimum wait, unless it is longer than max_delay, then the call gives up.
+    """
+    def __init__(self, attempts=None, base_delay=None, max_delay=None):
+        self.attempts = attempts if attempts is not None else int(os.getenv('STABILITY_RETRIES', '3'))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('STABILITY_BACKOFF_BASE', '1'))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('STABILITY_BACKOFF_MAX', '30'))
+
+    @staticmethod
+    def retryable(status):
+        return status == 429 or status >= 500
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns how long to wait before retry number `attempt` (0 based), or None to give up.
+        """
+        if attempt >= self.attempts:
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            return max(retry_after, backoff)
+        return backoff
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and refuses calls for `reset_timeout`
+    seconds. After that one probe call is let through (half open): success closes the circuit,
+    failure opens it again.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = failure_threshold if failure_threshold is not None else int(os.getenv('STABILITY_BREAKER_THRESHOLD', '5'))
+        self.reset_timeout = reset_timeout if reset_timeout is not None else float(os.getenv('STABILITY_BREAKER_RESET', '30'))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError when the call must not be made.
+        """
+        if self.state == self.CLOSED:
+            return
+        if self.state == self.OPEN:
+            retry_in = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if retry_in > 0:
+                raise CircuitOpenError(retry_in)
+            self.state = self.HALF_OPEN
+        if self._probing:
+            raise CircuitOpenError(self.reset_timeout)
+        self._probing = True
+
+    def release(self):
+        """
+        Gives up the probe without a verdict (the call was cancelled or failed for reasons unrelated to the API),
+        so the next call probes instead.
+        """
+        self._probing = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+                logging.warning(f"Stability API circuit opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the last `window` successful calls.
+    """
+    def __init__(self, window=200):
+        self._samples = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, fraction):
+        ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class ResilientCaller:
+    """
+    Runs API calls with retries (429/5xx and network errors), a circuit breaker and, when
+    `hedge_percentile` is set, hedging: if a call is slower than that percentile of recent calls,
+    a second identical call is started and whichever answers first wins. Hedges are only sent while
+    `semaphore` has a free slot, so they never queue behind real work or pile up under load.
+    """
+    MIN_HEDGE_SAMPLES = 20  # calls to observe before the percentile is trusted
+
+    def __init__(self, retry=None, breaker=None, hedge_percentile=None, semaphore=None):
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        hedge_percentile = hedge_percentile if hedge_percentile is not None else float(os.getenv('STABILITY_HEDGE_PERCENTILE', '0'))
+        self.hedge_fraction = hedge_percentile / 100.0
+        self.semaphore = semaphore
+        self.latency = LatencyTracker()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    async def call(self, send):
+        """
+        Awaits `send()` (a factory returning an httpx.Response) until it succeeds or retrying is no use.
+        Returns the 200 response, raises UpstreamError, CircuitOpenError or the last network error otherwise.
+        """
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            retry_after = None
+            try:
+                response = await self._send_hedged(send)
+            except httpx.TransportError as e:  # connection refused/reset, timeouts
+                self.breaker.record_failure()
+                error = e
+            except BaseException:
+                # Cancelled (by the scheduler, generate_images or shutdown) or a bug: says nothing about the API,
+                # but a half-open probe must not stay taken or every later call is refused
+                self.breaker.release()
+                raise
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    return response
+                error = UpstreamError(response.status_code, response.text)
+                if not self.retry.retryable(response.status_code):
+                    # The API is up and refused this request (bad prompt, bad key...), retrying won't help
+                    self.breaker.record_success()
+                    raise error
+                if response.status_code == 429:
+                    # Rate limited: the API is healthy, we are just too fast
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                retry_after = retry_after_seconds(response.headers.get("retry-after"))
+            delay = self.retry.delay(attempt, retry_after)
+            if delay is None:
+                raise error
+            attempt += 1
+            self.retries += 1
+            logging.info(f"Stability API call failed ({error}), retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _send(self, send):
+        if self.semaphore is None:
+            started = time.monotonic()
+            response = await send()
+        else:
+            async with self.semaphore:
+                started = time.monotonic()
+                response = await send()
+        if response.status_code == 200:
+            self.latency.add(time.monotonic() - started)
+        return response
+
+    async def _send_hedged(self, send):
+        if not self.hedge_fraction or len(self.latency) < self.MIN_HEDGE_SAMPLES:
+            return await self._send(send)
+        primary = asyncio.create_task(self._send(send))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.latency.percentile(self.hedge_fraction))
+            if done or (self.semaphore is not None and self.semaphore.locked()):
+                return await primary
+            self.hedges += 1
+            hedge = asyncio.create_task(self._send(send))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Take the first good answer, even when the other one failed in the same round
+                for task in tasks:
+                    if task in done and task.exception() is None and task.result().status_code == 200:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Neither got a 200: hand back an API answer if there is one, it tells the retry loop more
+            answered = [task for task in tasks if task.exception() is None]
+            return (answered or tasks)[0].result()  # re-raises the primary's error if both failed
+        finally:
+            # Also reached when our caller is cancelled: no attempt may outlive it
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,172 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import defaultdict, deque
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the generation queue is already at its limit.
+    """
+
+
+class _Job:
+    def __init__(self, user_id, priority, seq, job_factory):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.job_factory = job_factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.task = None
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GenerationScheduler:
+    """
+    Sits between BotHandler and ImageGen and decides when each render may start.
+
+    - at most `max_concurrency` renders run at once
+    - a single user never has more than `per_user_limit` renders running, so one user can't take all capacity
+    - queued jobs start in priority order (admins first), then first come first served
+    - once `max_queue` jobs are waiting, new submissions are refused with QueueFullError
+    """
+    ADMIN = 0
+    USER = 1
+
+    def __init__(self, max_concurrency=None, per_user_limit=None, max_queue=None):
+        self.max_concurrency = max_concurrency or int(os.getenv('GENERATION_MAX_CONCURRENCY', '4'))
+        self.per_user_limit = per_user_limit or int(os.getenv('GENERATION_PER_USER_LIMIT', '2'))
+        self.max_queue = max_queue or int(os.getenv('GENERATION_MAX_QUEUE', '50'))
+        self._queue = []  # heap of _Job, cancelled jobs are dropped lazily
+        self._queued = 0
+        self._running = 0
+        self._running_per_user = defaultdict(int)
+        self._seq = itertools.count()
+        # Wait-time stats
+        self.completed = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+        self._total_wait = 0.0
+        self._recent_waits = deque(maxlen=500)
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    @property
+    def running(self):
+        return self._running
+
+    def can_accept(self, count=1):
+        """
+        Returns True if `count` more jobs fit in the queue (used to turn a request away before it starts).
+        """
+        free_slots = max(self.max_concurrency - self._running, 0)
+        return self._queued + max(count - free_slots, 0) <= self.max_queue
+
+    def position(self, job):
+        """
+        Returns how many queued jobs will start before `job` (0 means it is next).
+        """
+        return sum(1 for other in self._queue if not other.cancelled and other < job)
+
+    async def submit(self, user_id, job_factory, priority=USER, on_queued=None):
+        """
+        Queues `job_factory` (an async callable) and returns its result once it has run.
+        If the job has to wait, `on_queued` is awaited with its queue position (1-based). It only notifies:
+        when it fails (e.g. the message can't be sent) the error is logged and the job still runs.
+        """
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError("The generation queue is full, please try again later.")
+        job = _Job(user_id, priority, next(self._seq), job_factory)
+        heapq.heappush(self._queue, job)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            if job.task is None and on_queued is not None:
+                try:
+                    await on_queued(self.position(job) + 1)
+                except Exception as e:
+                    logging.error(f"Queue notification failed: {e}")
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            # The caller gave up: drop the job if it is still waiting, otherwise stop the render
+            if job.task is None:
+                job.cancelled = True
+                self._queued -= 1
+            else:
+                job.task.cancel()
+            raise
+
+    def _dispatch(self):
+        """
+        Starts queued jobs while there is capacity, skipping users that are at their own limit.
+        """
+        skipped = []
+        while self._running < self.max_concurrency and self._queue:
+            job = heapq.heappop(self._queue)
+            if job.cancelled:
+                continue
+            if self._running_per_user[job.user_id] >= self.per_user_limit:
+                skipped.append(job)
+                continue
+            self._start(job)
+        for job in skipped:
+            heapq.heappush(self._queue, job)
+
+    def _start(self, job):
+        self._queued -= 1
+        self._running += 1
+        self._running_per_user[job.user_id] += 1
+        waited = time.monotonic() - job.queued_at
+        self._total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent_waits.append(waited)
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            result = await job.job_factory()
+            if not job.future.done():
+                job.future.set_result(result)
+        except BaseException as e:
+            if not job.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    job.future.cancel()
+                else:
+                    job.future.set_exception(e)
+        finally:
+            self.completed += 1
+            self._running -= 1
+            self._running_per_user[job.user_id] -= 1
+            if not self._running_per_user[job.user_id]:
+                del self._running_per_user[job.user_id]
+            self._dispatch()
+
+    def stats(self):
+        """
+        Returns a snapshot of queue depth, running jobs and wait times (seconds).
+        """
+        waits = sorted(self._recent_waits)
+        started = self.completed + self._running
+        return {
+            "queue_depth": self._queued,
+            "running": self._running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait": self._total_wait / started if started else 0.0,
+            "p95_wait": waits[min(int(len(waits) * 0.95), len(waits) - 1)] if waits else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+scheduler = GenerationScheduler()
@@ -0,0 +1,375 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from database import database, connect, migrate, DB_FILE, SERVED_GENERATIONS, STORED_BYTES, MISSING_BYTES, SET_BYTES, EVICT_GENERATION
+
+
+def shard_key(image_id, prefix="image", extension="png"):
+    """
+    Returns the storage key of an image: `image/ab/cd/<image_id>.png`, where ab/cd come from a hash of the id.
+    Two levels of 256 folders keep every folder small (a million images is ~15 per folder), so listings stay fast.
+    """
+    digest = hashlib.sha1(image_id.encode("utf-8")).hexdigest()
+    return f"{prefix}/{digest[:2]}/{digest[2:4]}/{image_id}.{extension}"
+
+
+class StorageBackend:
+    """
+    Where image files live, addressed by key (`image/ab/cd/<image_id>.png`). Calls are blocking,
+    ImageStore runs them in worker threads. To keep images somewhere else implement these five methods.
+    """
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Returns the bytes stored under `key`, or None.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """
+        Removes `key`. Removing a key that doesn't exist is not an error.
+        """
+        raise NotImplementedError
+
+    def size(self, key):
+        """
+        Returns the size of `key` in bytes, or None when it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def keys(self, prefix):
+        """
+        Yields every key under `prefix`.
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """
+    Keeps images as files below `root`, a key is the file's path relative to it. The default root is
+    the bot's folder, so keys are also the paths generate_html.py links to (`bot/image/...`).
+    """
+    def __init__(self, root="."):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a reader never sees a half-written file
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def keys(self, prefix):
+        folders = [self.path(prefix)]
+        while folders:
+            try:
+                entries = os.scandir(folders.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        folders.append(entry.path)
+                    elif not entry.name.endswith(".tmp"):
+                        yield os.path.relpath(entry.path, self.root).replace(os.sep, "/")
+
+
+class ObjectStore:
+    """
+    The calls an object store client (S3, GCS, MinIO...) needs to provide for ObjectStorage.
+    Wrap the SDK's client in a class with these five methods.
+    """
+    def put_object(self, key, data):
+        raise NotImplementedError
+
+    def get_object(self, key):
+        """
+        Returns the object's bytes, or None when there is no such object.
+        """
+        raise NotImplementedError
+
+    def delete_object(self, key):
+        raise NotImplementedError
+
+    def head_object(self, key):
+        """
+        Returns the object's size in bytes, or None when there is no such object.
+        """
+        raise NotImplementedError
+
+    def list_objects(self, prefix):
+        """
+        Yields the key of every object under `prefix`.
+        """
+        raise NotImplementedError
+
+
+class MemoryObjectStore(ObjectStore):
+    """
+    An in-process stand-in for an object store, for benchmarks and trying out ObjectStorage without a bucket.
+    Everything is lost when the process exits.
+    """
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, key, data):
+        with self._lock:
+            self._objects[key] = bytes(data)
+
+    def get_object(self, key):
+        with self._lock:
+            return self._objects.get(key)
+
+    def delete_object(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def head_object(self, key):
+        with self._lock:
+            data = self._objects.get(key)
+        return None if data is None else len(data)
+
+    def list_objects(self, prefix):
+        with self._lock:
+            keys = [key for key in self._objects if key.startswith(prefix)]
+        yield from keys
+
+
+class ObjectStorage(StorageBackend):
+    """
+    Keeps images in an object store. Keys are used as object names, under an optional `prefix`.
+    """
+    def __init__(self, store, prefix=""):
+        self.store = store
+        self.prefix = prefix
+
+    def put(self, key, data):
+        self.store.put_object(self.prefix + key, data)
+
+    def get(self, key):
+        return self.store.get_object(self.prefix + key)
+
+    def delete(self, key):
+        self.store.delete_object(self.prefix + key)
+
+    def size(self, key):
+        return self.store.head_object(self.prefix + key)
+
+    def keys(self, prefix):
+        for key in self.store.list_objects(self.prefix + prefix):
+            yield key[len(self.prefix):]
+
+
+def backend_from_env():
+    """
+    Returns the backend named by IMAGE_STORAGE: "local" (files below the bot's folder) or "memory" (MemoryObjectStore).
+    """
+    kind = os.getenv('IMAGE_STORAGE', 'local').lower()
+    if kind == "memory":
+        return ObjectStorage(MemoryObjectStore())
+    if kind != "local":
+        logging.warning(f"Unknown IMAGE_STORAGE {kind!r}, using local files")
+    return LocalStorage(os.getenv('IMAGE_STORAGE_ROOT', '.'))
+
+
+class ImageStore:
+    """
+    Saves finished images under hash-sharded keys and enforces the retention budget.
+
+    Every image's size and when it was last sent to someone (`bytes`, `last_served_at` in the
+    generations table) are tracked. A sweep every `sweep_interval` seconds evicts images not served
+    for `max_age_days`, then the least recently served ones until the total is within `max_bytes`.
+    An evicted image keeps its record (prompt, price, Telegram file id), only its `path` is cleared,
+    and that happens before the file is deleted, so no record ever points at a deleted file.
+    """
+    PREFIX = "image"
+
+    def __init__(self, backend=None, database=database, max_bytes=None, max_age_days=None, sweep_interval=None):
+        self.backend = backend or backend_from_env()
+        self.database = database
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('IMAGE_STORAGE_MAX_BYTES', '0'))
+        self.max_age_days = max_age_days if max_age_days is not None else float(os.getenv('IMAGE_MAX_AGE_DAYS', '0'))
+        self.sweep_interval = sweep_interval if sweep_interval is not None else float(os.getenv('STORAGE_SWEEP_INTERVAL', '600'))
+        self.stored_bytes = None  # as of the last sweep
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self._task = None
+
+    def key_for(self, image):
+        return shard_key(image.image_id, self.PREFIX)
+
+    def save(self, image):
+        """
+        Stores the image's PNG and returns its key. Blocking, runs in a worker thread.
+        """
+        key = self.key_for(image)
+        self.backend.put(key, image.data)
+        return key
+
+    async def read(self, key):
+        return await asyncio.to_thread(self.backend.get, key)
+
+    def served(self, image_ids):
+        """
+        Records that `image_ids` were just sent to a user, which keeps them from being evicted first.
+        The sender doesn't wait for the write.
+        """
+        if not image_ids:
+            return
+        self.database.write_behind(self.database.set_served(image_ids), "record served images")
+
+    async def _backfill_sizes(self, limit=500):
+        """
+        Fills in `bytes` for records saved before sizes were tracked, so they count against the budget.
+        """
+        rows = await self.database.fetchall(MISSING_BYTES, (limit,))
+        if not rows:
+            return
+        sizes = await asyncio.to_thread(lambda: [(self.backend.size(path), image_id) for image_id, path in rows])
+        await self.database.run(lambda conn: conn.executemany(SET_BYTES, [(size or 0, image_id) for size, image_id in sizes]), write=True)
+
+    def _select(self, conn):
+        """
+        Picks what to evict: expired images, then the least recently served until the total fits the budget.
+        """
+        total = conn.execute(STORED_BYTES).fetchone()[0]
+        cutoff = None
+        if self.max_age_days > 0:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - self.max_age_days * 86400))
+        victims = []
+        # Ordered by last use, so expired images come first and the walk stops at the first image worth keeping
+        for image_id, path, size, served_at in conn.execute(SERVED_GENERATIONS):
+            expired = cutoff is not None and served_at < cutoff
+            if not expired and (self.max_bytes <= 0 or total <= self.max_bytes):
+                break
+            victims.append((image_id, path, size or 0))
+            total -= size or 0
+        return total, victims
+
+    async def sweep(self):
+        """
+        Evicts what the retention policy says must go. Returns (images evicted, bytes freed).
+        Safe to run from several replicas at once: a record is only evicted by whoever cleared its path.
+        """
+        await self._backfill_sizes()
+        total, victims = await self.database.run(self._select)
+        evicted = []
+        if victims:
+            def clear(conn):
+                return [(path, size) for image_id, path, size in victims
+                        if conn.execute(EVICT_GENERATION, (image_id, path)).rowcount]
+            evicted = await self.database.run(clear, write=True)
+            # The records no longer point at these files, now they can go
+            await asyncio.to_thread(lambda: [self.backend.delete(path) for path, _ in evicted])
+        freed = sum(size for _, size in evicted)
+        self.stored_bytes = total
+        self.evicted += len(evicted)
+        self.evicted_bytes += freed
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} images ({freed / 1024 / 1024:.1f} MB), {total / 1024 / 1024:.1f} MB stored")
+        return len(evicted), freed
+
+    def start(self):
+        """
+        Starts sweeping in the background. Does nothing when neither a byte nor an age budget is set.
+        """
+        if self.max_bytes <= 0 and self.max_age_days <= 0:
+            return
+
+        async def sweep_forever():
+            while True:
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logging.error(f"Storage sweep failed: {e}")
+                await asyncio.sleep(self.sweep_interval)
+        if self._task is None:
+            self._task = asyncio.create_task(sweep_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def reconcile(conn, backend, prefix=ImageStore.PREFIX, dry_run=False):
+    """
+    Brings the generations table and the stored files back in line, e.g. after a crash between a
+    sweep's two steps or files deleted by hand: records whose file is gone lose their path, files
+    no record points at are deleted. Run it while the bot is stopped, a running bot saves files
+    a moment before recording them. Returns (records cleared, files deleted).
+    """
+    referenced = set()
+    cleared = []
+    for image_id, path in conn.execute("SELECT image_id, path FROM generations WHERE path IS NOT NULL").fetchall():
+        if backend.size(path) is None:
+            cleared.append(image_id)
+        else:
+            referenced.add(path)
+    orphans = [key for key in backend.keys(prefix) if key.endswith(".png") and key not in referenced]
+    if not dry_run:
+        conn.execute("BEGIN")
+        conn.executemany("UPDATE generations SET path = NULL WHERE image_id = ?", [(image_id,) for image_id in cleared])
+        conn.execute("COMMIT")
+        for key in orphans:
+            backend.delete(key)
+    return len(cleared), len(orphans)
+
+
+# Maintenance:  python storage.py sweep   /   python storage.py reconcile [--dry-run]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Image storage maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("sweep", help="apply IMAGE_STORAGE_MAX_BYTES / IMAGE_MAX_AGE_DAYS once")
+    reconcile_parser = subcommands.add_parser("reconcile", help="drop records of missing files and files without a record")
+    reconcile_parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+
+    if args.command == "sweep":
+        async def sweep_once():
+            database.open()
+            try:
+                store = ImageStore()
+                count, freed = await store.sweep()
+                print(f"Evicted {count} images ({freed / 1024 / 1024:.1f} MB), {store.stored_bytes / 1024 / 1024:.1f} MB stored")
+            finally:
+                await database.aclose()
+        asyncio.run(sweep_once())
+    else:
+        conn = connect(DB_FILE)
+        migrate(conn)
+        cleared, deleted = reconcile(conn, backend_from_env(), dry_run=args.dry_run)
+        verb = "Would clear" if args.dry_run else "Cleared"
+        print(f"{verb} {cleared} records of missing files, {'would delete' if args.dry_run else 'deleted'} {deleted} files without a record")
+        conn.close()
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import zlib
+import queue
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+# Longest request body accepted on the webhook, Telegram updates are a few KB at most
+MAX_BODY = 1024 * 1024
+
+STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    429: "Too Many Requests", 500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+}
+
+
+async def read_request(reader, max_body=MAX_BODY):
+    """
+    Reads one HTTP/1.1 request from `reader`. Returns (method, path, headers, body), or None when the
+    client closed the connection. Only what webhooks need is supported: no chunked bodies, no continuation lines.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def http_response(status, body=b"", content_type="text/plain; charset=utf-8", keep_alive=True, headers=None):
+    """
+    Returns the bytes of a complete HTTP/1.1 response. `headers` are extra response headers.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        + "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        + "\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+async def serve_http(handle, host, port, max_body=MAX_BODY):
+    """
+    Starts a small asyncio HTTP server. `handle(method, path, headers, body)` is awaited for every
+    request and returns (status, body, content_type), optionally followed by a dict of extra
+    response headers. Keep-alive connections are reused.
+    """
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, max_body)
+                except (ValueError, asyncio.IncompleteReadError):
+                    writer.write(http_response(400, keep_alive=False))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response_body, content_type, *extra = await handle(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(http_response(status, response_body, content_type, keep_alive, extra[0] if extra else None))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+
+def routing_key(update):
+    """
+    Returns the id the update is routed by: its chat, or the user for updates without a chat
+    (inline queries, pre-checkout...). All updates of one conversation land on the same worker.
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user and "id" in user:
+            return user["id"]
+    return update.get("update_id", 0)
+
+
+def worker_for(key, workers):
+    # crc32 is stable across processes and restarts, unlike hash()
+    return zlib.crc32(str(key).encode("ascii")) % workers
+
+
+def run_worker(index, updates):
+    """
+    Entry point of a worker process: runs the bot application without an updater and feeds it the
+    updates the router sends over `updates`.
+    """
+    asyncio.run(_worker_main(index, updates))
+
+
+async def _worker_main(index, updates):
+    # Imported here so every worker process builds its own bot, database thread and HTTP clients
+    from telegram import Update
+    from main import BotHandler
+    from database import database
+
+    database.open(migrate=False)  # the router migrated before starting the workers
+    bot_handler = BotHandler(use_updater=False, worker=index)
+    application = bot_handler.application
+    await application.initialize()
+    await bot_handler.post_init(application)
+    await application.start()
+    logging.info(f"Webhook worker {index} ready")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(json.loads(data), application.bot)
+            except Exception as e:
+                logging.error(f"Dropping malformed update: {e}")
+                continue
+            await application.update_queue.put(update)
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot_handler.shutdown(application)
+
+
+class WebhookRouter:
+    """
+    Receives Telegram webhook calls and hands each update to one of `workers` bot processes.
+    Updates are routed by chat, so a conversation always runs in the same process and its
+    in-memory state stays consistent.
+
+    Workers are supervised: one that died (crash, OOM kill) is restarted with the updates it hadn't taken yet.
+    A worker that keeps dying is restarted at most every RESTART_BACKOFF seconds; meanwhile its updates are
+    answered with 503, so Telegram delivers them again later instead of them being acknowledged and lost.
+    """
+    RESTART_BACKOFF = 10
+    SUPERVISE_INTERVAL = 5
+
+    def __init__(self, host="0.0.0.0", port=8443, workers=1, path="/telegram", secret_token=None):
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.path = path
+        self.secret_token = secret_token
+        self._queues = []
+        self._processes = []
+        self._restarted_at = []
+        self.restarts = 0
+
+    def _spawn(self, index):
+        context = multiprocessing.get_context("spawn")
+        updates = context.Queue()
+        # Not daemonic, daemonic processes can't start their post-processing pool
+        process = context.Process(target=run_worker, args=(index, updates), name=f"bot-worker-{index}")
+        process.start()
+        return updates, process
+
+    def start_workers(self):
+        # Migrated once here, not by each worker as it starts (they would all do it at the same moment)
+        from database import DB_FILE, connect, migrate
+        conn = connect(DB_FILE)
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+        # Workers inherit the environment: share the cores among their post-processing pools
+        os.environ.setdefault("POSTPROCESS_WORKERS", str(max(1, (os.cpu_count() or 1) // self.workers)))
+        for index in range(self.workers):
+            updates, process = self._spawn(index)
+            self._queues.append(updates)
+            self._processes.append(process)
+            self._restarted_at.append(float("-inf"))
+
+    def ensure_worker(self, index):
+        """
+        Returns True when worker `index` is running. A dead one is restarted first, unless it was
+        restarted less than RESTART_BACKOFF seconds ago; then it returns False.
+        """
+        process = self._processes[index]
+        if process.is_alive():
+            return True
+        now = time.monotonic()
+        if now - self._restarted_at[index] < self.RESTART_BACKOFF:
+            return False
+        self._restarted_at[index] = now
+        self.restarts += 1
+        logging.error(f"Webhook worker {index} died (exit code {process.exitcode}), restarting it")
+        old_updates = self._queues[index]
+        updates, self._processes[index] = self._spawn(index)
+        # Hand over what the dead worker hadn't taken yet, those updates were already acknowledged
+        while True:
+            try:
+                updates.put(old_updates.get_nowait())
+            except queue.Empty:
+                break
+        old_updates.close()
+        self._queues[index] = updates
+        return True
+
+    async def supervise(self):
+        # Restarts dead workers even when no update for them comes in
+        while True:
+            await asyncio.sleep(self.SUPERVISE_INTERVAL)
+            for index in range(self.workers):
+                self.ensure_worker(index)
+
+    def stop_workers(self):
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+    async def handle(self, method, path, headers, body):
+        if path.split("?", 1)[0] != self.path:
+            return 404, "not found", "text/plain"
+        if method != "POST":
+            return 405, "POST only", "text/plain"
+        if self.secret_token and headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return 403, "forbidden", "text/plain"
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400, "invalid JSON", "text/plain"
+        if not isinstance(update, dict):
+            return 400, "invalid update", "text/plain"
+        index = worker_for(routing_key(update), self.workers)
+        if not self.ensure_worker(index):
+            # Not acknowledged, Telegram delivers it again later
+            return 503, "worker restarting", "text/plain", {"Retry-After": str(self.RESTART_BACKOFF)}
+        # Acknowledge right away, the worker processes the update on its own time
+        self._queues[index].put(body.decode("utf-8"))
+        return 200, "ok", "text/plain"
+
+    async def set_webhook(self, token, url):
+        from telegram import Bot
+        async with Bot(token) as bot:
+            await bot.set_webhook(url=url.rstrip("/") + self.path, secret_token=self.secret_token)
+        logging.info(f"Webhook set to {url.rstrip('/')}{self.path}")
+
+    async def serve(self, token=None, url=None):
+        if token and url:
+            await self.set_webhook(token, url)
+        self.start_workers()
+        supervisor = asyncio.create_task(self.supervise())
+        server = await serve_http(self.handle, self.host, self.port)
+        logging.info(f"Webhook listening on {self.host}:{self.port}{self.path} with {self.workers} workers")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+        try:
+            await stop.wait()
+        finally:
+            supervisor.cancel()
+            server.close()
+            await server.wait_closed()
+            await asyncio.to_thread(self.stop_workers)
+
+
+def serve(host=None, port=None, workers=None, url=None):
+    """
+    Runs the bot in webhook mode. Settings not passed in come from the environment.
+    """
+    router = WebhookRouter(
+        host=host or os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+        port=port or int(os.getenv("WEBHOOK_PORT", "8443")),
+        workers=workers or int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1))),
+        path=os.getenv("WEBHOOK_PATH", "/telegram"),
+        secret_token=os.getenv("WEBHOOK_SECRET") or None,
+    )
+    asyncio.run(router.serve(os.getenv("TELEGRAM_BOT_TOKEN"), url or os.getenv("WEBHOOK_URL")))
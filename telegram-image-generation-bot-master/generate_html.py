@@ -1,15 +1,42 @@
 import os
 import json
+import html
+import re
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource  # peak memory reporting, not available on Windows
+except ImportError:
+    resource = None
+from PIL import Image, features
+from bot.database import connect, migrate, query_generations, get_generation
 
-# Folder containing the images and metadata
-image_folder = os.path.join("bot", "image")
+# Bot database holding the generation metadata
+db_file = os.path.join("bot", "bot_users.db")
 
 # Output HTML file
 output_file = "index.html"
 
+# Small web versions of the images, named by the hash of their source so they are only encoded once
+thumbs_folder = "thumbs"
+thumb_width = 400  # cards are 300px wide, a bit extra keeps them sharp on dense screens
+thumb_format = "webp" if features.check("webp") else "jpeg"
+
+# Search index and paged card data loaded by the page's script
+shards_folder = "gallery"
+page_size = 48
+
+# Folder with the generated images, walked by the streaming build
+image_folder = os.path.join("bot", "image")
+
+# Cards rendered by earlier builds, keyed by image id, so a rebuild only renders new or changed images
+manifest_file = "gallery_manifest.json"
+
 # Start of the HTML structure
 # I mean there is css code first for style design ig you do not need comments on it :/
-html_content = """
+html_head = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -123,6 +150,24 @@ html_content = """
             visibility: visible;
             opacity: 1;
         }
+        .pager {
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            gap: 15px;
+            color: #444;
+        }
+        .pager button {
+            padding: 8px 16px;
+            border: 1px solid #ddd;
+            border-radius: 30px;
+            background: #fff;
+            cursor: pointer;
+        }
+        .pager button:disabled {
+            cursor: default;
+            opacity: 0.5;
+        }
         h1 {
             width: 100%;
             text-align: center;
@@ -139,31 +184,157 @@ html_content = """
             color: #444;
         }
     </style>
-    <script> // JavaScript function to filter gallery items based on user input
-        function filterGallery() {
+    <script> // JavaScript that filters and pages through the prebuilt search index (gallery/index.js)
+        // Cards are rendered only for the current page; their data is loaded one shard at a time.
+        let galleryData = null;
+        const shards = {};
+        const shardWaiters = {};
+        const decodedPostings = new Map();
+        let tokenKeys = [];
+        let results = null;  // sorted doc ids matching the filters, null means "everything"
+        let page = 0;
+        let filterTimer = null;
+
+        function galleryIndex(data) {
+            galleryData = data;
+            tokenKeys = Object.keys(data.tokens);
+        }
+
+        function galleryShard(number, docs) {
+            shards[number] = docs;
+            (shardWaiters[number] || []).forEach(resolve => resolve());
+        }
+
+        function loadShard(number) {
+            if (shards[number]) {
+                return Promise.resolve();
+            }
+            return new Promise(resolve => {
+                const requested = number in shardWaiters;
+                shardWaiters[number] = (shardWaiters[number] || []).concat(resolve);
+                if (!requested) {
+                    const script = document.createElement("script");
+                    script.src = "gallery/page-" + String(number).padStart(5, "0") + ".js";
+                    document.body.appendChild(script);
+                }
+            });
+        }
+
+        // Postings are stored as gaps between sorted doc ids to keep the index small
+        function decode(key, deltas) {
+            if (!decodedPostings.has(key)) {
+                let value = 0;
+                decodedPostings.set(key, deltas.map(delta => (value += delta)));
+            }
+            return decodedPostings.get(key);
+        }
+
+        function union(lists) {
+            if (lists.length === 1) {
+                return lists[0];
+            }
+            return Array.from(new Set(lists.flat())).sort((a, b) => a - b);
+        }
+
+        function intersect(a, b) {
+            const out = [];
+            let i = 0, j = 0;
+            while (i < a.length && j < b.length) {
+                if (a[i] === b[j]) { out.push(a[i]); i++; j++; }
+                else if (a[i] < b[j]) { i++; }
+                else { j++; }
+            }
+            return out;
+        }
+
+        // Docs whose key (a prompt word, a style, a user) matches the query
+        function lookup(postings, prefix, query, matches) {
+            const lists = Object.keys(postings)
+                .filter(key => matches(key, query))
+                .map(key => decode(prefix + key, postings[key]));
+            return lists.length ? union(lists) : [];
+        }
+
+        function search() {
             const promptFilter = document.getElementById("prompt-filter").value.toLowerCase();
-            const styleFilter = document.getElementById("style-filter").value.toLowerCase();
-            const userFilter = document.getElementById("user-filter").value.toLowerCase();
+            const styleFilter = document.getElementById("style-filter").value.toLowerCase().trim();
+            const userFilter = document.getElementById("user-filter").value.toLowerCase().trim();
             const priceFilter = parseFloat(document.getElementById("price-filter").value) || 0;
 
-            const items = document.querySelectorAll(".gallery-item");
-            items.forEach(item => {
-                const prompt = item.getAttribute("data-prompt").toLowerCase();
-                const style = item.getAttribute("data-style").toLowerCase();
-                const user = item.getAttribute("data-user").toLowerCase();
-                const price = parseFloat(item.getAttribute("data-price")) || 0;
-
-                if (
-                    (prompt.includes(promptFilter)) &&
-                    (style.includes(styleFilter)) &&
-                    (user.includes(userFilter)) &&
-                    (price >= priceFilter)
-                ) {
-                    item.style.display = "block";
-                } else {
-                    item.style.display = "none";
+            const sets = [];
+            for (const word of promptFilter.match(/[a-z0-9]+/g) || []) {
+                const lists = tokenKeys.filter(key => key.startsWith(word)).map(key => decode("t:" + key, galleryData.tokens[key]));
+                sets.push(lists.length ? union(lists) : []);
+            }
+            if (styleFilter) {
+                sets.push(lookup(galleryData.styles, "s:", styleFilter, (key, query) => key.includes(query)));
+            }
+            if (userFilter) {
+                sets.push(lookup(galleryData.users, "u:", userFilter, (key, query) => key.includes(query)));
+            }
+            if (priceFilter > 0) {
+                // Prices are sorted ascending, binary search for the first one >= the minimum
+                const [prices, ids] = galleryData.prices;
+                let low = 0, high = prices.length;
+                while (low < high) {
+                    const middle = (low + high) >> 1;
+                    if (prices[middle] < priceFilter) { low = middle + 1; } else { high = middle; }
                 }
-            });
+                sets.push(ids.slice(low).sort((a, b) => a - b));
+            }
+            results = sets.length ? sets.reduce(intersect) : null;
+        }
+
+        function escapeHtml(text) {
+            return String(text).replace(/[&<>"']/g, c => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[c]));
+        }
+
+        function renderCard(doc) {
+            const [src, thumb, prompt, style, size, user, price, tooltip] = doc.map(escapeHtml);
+            return `<div class="gallery-item">
+                <a href="${src}" target="_blank"><img src="${thumb || src}" alt="${src}" loading="lazy"></a>
+                <p><strong>Prompt:</strong> ${prompt}</p>
+                <p><strong>Style:</strong> ${style}</p>
+                <p><strong>Size:</strong> ${size}</p>
+                <p><strong>User:</strong> ${user}</p>
+                <p class="price"><strong>Price:</strong> ${price}
+                    <span class="tooltip">${tooltip}</span>
+                </p>
+            </div>`;
+        }
+
+        async function renderPage() {
+            const pageSize = galleryData.page_size;
+            const total = results ? results.length : galleryData.count;
+            const pages = Math.max(1, Math.ceil(total / pageSize));
+            page = Math.min(Math.max(page, 0), pages - 1);
+            const ids = [];
+            for (let n = page * pageSize; n < Math.min(total, (page + 1) * pageSize); n++) {
+                ids.push(results ? results[n] : n);
+            }
+            const needed = Array.from(new Set(ids.map(id => Math.floor(id / pageSize))));
+            await Promise.all(needed.map(loadShard));
+            document.getElementById("gallery").innerHTML =
+                ids.map(id => renderCard(shards[Math.floor(id / pageSize)][id % pageSize])).join("");
+            document.getElementById("page-info").textContent = `Page ${page + 1} of ${pages} (${total} images)`;
+            document.getElementById("prev-page").disabled = page === 0;
+            document.getElementById("next-page").disabled = page >= pages - 1;
+        }
+
+        function filterGallery() {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(() => {
+                if (!galleryData) { return; }
+                search();
+                page = 0;
+                renderPage();
+            }, 150);
+        }
+
+        function changePage(step) {
+            if (!galleryData) { return; }
+            page += step;
+            renderPage();
         }
     </script>
 </head>
@@ -175,66 +346,137 @@ html_content = """
         <input type="text" id="user-filter" placeholder="👤 Filter by User" oninput="filterGallery()">
         <input type="number" id="price-filter" placeholder="💰 Minimum Price ($)" oninput="filterGallery()">
     </div>
-    <div class="gallery">
+    <div class="pager">
+        <button id="prev-page" onclick="changePage(-1)" disabled>◀ Previous</button>
+        <span id="page-info"></span>
+        <button id="next-page" onclick="changePage(1)">Next ▶</button>
+    </div>
+    <div class="gallery" id="gallery">
+"""
+
+# End of the HTML structure
+html_tail = """
+    </div>
+    <script src="gallery/index.js"></script>
+    <script>
+        if (galleryData) {
+            // Streaming builds skip the search index, so there is nothing to filter against
+            if (galleryData.searchable === false) {
+                document.querySelector(".filter-container").style.display = "none";
+            }
+            renderPage();
+        }
+    </script>
+    <footer>
+        <p>Powered by Your Creative Bot ✨</p>
+    </footer>
+</body>
+</html>
 """
 
-# Loop through files in the image folder to generate gallery items
-for filename in os.listdir(image_folder):
-    if filename.endswith(".png"):
-        image_path = os.path.join("bot", "image", filename).replace("\\", "/")
-
-        # Find the corresponding .txt file
-        txt_filename = filename.replace(".png", ".txt")
-        metadata_file = os.path.join(image_folder, txt_filename)
-
-        # Default metadata values (in case no metadata file exists)
-        prompt = "No prompt available"
-        style = "Unknown style"
-        size = "Unknown size"
-        user = "Anonymous"
-        price = "Not for sale"
-        tooltip = ""
-
-        # Check if the .txt file exists and read metadata , details
-        if os.path.exists(metadata_file):
-            with open(metadata_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                for line in lines:
-                    # Extract details from metadata file lines
-                    if line.startswith("Prompt:"):
-                        prompt = line.replace("Prompt:", "").strip()
-                    elif line.startswith("Style:"):
-                        style = line.replace("Style:", "").strip()
-                    elif line.startswith("Size:"):
-                        size = line.replace("Size:", "").strip()
-                    elif line.startswith("User:"):
-                        user = line.replace("User:", "").strip()
-                    elif line.startswith("Full User:"):
-                        # Parse user details (if available) for tooltips
-                        full_user_str = line.replace("Full User:", "").strip()
-                        try:
-                            full_user = json.loads(full_user_str)
-                            tooltip = f"Contact User: {full_user.get('first_name', '')} {full_user.get('last_name', '')}".strip()
-                            if full_user.get("username"):
-                                tooltip += f" (@{full_user['username']})"
-                        except json.JSONDecodeError:
-                            tooltip = "Full user details unavailable"
-                    elif line.startswith("Price:"):
-                        price_line = line.replace("Price:", "").strip()
-                        if price_line.lower() != "no":
-                            price = f"${price_line}"
-
-        # Convert price to a numeric value (used for filtering)
-        numeric_price = float(price.replace("$", "")) if price != "Not for sale" else 0
-
-        # Add the image and metadata to the HTML
-        html_content += f"""
-        <div class="gallery-item" 
-             data-prompt="{prompt}" 
-             data-style="{style}" 
-             data-user="{user}" 
-             data-price="{numeric_price}">
-            <img src="{image_path}" alt="{filename}">
+
+def image_signature(row):
+    """
+    Fingerprint of everything a card shows: the record's fields plus the image file's mtime and size.
+    A card is re-rendered only when this changes.
+    """
+    try:
+        stat = os.stat(os.path.join("bot", row["path"]))
+        file_state = f"{stat.st_mtime_ns}:{stat.st_size}"
+    except OSError:
+        file_state = "missing"
+    fields = [row["path"], row["prompt"], row["style"], row["size"], row["username"], row["full_user"], row["price"], file_state]
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+def make_thumbnail(source_path):
+    """
+    Runs in a worker process. Hashes the source image and encodes its thumbnail, unless a thumbnail
+    for that exact content already exists. Returns the thumbnail path, or None if the source is unreadable.
+    """
+    try:
+        with open(source_path, "rb") as f:
+            source_hash = hashlib.sha1(f.read()).hexdigest()
+        thumb_path = f"{thumbs_folder}/{source_hash}.{thumb_format}"
+        if not os.path.exists(thumb_path):
+            with Image.open(source_path) as image:
+                image.thumbnail((thumb_width, thumb_width * 4))
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                temp_path = thumb_path + ".tmp"
+                if thumb_format == "webp":
+                    image.save(temp_path, format="WEBP", quality=80, method=4)
+                else:
+                    image.save(temp_path, format="JPEG", quality=80, optimize=True)
+                os.replace(temp_path, thumb_path)
+        return thumb_path
+    except OSError as e:
+        print(f"Could not create thumbnail for {source_path}: {e}")
+        return None
+
+
+def make_thumbnails(rows, workers=None):
+    """
+    Creates thumbnails for `rows` in a process pool using every core. Returns {image_id: thumb_path}.
+    """
+    if not rows:
+        return {}
+    os.makedirs(thumbs_folder, exist_ok=True)
+    started = time.perf_counter()
+    sources = [os.path.join("bot", row["path"]) for row in rows]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        thumbs = list(pool.map(make_thumbnail, sources, chunksize=max(1, len(sources) // (workers * 8))))
+    elapsed = time.perf_counter() - started
+    print(f"  thumbnails: {len(sources)} images in {elapsed:.2f}s with {workers} workers "
+          f"({len(sources) / elapsed:.1f} images/second)")
+    return {row["image_id"]: thumb for row, thumb in zip(rows, thumbs)}
+
+
+def card_data(row, thumb_path=None):
+    """
+    Returns what a card shows for a generations row, as a list:
+    [original path, thumbnail path, prompt, style, size, user, price text, tooltip, numeric price].
+    The same list is used for the server-rendered first page and in the page shards.
+    """
+    image_path = os.path.join("bot", row["path"]).replace("\\", "/")
+
+    # Default metadata values (in case a field was never recorded)
+    prompt = row["prompt"] or "No prompt available"
+    style = row["style"] or "Unknown style"
+    size = row["size"] or "Unknown size"
+    user = row["username"] or "Anonymous"
+    price = f"${row['price']}" if row["price"] is not None else "Not for sale"
+    tooltip = ""
+
+    # Parse user details (if available) for tooltips
+    if row["full_user"]:
+        try:
+            full_user = json.loads(row["full_user"])
+            tooltip = f"Contact User: {full_user.get('first_name', '')} {full_user.get('last_name', '')}".strip()
+            if full_user.get("username"):
+                tooltip += f" (@{full_user['username']})"
+        except json.JSONDecodeError:
+            tooltip = "Full user details unavailable"
+
+    # Convert price to a numeric value (used for filtering)
+    numeric_price = row["price"] if row["price"] is not None else 0
+    return [image_path, thumb_path or "", prompt, style, size, user, price, tooltip, numeric_price]
+
+
+def render_card(doc):
+    """
+    Returns the HTML of one gallery item. The card shows the thumbnail (lazy loaded) and links to the
+    full-size original.
+    """
+    image_path, thumb_path, prompt, style, size, user, price, tooltip, _ = (
+        html.escape(str(value)) for value in doc
+    )
+    return f"""
+        <div class="gallery-item">
+            <a href="{image_path}" target="_blank">
+                <img src="{thumb_path or image_path}" alt="{image_path}" loading="lazy">
+            </a>
             <p><strong>Prompt:</strong> {prompt}</p>
             <p><strong>Style:</strong> {style}</p>
             <p><strong>Size:</strong> {size}</p>
@@ -245,19 +487,255 @@ for filename in os.listdir(image_folder):
         </div>
         """
 
-# End of the HTML structure
-html_content += """
-    </div>
-    <footer>
-        <p>Powered by Your Creative Bot ✨</p>
-    </footer>
-</body>
-</html>
-"""
 
-# Write the HTML content to the output file
-with open(output_file, "w", encoding="utf-8") as file:
-    file.write(html_content)
+def delta_encode(ids):
+    """
+    Stores sorted doc ids as the gaps between them, which keeps the JSON index small.
+    """
+    previous = 0
+    gaps = []
+    for doc_id in ids:
+        gaps.append(doc_id - previous)
+        previous = doc_id
+    return gaps
+
+
+def build_search_index(docs):
+    """
+    Builds the client's search index from the card data, in display order (doc id = position):
+    prompt word -> doc ids, style -> doc ids, user -> doc ids and a price column sorted ascending.
+    """
+    tokens = {}
+    styles = {}
+    users = {}
+    prices = []
+    for doc_id, doc in enumerate(docs):
+        for token in set(re.findall(r"[a-z0-9]+", doc[2].lower())):
+            tokens.setdefault(token, []).append(doc_id)
+        styles.setdefault(doc[3].lower(), []).append(doc_id)
+        users.setdefault(doc[5].lower(), []).append(doc_id)
+        if doc[8] > 0:
+            prices.append((doc[8], doc_id))
+    prices.sort()
+    return {
+        "count": len(docs),
+        "page_size": page_size,
+        "tokens": {token: delta_encode(ids) for token, ids in tokens.items()},
+        "styles": {style: delta_encode(ids) for style, ids in styles.items()},
+        "users": {user: delta_encode(ids) for user, ids in users.items()},
+        "prices": [[price for price, _ in prices], [doc_id for _, doc_id in prices]],
+    }
+
+
+def write_shards(docs):
+    """
+    Writes the card data in pages of `page_size` as gallery/page-NNNNN.js and removes pages left
+    over from a bigger gallery. Shards are scripts (not .json) so the page also works from file://.
+    """
+    os.makedirs(shards_folder, exist_ok=True)
+    shard_count = (len(docs) + page_size - 1) // page_size
+    for number in range(shard_count):
+        write_shard(number, [doc[:8] for doc in docs[number * page_size:(number + 1) * page_size]])
+    remove_stale_shards(shard_count)
+    return shard_count
+
+
+def write_shard(number, docs):
+    path = os.path.join(shards_folder, f"page-{number:05d}.js")
+    write_atomic(path, f"galleryShard({number},{json.dumps(docs, separators=(',', ':'))});")
+
+
+def remove_stale_shards(shard_count):
+    """
+    Deletes page shards left over from an earlier, bigger build.
+    """
+    with os.scandir(shards_folder) as entries:
+        for entry in entries:
+            match = re.fullmatch(r"page-(\d+)\.js", entry.name)
+            if match and int(match.group(1)) >= shard_count:
+                os.remove(entry.path)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}  # a broken manifest just means a full rebuild
+
+
+def write_atomic(path, content):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+def iter_image_rows(conn):
+    """
+    Walks the image folder and its shard folders (image/ab/cd/) with os.scandir, one directory entry
+    at a time, no full listing in memory, and yields the generations row of each image.
+    Images without a record get a placeholder row. Images whose record has no path are skipped: the file
+    is left over from an eviction that didn't finish (`python storage.py reconcile` deletes it).
+    """
+    folders = [image_folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                    continue
+                if not entry.name.endswith(".png") or not entry.is_file():
+                    continue
+                image_id = entry.name[:-len(".png")]
+                row = get_generation(conn, image_id)
+                if row is not None and row["path"] is None:
+                    continue
+                if row is None:
+                    path = os.path.relpath(entry.path, "bot").replace(os.sep, "/")
+                    row = {"path": path, "prompt": None, "style": None, "size": None,
+                           "username": None, "full_user": None, "price": None}
+                yield row
+
+
+def build_streaming():
+    """
+    Constant-memory build for very large archives. Cards are produced by a generator and written
+    straight to disk: the first page into index.html, the rest into page shards as each page fills.
+    No manifest, thumbnails or search index are kept (all of them grow with the archive), so the page
+    offers paging but no filtering. index.html is replaced atomically once the walk is done.
+    Returns the number of images written.
+    """
+    started = time.perf_counter()
+    os.makedirs(shards_folder, exist_ok=True)
+    conn = connect(db_file)
+    migrate(conn)
+    temp_output = output_file + ".tmp"
+    count = 0
+    page = []
+    with open(temp_output, "w", encoding="utf-8") as out:
+        out.write(html_head)
+        for row in iter_image_rows(conn):
+            doc = card_data(row)
+            if count < page_size:
+                out.write(render_card(doc))
+            page.append(doc[:8])
+            count += 1
+            if len(page) == page_size:
+                write_shard(count // page_size - 1, page)
+                page = []
+        if page:
+            write_shard(count // page_size, page)
+        out.write(html_tail)
+    conn.close()
+
+    shard_count = (count + page_size - 1) // page_size
+    remove_stale_shards(shard_count)
+    write_atomic(os.path.join(shards_folder, "index.js"),
+                 f"galleryIndex({json.dumps({'count': count, 'page_size': page_size, 'searchable': False})});")
+    os.replace(temp_output, output_file)
+
+    elapsed = time.perf_counter() - started
+    print(f"  streamed {count} images in {shard_count} pages of {page_size} in {elapsed * 1000:.1f} ms")
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"  peak memory {peak:.1f} MB")
+    return count
+
+
+def build(full=False, workers=None):
+    """
+    Builds index.html. Unless `full` is set, cards whose signature matches the manifest (and whose
+    thumbnail still exists) are reused instead of being rendered again. Returns (rendered, reused) counts.
+    """
+    timings = {}
+    started = time.perf_counter()
+    old_manifest = {} if full else load_manifest(manifest_file)
+    timings["manifest load"] = time.perf_counter() - started
+
+    # Loop through the generation records in the bot database to generate gallery items
+    # (import old .txt metadata files once with: cd bot && python database.py import image)
+    step = time.perf_counter()
+    conn = connect(db_file)
+    migrate(conn)
+    rows = query_generations(conn)
+    conn.close()
+    timings["database query"] = time.perf_counter() - step
+
+    # Find new or changed images, only those get a thumbnail pass and a fresh card
+    step = time.perf_counter()
+    signatures = [image_signature(row) for row in rows]
+    changed = []
+    for row, signature in zip(rows, signatures):
+        entry = old_manifest.get(row["image_id"])
+        if entry is None or "doc" not in entry or entry["signature"] != signature \
+                or (entry.get("thumb") and not os.path.exists(entry["thumb"])):
+            changed.append(row)
+    timings["change scan"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    thumbs = make_thumbnails(changed, workers)
+    timings["thumbnails"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    manifest = {}
+    docs = []
+    for row, signature in zip(rows, signatures):
+        image_id = row["image_id"]
+        if image_id in thumbs:
+            entry = {"signature": signature, "thumb": thumbs[image_id], "doc": card_data(row, thumbs[image_id])}
+        else:
+            entry = old_manifest[image_id]
+        manifest[image_id] = entry
+        docs.append(entry["doc"])
+    rendered = len(changed)
+    timings["cards"] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    search_index = build_search_index(docs)
+    timings["search index"] = time.perf_counter() - step
+
+    # The page itself only carries the first page of cards, everything else is in the shards
+    step = time.perf_counter()
+    first_page = [render_card(doc) for doc in docs[:page_size]]
+    write_atomic(output_file, "".join([html_head, *first_page, html_tail]))
+    shard_count = write_shards(docs)
+    write_atomic(os.path.join(shards_folder, "index.js"), f"galleryIndex({json.dumps(search_index, separators=(',', ':'))});")
+    write_atomic(manifest_file, json.dumps(manifest))
+    timings["write"] = time.perf_counter() - step
+    print(f"  {len(docs)} images in {shard_count} pages of {page_size}")
+
+    total = time.perf_counter() - started
+    for name, seconds in timings.items():
+        print(f"  {name:<15} {seconds * 1000:9.1f} ms")
+    print(f"  {'total':<15} {total * 1000:9.1f} ms")
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"  peak memory {peak:.1f} MB")
+    return rendered, len(rows) - rendered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the image gallery (index.html) from the bot database.")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and re-render every card")
+    parser.add_argument("--workers", type=int, default=None, help="thumbnail worker processes (default: all cores)")
+    parser.add_argument("--stream", action="store_true",
+                        help="constant-memory build for very large archives (paging only, no thumbnails or search)")
+    args = parser.parse_args()
 
-# Print success message YAY I FINALLY DID IT
-print(f"HTML file '{output_file}' has been generated with enhanced styling functionality!")
+    if args.stream:
+        count = build_streaming()
+        print(f"HTML file '{output_file}' has been generated with enhanced styling functionality! ({count} images)")
+    else:
+        rendered, reused = build(full=args.full, workers=args.workers)
+        # Print success message YAY I FINALLY DID IT
+        print(f"HTML file '{output_file}' has been generated with enhanced styling functionality! "
+              f"({rendered} cards rendered, {reused} reused)")
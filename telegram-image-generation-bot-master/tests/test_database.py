@@ -0,0 +1,54 @@
+"""
+Schema migrations of database.py.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from database import MIGRATIONS, connect, migrate  # noqa: E402
+
+
+def _migrate_at_once(path, barrier, errors):
+    conn = connect(path)
+    barrier.wait()
+    try:
+        migrate(conn)
+    except Exception as e:
+        errors.put(repr(e))
+    finally:
+        conn.close()
+
+
+def test_concurrent_migrations(tmp_path):
+    # Webhook workers and replicas all migrate the same database when they start
+    context = multiprocessing.get_context("spawn")
+    for trial in range(5):
+        path = str(tmp_path / f"bot_{trial}.db")
+        barrier = context.Barrier(3)
+        errors = context.Queue()
+        processes = [context.Process(target=_migrate_at_once, args=(path, barrier, errors)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=60)
+            assert process.exitcode == 0
+        assert errors.empty(), errors.get()
+
+        conn = connect(path)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        migrate(conn)  # a later start has nothing left to do
+        conn.close()
+
+
+def test_migrate_repairs_a_half_migrated_database(tmp_path):
+    # What the old migrate() could leave behind: every step applied, user_version stuck at an earlier one
+    conn = connect(str(tmp_path / "bot.db"))
+    migrate(conn)
+    conn.execute("PRAGMA user_version = 4")
+    migrate(conn)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    conn.close()
@@ -0,0 +1,37 @@
+"""
+File id bookkeeping of delivery.py.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from database import Database  # noqa: E402
+from delivery import FileIdStore  # noqa: E402
+
+
+def test_file_ids_are_bounded_and_recent_reads_the_database(tmp_path):
+    async def main():
+        database = Database(str(tmp_path / "bot.db"))
+        database.open()
+        try:
+            store = FileIdStore(database, max_entries=3)
+            for n in range(5):
+                store.set(f"image-{n}", f"file-{n}")
+                await database.flush()  # one created_at per image
+                await asyncio.sleep(0.002)
+            assert store.get("image-0") is None and store.get("image-4") == "file-4"
+            assert await store.recent(2) == [("image-4", "file-4"), ("image-3", "file-3")]
+
+            restarted = FileIdStore(database, max_entries=2)
+            await restarted.load()
+            assert restarted.get("image-2") is None
+            assert restarted.get("image-3") == "file-3"
+            restarted.set("image-9", "file-9")  # image-4 is now the least recently used
+            assert restarted.get("image-4") is None and restarted.get("image-3") == "file-3"
+        finally:
+            database.close()
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+"""
+Access lists of helper.py.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from helper import Helper  # noqa: E402
+
+
+def test_env_file_can_revoke_access_granted_at_startup(tmp_path, monkeypatch):
+    env_file = tmp_path / ".env"
+    env_file.write_text("USER_ID=1,2\nADMIN_ID=1\n")
+    # What load_dotenv left in the environment when the bot started
+    monkeypatch.setenv("USER_ID", "1,2")
+    monkeypatch.setenv("ADMIN_ID", "1")
+    helper = Helper(env_file=str(env_file))
+    assert helper.is_user(2) and helper.is_admin(1)
+
+    env_file.write_text("USER_ID=1\nADMIN_ID=\n")
+    helper.reload()
+    assert helper.is_user(1) and not helper.is_user(2)
+    assert not helper.is_admin(1)
+
+    env_file.unlink()
+    helper.reload()
+    assert not helper.is_user(1)
+
+
+def test_environment_is_used_without_env_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("USER_ID", "7")
+    monkeypatch.setenv("ADMIN_ID", "")
+    helper = Helper(env_file=str(tmp_path / ".env"))
+    assert helper.is_user(7) and not helper.is_admin(7)
@@ -0,0 +1,140 @@
+"""
+Circuit breaker and retry behaviour of resilience.py.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from resilience import ResilientCaller, CircuitBreaker, CircuitOpenError, RetryPolicy, UpstreamError  # noqa: E402
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+        self.headers = {}
+
+
+def respond(status_code, delay=0.0):
+    async def send():
+        await asyncio.sleep(delay)
+        return Response(status_code)
+    return send
+
+
+def half_open_caller():
+    """
+    A caller whose breaker opened after one failure and may probe again right away.
+    """
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    caller = ResilientCaller(retry=RetryPolicy(attempts=0), breaker=breaker, hedge_percentile=0)
+
+    async def open_it():
+        with pytest.raises(UpstreamError):
+            await caller.call(respond(500))
+        assert breaker.state == breaker.OPEN
+        await asyncio.sleep(0.02)
+    return caller, open_it
+
+
+def test_breaker_opens_and_probe_closes_it():
+    async def main():
+        caller, open_it = half_open_caller()
+        await open_it()
+        assert (await caller.call(respond(200))).status_code == 200
+        assert caller.breaker.state == caller.breaker.CLOSED
+    asyncio.run(main())
+
+
+def test_breaker_refuses_calls_while_open():
+    async def main():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        caller = ResilientCaller(retry=RetryPolicy(attempts=0), breaker=breaker, hedge_percentile=0)
+        with pytest.raises(UpstreamError):
+            await caller.call(respond(500))
+        with pytest.raises(CircuitOpenError):
+            await caller.call(respond(200))
+    asyncio.run(main())
+
+
+def test_cancelled_probe_releases_the_breaker():
+    async def main():
+        caller, open_it = half_open_caller()
+        await open_it()
+        probe = asyncio.create_task(caller.call(respond(200, delay=10)))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        for _ in range(3):
+            assert (await caller.call(respond(200))).status_code == 200
+        assert caller.breaker.state == caller.breaker.CLOSED
+    asyncio.run(main())
+
+
+def test_unexpected_error_in_probe_releases_the_breaker():
+    async def main():
+        caller, open_it = half_open_caller()
+        await open_it()
+
+        async def broken():
+            raise ValueError("not an API failure")
+        with pytest.raises(ValueError):
+            await caller.call(broken)
+        assert (await caller.call(respond(200))).status_code == 200
+    asyncio.run(main())
+
+
+def hedging_caller(latency):
+    """
+    A caller that has seen enough calls of `latency` seconds to start hedging.
+    """
+    caller = ResilientCaller(retry=RetryPolicy(attempts=0), hedge_percentile=50)
+    for _ in range(caller.MIN_HEDGE_SAMPLES):
+        caller.latency.add(latency)
+    return caller
+
+
+def test_cancelled_caller_cancels_the_attempt_in_flight():
+    async def main():
+        caller = hedging_caller(latency=5)
+        cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        call = asyncio.create_task(caller.call(slow))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+    asyncio.run(main())
+
+
+def test_hedge_success_wins_over_failure_finishing_with_it():
+    async def main():
+        caller = hedging_caller(latency=0.01)
+        both_sent = asyncio.Event()
+        calls = []
+
+        async def send():
+            calls.append(len(calls))
+            if len(calls) == 2:
+                both_sent.set()
+            first = len(calls) == 1
+            await both_sent.wait()
+            if first:
+                raise RuntimeError("primary broke")
+            return Response(200)
+        assert (await caller.call(send)).status_code == 200
+        assert caller.hedges == 1 and caller.hedge_wins == 1
+    asyncio.run(main())
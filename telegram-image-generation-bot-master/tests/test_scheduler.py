@@ -0,0 +1,55 @@
+"""
+Queueing behaviour of scheduler.py.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from scheduler import GenerationScheduler  # noqa: E402
+
+
+def job(result, started=None, seconds=0.01):
+    async def run():
+        if started is not None:
+            started.append(result)
+        await asyncio.sleep(seconds)
+        return result
+    return run
+
+
+def test_jobs_beyond_capacity_wait_their_turn():
+    async def main():
+        scheduler = GenerationScheduler(max_concurrency=1, per_user_limit=1, max_queue=10)
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+        results = await asyncio.gather(
+            scheduler.submit(1, job("first"), on_queued=on_queued),
+            scheduler.submit(2, job("second"), on_queued=on_queued),
+        )
+        assert results == ["first", "second"]
+        assert positions == [1]
+        assert scheduler.queue_depth == 0 and scheduler.running == 0
+    asyncio.run(main())
+
+
+def test_failing_queue_notification_still_runs_the_job_once():
+    async def main():
+        scheduler = GenerationScheduler(max_concurrency=1, per_user_limit=1, max_queue=10)
+        started = []
+
+        async def on_queued(position):
+            raise RuntimeError("message could not be sent")
+        results = await asyncio.gather(
+            scheduler.submit(1, job("first", started)),
+            scheduler.submit(2, job("second", started), on_queued=on_queued),
+        )
+        assert results == ["first", "second"]
+        assert started == ["first", "second"]
+        assert scheduler.queue_depth == 0 and scheduler.running == 0
+    asyncio.run(main())